@@ -0,0 +1,279 @@
+"""A benchmark suite of the terms extraction and the page parsing.
+
+The suites (SUITES):
+
+- ngrams: iter_n_grams over texts of several sizes;
+- extract: TermsExtractor.extract_terms of every engine with dictionaries
+  of 40 to 100k terms;
+- parsers: parse_page of every aggregator parser and the generic one on pages
+  of 1 KB to 5 MB;
+- e2e: extract_techs runners fetching pages from a local stub server.
+
+The results are written as json (--output) with the commit and the environment,
+a later run compares its results with them by --compare and exits with 1 if any
+benchmark is slower by more than --threshold.
+
+Usage: python -m benchmarks.bench_suite [--quick] [--suite NAME] [--output FILE]
+                                        [--compare FILE]
+"""
+
+import argparse
+from collections import deque
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from jobtechs.parser import (
+    NETLOC_TO_PARSER_MAP, TERMS_EXTRACTORS, AutomatonTermsExtractor, PageParser, iter_n_grams)
+from jobtechs.sinks import open_sink
+import jobtechs.termsdb  # pylint: disable=unused-import
+
+from benchmarks.corpus import PAGES, make_page, make_terms, make_text, write_terms
+
+KB = 1024
+MB = 1024 * KB
+
+# the seconds a measurement of a fast operation takes at least
+MIN_TIME = 0.2
+
+
+def measure(func, repeat=3):
+    """Return the best time of a single call of func in seconds.
+
+    Fast functions are called in loops of about MIN_TIME seconds."""
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    number = max(int(MIN_TIME / elapsed), 1) if elapsed > 0 else 1000
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+class Suite:
+    """Collects the results of the benchmarks of a run."""
+
+    def __init__(self, quick=False, workdir=None):
+        self.quick = quick
+        self.workdir = workdir
+        self.results = []
+
+    def record(self, suite, name, seconds, size=None, **params):
+        """Add a result, size is the number of bytes (or items) processed by a call."""
+        result = {'suite': suite, 'name': name, 'params': params, 'seconds': seconds}
+        if size:
+            result['size'] = size
+            result['throughput'] = size / seconds
+        self.results.append(result)
+        print('{:<8} {:<46} {:<32} {:>12.6f} s{}'.format(
+            suite, name, ' '.join('{}={}'.format(*item) for item in sorted(params.items())),
+            seconds, ' {:>9.2f} MB/s'.format(size / seconds / MB) if size else ''))
+        sys.stdout.flush()
+
+    def terms_file(self, count):
+        """Return the path of a terms file of count synthetic terms."""
+        path = os.path.join(self.workdir, 'terms{}.txt'.format(count))
+        if not os.path.exists(path):
+            write_terms(make_terms(count), path)
+        return path
+
+    @property
+    def text_sizes(self):
+        # pylint: disable=missing-docstring
+        return (KB, 64 * KB) if self.quick else (KB, 64 * KB, MB)
+
+    @property
+    def page_sizes(self):
+        # pylint: disable=missing-docstring
+        return (KB, 64 * KB) if self.quick else (KB, 64 * KB, MB, 5 * MB)
+
+    @property
+    def terms_counts(self):
+        # pylint: disable=missing-docstring
+        return (40, 1000) if self.quick else (40, 1000, 100000)
+
+
+def bench_ngrams(suite):
+    """iter_n_grams over texts of several sizes."""
+    terms = make_terms(40)
+    for size in suite.text_sizes:
+        text = make_text(size, terms)
+        for max_n in (1, 2, 3):
+            seconds = measure(lambda: deque(iter_n_grams(text, max_n), maxlen=0))
+            suite.record('ngrams', 'iter_n_grams', seconds, size, text_size=size, max_n=max_n)
+
+
+def bench_extract(suite):
+    """extract_terms of every engine with dictionaries of several sizes."""
+    for count in suite.terms_counts:
+        terms_path = suite.terms_file(count)
+        terms = make_terms(count)
+        for engine, extractor_cls in sorted(TERMS_EXTRACTORS.items()):
+            started = time.perf_counter()
+            extractor = extractor_cls(terms_path)
+            suite.record('extract', 'load ' + engine, time.perf_counter() - started,
+                         terms=count)
+            for size in suite.text_sizes:
+                text = make_text(size, terms)
+                seconds = measure(lambda: extractor.extract_terms(text))
+                suite.record('extract', 'extract_terms ' + engine, seconds, size,
+                             terms=count, text_size=size)
+
+
+def bench_parsers(suite):
+    """parse_page of every parser on pages of several sizes."""
+    terms = make_terms(40)
+    extractor = AutomatonTermsExtractor(suite.terms_file(40))
+    parsers = {netloc: parser_cls() for netloc, parser_cls in NETLOC_TO_PARSER_MAP.items()}
+    parsers['default'] = PageParser(agg_parsers=list(parsers.values()))
+    for netloc in sorted(PAGES):
+        parser = parsers[netloc]
+        for size in suite.page_sizes:
+            url, page = make_page(netloc, size, terms)
+            result, error = parser.parse_page(url, page, extractor, 'utf-8')
+            if error or not result.term_ids:
+                raise RuntimeError('{} failed to parse its page: {}'.format(netloc, error))
+            seconds = measure(lambda: parser.parse_page(url, page, extractor, 'utf-8'))
+            suite.record('parsers', '{} {}'.format(type(parser).__name__, netloc), seconds,
+                         len(page), page_size=size)
+
+
+def bench_e2e(suite):
+    """extract_techs runners fetching pages from a local stub server."""
+    # pylint: disable=import-outside-toplevel
+    from jobtechs.scripts.extract_techs import RUNNERS
+    # the stub server of the tests
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), 'tests'))
+    from stub_server import StubServer
+
+    terms = make_terms(40)
+    count = 200 if suite.quick else 1000
+    size = 16 * KB
+    _, page = make_page('default', size, terms)
+    for engine, runner_cls in sorted(RUNNERS.items()):
+        pages = {'/job/{}'.format(i): page for i in range(count)}
+        with StubServer(pages) as server:
+            urls = ''.join(server.url(path) + '\n' for path in sorted(pages))
+            try:
+                runner = runner_cls(
+                    terms_path=suite.terms_file(40),
+                    errors_path=os.path.join(suite.workdir, 'errors.txt'),
+                    sink=open_sink('jsonl', os.devnull), host_rps=0, max_rps=0,
+                    stats_interval=0, terms_reload_interval=None)
+            except RuntimeError as err:
+                print('e2e {} skipped: {}'.format(engine, err))
+                continue
+            started = time.perf_counter()
+            runner.run(urls.splitlines())
+            seconds = time.perf_counter() - started
+            runner.close()
+            if runner.sink.rows != count:
+                raise RuntimeError('{} of {} pages parsed by {}'.format(
+                    runner.sink.rows, count, engine))
+        suite.record('e2e', 'extract_techs ' + engine, seconds, count * len(page),
+                     pages=count, page_size=size)
+
+
+# benchmark functions by suite name
+SUITES = {
+    'ngrams': bench_ngrams,
+    'extract': bench_extract,
+    'parsers': bench_parsers,
+    'e2e': bench_e2e,
+}
+
+
+def get_commit():
+    """Return the commit of the working tree and whether it has changes, None outside git."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=directory, stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=directory,
+            stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {'commit': commit.decode().strip(), 'dirty': bool(status.strip())}
+
+
+def result_key(result):
+    """Return the key identifying a benchmark across runs."""
+    return (result['suite'], result['name'],
+            tuple(sorted((key, str(value)) for key, value in result['params'].items())))
+
+
+def compare(baseline, results, threshold):
+    """Print the ratios of the times to the baseline ones, return the number of regressions."""
+    old = {result_key(result): result['seconds'] for result in baseline['results']}
+    regressions = 0
+    print('\ncompared with {}'.format(baseline.get('meta', {}).get('git')))
+    for result in results:
+        seconds = old.get(result_key(result))
+        if seconds is None:
+            continue
+        ratio = result['seconds'] / seconds
+        mark = ''
+        if ratio > 1 + threshold:
+            mark = ' REGRESSION'
+            regressions += 1
+        elif ratio < 1 - threshold:
+            mark = ' faster'
+        suite, name, params = result_key(result)
+        print('{:<8} {:<46} {:<32} {:>6.2f}x{}'.format(
+            suite, name, ' '.join('{}={}'.format(*item) for item in params), ratio, mark))
+    return regressions
+
+
+def main():
+    """Run the suites, write and compare the results."""
+    args_parser = argparse.ArgumentParser(description=__doc__,
+                                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    args_parser.add_argument('--suite', action='append', choices=list(SUITES),
+                             help='A suite to run, may be repeated. Defaults to all.')
+    args_parser.add_argument('--quick', action='store_true',
+                             help='Smaller corpora, for a quick check.')
+    args_parser.add_argument('--output', help='A json file the results are written to.')
+    args_parser.add_argument('--compare', metavar='FILE',
+                             help='A json file of earlier results to compare with.')
+    args_parser.add_argument('--threshold', type=float, default=0.1,
+                             help='The slowdown counted as a regression. Defaults to 0.1.')
+    args = args_parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='jobtechs-bench-')
+    suite = Suite(quick=args.quick, workdir=workdir)
+    try:
+        for name in args.suite or list(SUITES):
+            SUITES[name](suite)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'git': get_commit(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'quick': args.quick,
+        },
+        'results': suite.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file_:
+            json.dump(report, file_, indent=1)
+    if args.compare:
+        with open(args.compare) as file_:
+            baseline = json.load(file_)
+        if compare(baseline, suite.results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
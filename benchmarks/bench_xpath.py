@@ -0,0 +1,59 @@
+"""A microbenchmark of the aggregator parsers selectors: XPath expression strings
+evaluated by tree.xpath versus the selectors compiled at class creation.
+
+Usage: python -m benchmarks.bench_xpath [--number N]
+"""
+
+import argparse
+import timeit
+
+import lxml.html as etree
+
+from jobtechs.parser import NETLOC_TO_PARSER_MAP
+
+PAGE = '''<html><head>
+<meta property="og:url" content="https://boards.greenhouse.io/acme/jobs/42">
+<meta name="groupId" content="acme"><meta name="jobId" content="SM1-42">
+<link rel="alternate" media="handheld" href="/m/viewjob?jk=ce09ccbdef05dafc">
+</head><body>
+<div id="header"><a href="http://acme.com/">Acme</a><span class="company-name">at Acme</span></div>
+<div id="logo"><h1><img alt="Acme"></h1></div>
+<div id="content">{}</div>
+<ul><li itemprop="hiringOrganization"><span itemprop="name">Acme</span></li></ul>
+</body></html>'''.format('<p>We use Python, Django and PostgreSQL.</p>\n' * 200)
+
+
+def bench_parser(parser_class, tree, number):
+    """Return the time of evaluating all the selectors of the class by strings and compiled."""
+    parser = parser_class()
+    expressions = parser_class.selectors
+
+    def by_strings():
+        for expression in expressions.values():
+            tree.xpath(expression)
+
+    def compiled():
+        for selector in expressions:
+            parser.select(selector, tree)
+
+    return (min(timeit.repeat(by_strings, number=number, repeat=3)),
+            min(timeit.repeat(compiled, number=number, repeat=3)))
+
+
+def main():
+    """Print the per-page time of the selectors of every aggregator parser."""
+    args_parser = argparse.ArgumentParser(description=__doc__)
+    args_parser.add_argument('--number', type=int, default=2000,
+                             help='The number of evaluations per measurement.')
+    args = args_parser.parse_args()
+    tree = etree.fromstring(PAGE)
+    print('{:<28} {:>10} {:>10} {:>8}'.format('parser', 'strings,us', 'compiled,us', 'speedup'))
+    for netloc, parser_class in sorted(NETLOC_TO_PARSER_MAP.items()):
+        by_strings, compiled = bench_parser(parser_class, tree, args.number)
+        print('{:<28} {:>10.1f} {:>10.1f} {:>7.2f}x'.format(
+            netloc, by_strings / args.number * 1e6, compiled / args.number * 1e6,
+            by_strings / compiled))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Synthetic corpora for the benchmarks: term dictionaries, description texts and
+job pages shaped like the pages of every aggregator parser.
+
+Everything is generated from a seed, so that the same corpus is used for all
+the commits compared.
+"""
+
+import os
+import random
+
+from jobtechs.common import iter_good_lines
+
+TECHS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'techs.txt')
+
+# the words the descriptions are made of besides the terms
+FILLER = ('we are looking for an experienced developer to join our team you will work with '
+          'the latest technologies and build scalable services for millions of users '
+          'experience with is a plus must have strong skills in and good communication').split()
+
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def read_techs():
+    """Return the terms of the techs file of the project."""
+    with open(TECHS_PATH) as file_:
+        return list(iter_good_lines(file_))
+
+
+def make_terms(count, seed=0):
+    """Return a list of count distinct terms: the techs of the project and random ones.
+
+    The random terms are of 1-3 words, some of them with '.', '#' or '+'."""
+    rnd = random.Random(seed)
+    terms = read_techs()[:count]
+    seen = {term.lower() for term in terms}
+    words = [''.join(rnd.choice(LETTERS) for _ in range(rnd.randint(2, 9)))
+             + rnd.choice(('', '', '', '', '.js', '#', '++'))
+             for _ in range(max(count // 2, 1))]
+    while len(terms) < count:
+        term = ' '.join(rnd.choice(words) for _ in range(rnd.choice((1, 1, 2, 2, 3))))
+        if term not in seen:
+            seen.add(term)
+            terms.append(term)
+    return terms
+
+
+def write_terms(terms, path):
+    """Write the terms into a terms file at the path."""
+    with open(path, 'w') as file_:
+        print(*terms, sep='\n', file=file_)
+
+
+def make_text(size, terms, seed=0, density=0.05):
+    """Return a text of about size characters of filler words and terms.
+
+    density is the share of the terms among the words."""
+    rnd = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        if rnd.random() < density:
+            word = rnd.choice(terms)
+        else:
+            word = rnd.choice(FILLER)
+        if rnd.random() < 0.08:
+            word += rnd.choice((',', '.'))
+        parts.append(word)
+        length += len(word) + 1
+    return ' '.join(parts)[:size]
+
+
+def make_description_html(size, terms, seed=0):
+    """Return paragraphs of about size characters of a job description."""
+    text = make_text(size, terms, seed)
+    paragraphs = [text[i:i + 600] for i in range(0, len(text), 600)]
+    return '\n'.join('<p>{}</p>'.format(paragraph) for paragraph in paragraphs)
+
+
+# urls and page templates by the netloc of the parser, 'default' is a generic page;
+# {} is replaced by the description
+PAGES = {
+    'www.indeed.com': (
+        'https://www.indeed.com/viewjob?jk=ce09ccbdef05dafc',
+        '''<html><head><title>Developer - Acme</title>
+<link rel="alternate" media="handheld" href="/m/viewjob?jk=ce09ccbdef05dafc"></head>
+<body><span class="company">Acme</span><span id="job_summary">{}</span></body></html>'''),
+    'newton.newtonsoftware.com': (
+        'https://newton.newtonsoftware.com/career/JobIntroduction.action?clientId=8a78&id=8a79',
+        '''<html><head><title>Developer</title></head><body>
+<span id="indeed-apply-widget" data-indeed-apply-jobcompanyname="Acme"
+ data-indeed-apply-continueurl="http://acme.com/careers"></span>
+<table id="gnewtonJobDescription"><tr><td id="gnewtonJobDescriptionText">{}</td></tr></table>
+</body></html>'''),
+    'boards.greenhouse.io': (
+        'https://boards.greenhouse.io/embed/job_app?for=acme&token=42',
+        '''<html><head><meta property="og:url" content="https://boards.greenhouse.io/acme/jobs/42">
+</head><body><div id="header"><a href="http://acme.com/careers">Acme</a>
+<span class="company-name">at Acme</span></div><div id="content">{}</div></body></html>'''),
+    'recruit.hirebridge.com': (
+        'http://recruit.hirebridge.com/v3/Jobs/JobDetails.aspx?cid=7744&jid=451687',
+        '''<html><head><meta property="og:url"
+ content="http://recruit.hirebridge.com/v3/Jobs/JobDetails.aspx?cid=7744&jid=451687"></head>
+<body><div id="logo"><h1><img alt="Acme"></h1></div><div id="main">{}</div>
+<div id="rightcol"><a href="http://acme.com/">Acme</a></div></body></html>'''),
+    'jobs.jobvite.com': (
+        'http://jobs.jobvite.com/acme/job/oNg44fwV',
+        '''<html><head><title>Developer</title></head><body>
+<div class="jv-logo"><a href="http://acme.com/"><img alt="Acme"></a></div>
+<div class="jv-job-detail-description">{}</div></body></html>'''),
+    'www.dice.com': (
+        'https://www.dice.com/jobs/detail/developer-acme/cybercod/SM1-42',
+        '''<html><head><meta name="groupId" content="cybercod"><meta name="jobId" content="SM1-42">
+</head><body><ul><li itemprop="hiringOrganization"><span itemprop="name">Acme</span></li></ul>
+<div id="jobdescSec">{}</div></body></html>'''),
+    'default': (
+        'http://acme.com/careers/developer',
+        '''<html><head><title>Developer at Acme</title><style>p {{ margin: 0 }}</style>
+<script>var tracking = "<p>not a description</p>";</script></head>
+<body><h1>Developer</h1>{}</body></html>'''),
+}
+
+
+def make_page(netloc, size, terms, seed=0):
+    """Return the url and the utf-8 bytes of a job page of about size bytes for the parser."""
+    url, template = PAGES[netloc]
+    overhead = len(template) - 2
+    html = template.format(make_description_html(max(size - overhead, 0), terms, seed))
+    return url, html.encode('utf-8')
@@ -0,0 +1,382 @@
+"""The module defines an asyncio-based alternative to the ThrottledFetcher processes.
+
+A single event loop requests all the urls concurrently with aiohttp. Each host has
+its own limit of concurrent requests and requests per second, which is lowered
+when the host responds with 429/503 (see HostLimiter). Parsing of the
+fetched pages is CPU-bound, hence it is passed to a pool of processes, each of
+which gets its copy of the parsers and the terms extractor once, on start.
+
+The fetcher puts the same results and errors to q_out and q_err as ThrottledFetcher.
+If they are bounded and full, the tasks wait for free room without blocking the loop,
+and no new urls are taken meanwhile.
+
+The stages of processing the urls may be timed (see jobtechs.metrics), aiohttp
+reports resolving the hosts and connecting to them separately.
+
+aiohttp is an optional dependency required only by this module.
+"""
+
+import asyncio
+import heapq
+import logging
+from queue import Full
+import time
+from urllib.parse import urlparse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from jobtechs import parsepool
+from jobtechs.common import DEFAULT_HEADERS, get_charset
+from jobtechs.fetcher import SessionFactory
+from jobtechs.metrics import Trace
+from jobtechs.throttle import HostScheduler, TokenBucket, parse_retry_after
+
+G_LOG = logging.getLogger(__name__)
+
+# statuses worth retrying, the same as in SessionFactory
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+CONNECTION_ERROR = 'requests.ConnectionError: Failed to establish a new connection.'
+
+
+def http_error_message(status, reason, url):
+    """Format an error for the status the same way as requests' raise_for_status does.
+
+    Returns None if the status is not an error."""
+    if 400 <= status < 500:
+        kind = 'Client'
+    elif 500 <= status < 600:
+        kind = 'Server'
+    else:
+        return None
+    return '{} {} Error: {} for url: {}'.format(status, kind, reason, url)
+
+
+def make_trace_config():
+    """Return an aiohttp TraceConfig timing the dns and connect stages of the Trace
+    given as the trace_request_ctx of a request."""
+    # pylint: disable=unused-argument
+    async def on_dns_start(session, context, params):
+        context.dns_started = time.perf_counter()
+
+    async def on_dns_end(session, context, params):
+        trace = context.trace_request_ctx
+        if trace is not None:
+            elapsed = time.perf_counter() - context.dns_started
+            trace.add('dns', elapsed)
+            # the host is resolved while the connection is created
+            trace.add('connect', -elapsed)
+
+    async def on_connect_start(session, context, params):
+        context.connect_started = time.perf_counter()
+
+    async def on_connect_end(session, context, params):
+        trace = context.trace_request_ctx
+        if trace is not None:
+            trace.add('connect', time.perf_counter() - context.connect_started)
+
+    config = aiohttp.TraceConfig()
+    config.on_dns_resolvehost_start.append(on_dns_start)
+    config.on_dns_resolvehost_end.append(on_dns_end)
+    config.on_connection_create_start.append(on_connect_start)
+    config.on_connection_create_end.append(on_connect_end)
+    return config
+
+
+class HostLimiter:
+    """Limits concurrency and the request rate for a single host.
+
+    The requests are spaced by interval seconds, 1 / host_rps at first (0 means
+    no limit), and by the rate_limiter (a TokenBucket) if it is given. The time
+    slots are handed out in the order of the calls, so that waiting requests are
+    served first-come first-served.
+
+    The interval adapts to the responses (see done) as in HostScheduler: 429/503
+    double it (up to max_interval) and postpone the requests by Retry-After,
+    other responses shorten it back to the base one by 10%."""
+
+    def __init__(self, rate_limiter=None, concurrency=5, host_rps=0, max_interval=60):
+        self.rate_limiter = rate_limiter
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.base_interval = 1. / host_rps if host_rps > 0 else 0
+        self.interval = self.base_interval
+        self.max_interval = max_interval
+        self.next_time = 0.
+        # the requests waiting for the host or sent to it
+        self.requests = 0
+
+    def is_idle(self, now):
+        """Whether no request uses the host, its next slot is due and it is not slowed down."""
+        return not self.requests and self.next_time <= now and self.interval <= self.base_interval
+
+    @property
+    def limited(self):
+        """Whether the requests wait for time slots."""
+        return bool(self.rate_limiter) or self.interval > 0 or self.next_time > 0
+
+    async def wait(self):
+        """Wait for the next time slot of the host."""
+        now = time.monotonic()
+        start = max(self.next_time, now)
+        if self.next_time or self.interval:
+            self.next_time = start + self.interval
+        delay = start - now
+        if self.rate_limiter:
+            delay = max(delay, self.rate_limiter.reserve())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def done(self, status, retry_after=None):
+        """Adapt the interval to the status of a response."""
+        if status in HostScheduler.THROTTLING_STATUSES:
+            self.interval = min(max(self.interval * 2, 1.), self.max_interval)
+            if retry_after:
+                self.next_time = max(self.next_time, time.monotonic() + retry_after)
+        elif self.interval > self.base_interval:
+            self.interval = max(self.interval * 0.9, self.base_interval)
+            if self.interval < self.base_interval * 1.05:
+                self.interval = self.base_interval
+
+
+class AsyncFetcher:
+    """Fetch urls in a single event loop and parse them in a pool of processes.
+
+    parsers map a netloc to the parser of the netloc, the 'default' key is used
+    for all other hosts. The hosts having a specific parser are limited to
+    max_rps requests per second (or by rate limiters created by rate_limiter_factory
+    for a netloc), all other hosts to host_rps each. All hosts are limited to
+    host_concurrency simultaneous requests and slowed down on 429/503 responses
+    (see HostLimiter). At most max_concurrency urls are processed at once. The limiters
+    of the idle hosts without a specific parser are dropped, unless they are slowed down.
+
+    follow_up(url, error) decides whether to request an external job description
+    reported by a parsing error instead of reporting the error, see
+    TechsExtractionRunner.follow_up. The followed urls are requested in the same loop.
+
+    If on_trace is given, the stages of processing each url are timed and
+    on_trace is called with the finished Trace of every url in the loop.
+    The traces are labeled by the parser key and the parser class.
+
+    If profile_path is given, the parsing processes are profiled (see parsepool.init_worker).
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(self, parsers, terms_extractor, q_out, q_err, max_rps=3, host_rps=0,
+                 host_concurrency=5, max_concurrency=100, parse_workers=None,
+                 session_factory=None, rate_limiter_factory=None, cache=None, follow_up=None,
+                 on_trace=None, profile_path=None):
+        if aiohttp is None:
+            raise RuntimeError('aiohttp is required for the asyncio fetcher.')
+        self.parsers = parsers
+        self.q_out = q_out
+        self.q_err = q_err
+        self.max_rps = max_rps
+        self.host_rps = host_rps
+        self.host_concurrency = host_concurrency
+        self.max_concurrency = max_concurrency
+        self.session_factory = session_factory or SessionFactory()
+        self.cache = cache
+        self.follow_up = follow_up
+        self.on_trace = on_trace
+        self._tasks = set()
+        if rate_limiter_factory is None:
+            rate_limiter_factory = self._make_rate_limiter
+        self.rate_limiter_factory = rate_limiter_factory
+        self._limiters = {}
+        # (next_time, netloc) of the hosts which became idle, see _evict_limiters
+        self._idle = []
+        self._executor = parsepool.make_pool(
+            parsers, terms_extractor, parse_workers, profile_path)
+
+    @property
+    def in_flight(self):
+        """The number of urls being processed."""
+        return len(self._tasks)
+
+    def _make_rate_limiter(self, netloc):
+        # pylint: disable=unused-argument
+        return TokenBucket(self.max_rps) if self.max_rps > 0 else None
+
+    def _evict_limiters(self):
+        now = time.monotonic()
+        while self._idle and self._idle[0][0] <= now:
+            _, netloc = heapq.heappop(self._idle)
+            limiter = self._limiters.get(netloc)
+            if limiter is not None and limiter.is_idle(now):
+                del self._limiters[netloc]
+
+    def _release_limiter(self, netloc, limiter):
+        if not limiter.requests and netloc not in self.parsers:
+            heapq.heappush(self._idle, (limiter.next_time, netloc))
+
+    def _get_limiter(self, netloc):
+        self._evict_limiters()
+        limiter = self._limiters.get(netloc)
+        if limiter is None:
+            if netloc in self.parsers:
+                limiter = HostLimiter(self.rate_limiter_factory(netloc), self.host_concurrency)
+            else:
+                limiter = HostLimiter(None, self.host_concurrency, self.host_rps)
+            self._limiters[netloc] = limiter
+        return limiter
+
+    def _make_session(self):
+        connect_timeout, read_timeout = self.session_factory.timeout
+        return aiohttp.ClientSession(
+            headers=DEFAULT_HEADERS,
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+            connector=aiohttp.TCPConnector(
+                limit=self.max_concurrency, limit_per_host=self.host_concurrency),
+            trace_configs=[make_trace_config()] if self.on_trace else None)
+
+    async def _fetch(self, session, url, trace=None, limiter=None):
+        """Request the url retrying on connection errors and RETRY_STATUSES.
+
+        Returns the body of the page and its charset. If the response is cached,
+        the request is conditional. The request is timed into the trace, if given.
+        The statuses of the responses are reported to the limiter of the host, if given.
+        """
+        entry = self.cache.get(url) if self.cache else None
+        headers = entry.validators() if entry else None
+        retries = self.session_factory.retries
+        for attempt in range(retries + 1):
+            delay = self.session_factory.backoff_factor * (2 ** attempt)
+            if trace is not None:
+                started = time.perf_counter()
+                connect = trace.stages.get('dns', 0.) + trace.stages.get('connect', 0.)
+            try:
+                async with session.get(url, headers=headers, trace_request_ctx=trace) as res:
+                    if trace is not None:
+                        connect = (trace.stages.get('dns', 0.)
+                                   + trace.stages.get('connect', 0.) - connect)
+                        trace.add('ttfb', time.perf_counter() - started - connect)
+                    retry_after = parse_retry_after(res.headers.get('Retry-After'))
+                    if limiter is not None:
+                        limiter.done(res.status, retry_after)
+                    if entry is not None and res.status == 304:
+                        self.cache.touch(entry)
+                        return entry.body, get_charset(entry.headers)
+                    if res.status in RETRY_STATUSES and attempt < retries:
+                        if retry_after is not None:
+                            delay = retry_after
+                    else:
+                        error = http_error_message(res.status, res.reason, str(res.url))
+                        if error:
+                            raise RuntimeError(error)
+                        if trace is None:
+                            body = await res.read()
+                        else:
+                            started = time.perf_counter()
+                            body = await res.read()
+                            trace.add('download', time.perf_counter() - started)
+                            trace.bytes += len(body)
+                        if self.cache:
+                            self.cache.put(url, res.status, res.headers, body)
+                        return body, res.charset
+            except aiohttp.ClientConnectionError:
+                if attempt >= retries:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def _process_url(self, session, url):
+        """Request the url, parse its request and put into q_out.
+
+        Report an error to q_err otherwise.
+        """
+        # pylint: disable=broad-except
+        netloc = urlparse(url).netloc
+        parser_key = netloc if netloc in self.parsers else 'default'
+        limiter = self._get_limiter(netloc)
+        trace = None
+        if self.on_trace:
+            trace = Trace(url, parser_key, type(self.parsers[parser_key]).__name__)
+        outcome = 'failed'
+        try:
+            entry = self.cache.get_fresh(url) if self.cache else None
+            if entry is not None:
+                body, encoding = entry.body, get_charset(entry.headers)
+            else:
+                started = time.perf_counter()
+                limiter.requests += 1
+                try:
+                    async with limiter.semaphore:
+                        waited = time.perf_counter()
+                        limited = limiter.limited
+                        await limiter.wait()
+                        if trace is not None:
+                            trace.add('queue', waited - started)
+                            if limited:
+                                trace.add('throttle', time.perf_counter() - waited)
+                        body, encoding = await self._fetch(session, url, trace, limiter)
+                finally:
+                    limiter.requests -= 1
+                    self._release_limiter(netloc, limiter)
+            # the bytes are decoded by lxml in the parsing process
+            if trace is None:
+                result, error = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, parsepool.parse_page, parser_key, url, body, encoding)
+            else:
+                result, error, stages = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, parsepool.parse_page_timed, parser_key, url, body, encoding)
+                for stage, seconds in stages.items():
+                    trace.add(stage, seconds)
+            outcome = 'error' if error else 'ok' if entry is None else 'cached'
+            if error:
+                new_url = self.follow_up(url, error) if self.follow_up else None
+                if new_url:
+                    self._spawn(session, new_url)
+                elif new_url is None:
+                    G_LOG.error('parsing failed url=%s | %s', url, error)
+                    await self._put(self.q_err, (url, error))
+            else:
+                await self._put(self.q_out, result)
+        except aiohttp.ClientConnectionError:
+            G_LOG.error(
+                'requests.ConnectionError: Failed to establish a new connection to %s.', url)
+            await self._put(self.q_err, (url, CONNECTION_ERROR))
+        except Exception as err:
+            G_LOG.exception('Uncaught exception on processing url=%s | %s', url, str(err))
+            await self._put(self.q_err, (url, str(err)))
+        finally:
+            if trace is not None:
+                trace.outcome = outcome
+                self.on_trace(trace)
+
+    @staticmethod
+    async def _put(queue, item):
+        """Put the item into the queue, a full queue is waited for in a thread."""
+        try:
+            queue.put_nowait(item)
+        except Full:
+            await asyncio.get_running_loop().run_in_executor(None, queue.put, item)
+
+    def _spawn(self, session, url):
+        task = asyncio.ensure_future(self._process_url(session, url))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def fetch_all(self, urls):
+        """Process all the urls from an iterable, the iterable is consumed lazily."""
+        slots = asyncio.Semaphore(self.max_concurrency)
+        # the limiters are bound to the event loop
+        self._limiters = {}
+        self._idle = []
+        async with self._make_session() as session:
+            for url in urls:
+                await slots.acquire()
+                self._spawn(session, url).add_done_callback(lambda _: slots.release())
+            # the followed urls are spawned by the tasks
+            while self._tasks:
+                await asyncio.wait(set(self._tasks))
+
+    def run(self, urls):
+        """Process all the urls from an iterable in a new event loop."""
+        asyncio.run(self.fetch_all(urls))
+
+    def close(self):
+        """Shut down the parsing processes."""
+        self._executor.shutdown()
@@ -0,0 +1,174 @@
+"""The module implements an on-disk cache of HTTP responses.
+
+Each response is stored in two files named by hash_url of the normalized url:
+the body as is and a json with the url, the status, the headers and the time
+of fetching. The files are written atomically, so that several fetcher processes
+can share the cache directory.
+
+A response younger than ttl seconds is served without requests. An older one is
+revalidated with a conditional request (If-None-Match/If-Modified-Since), and
+a 304 response refreshes its time of fetching.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from jobtechs.parser import hash_url, normalize_url
+
+G_LOG = logging.getLogger(__name__)
+
+# the stored body is decoded, hence these headers are no longer valid
+SKIPPED_HEADERS = frozenset(('content-encoding', 'content-length', 'transfer-encoding',
+                             'connection', 'keep-alive', 'set-cookie'))
+
+
+class CacheEntry:
+    """A cached response: the url, the status, the headers, the body and the time of fetching."""
+
+    def __init__(self, url, status, headers, body, fetched_at):
+        # pylint: disable=too-many-arguments
+        self.url = url
+        self.status = status
+        self.headers = CaseInsensitiveDict(headers)
+        self.body = body
+        self.fetched_at = fetched_at
+
+    def is_fresh(self, ttl):
+        """Check whether the entry was fetched less than ttl seconds ago."""
+        return ttl is not None and time.time() - self.fetched_at < ttl
+
+    def validators(self):
+        """Return headers for a conditional request revalidating the entry."""
+        headers = {}
+        if 'ETag' in self.headers:
+            headers['If-None-Match'] = self.headers['ETag']
+        if 'Last-Modified' in self.headers:
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def to_response(self):
+        """Make a requests.Response from the entry."""
+        res = requests.Response()
+        res.url = self.url
+        res.status_code = self.status
+        res.headers = CaseInsensitiveDict(self.headers)
+        res.encoding = get_encoding_from_headers(res.headers)
+        res._content = self.body  # pylint: disable=protected-access
+        return res
+
+
+class ResponseCache:
+    """An on-disk cache of successful responses in the directory.
+
+    ttl is the number of seconds a response is served without revalidation,
+    None means a response is always revalidated. max_size limits the total size
+    of the cache in bytes, the oldest responses are evicted by prune().
+    """
+
+    def __init__(self, directory, ttl=None, max_size=None):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_size = max_size
+
+    def _paths(self, url):
+        key = hash_url(normalize_url(url))
+        subdir = self.directory.joinpath(key[:2])
+        return subdir.joinpath(key + '.json'), subdir.joinpath(key + '.body')
+
+    def _write(self, path, data):
+        path.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file_:
+            file_.write(data)
+        os.replace(tmp_path, str(path))
+
+    def get(self, url):
+        """Return the CacheEntry of the url or None if it is not cached."""
+        meta_path, body_path = self._paths(url)
+        try:
+            with meta_path.open() as file_:
+                meta = json.load(file_)
+            body = body_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+        return CacheEntry(meta['url'], meta['status'], meta['headers'], body, meta['fetched_at'])
+
+    def get_fresh(self, url):
+        """Return the CacheEntry of the url if it does not need revalidation, None otherwise."""
+        entry = self.get(url)
+        if entry is not None and entry.is_fresh(self.ttl):
+            return entry
+        return None
+
+    def is_fresh(self, url):
+        """Check whether the url is cached and does not need revalidation."""
+        if self.ttl is None:
+            return False
+        meta_path, _ = self._paths(url)
+        try:
+            return time.time() - meta_path.stat().st_mtime < self.ttl
+        except OSError:
+            return False
+
+    def put(self, url, status, headers, body):
+        """Store a response, only successful responses are cached."""
+        if status != 200:
+            return
+        meta_path, body_path = self._paths(url)
+        meta = {
+            'url': url,
+            'status': status,
+            'headers': {name: value for name, value in headers.items()
+                        if name.lower() not in SKIPPED_HEADERS},
+            'fetched_at': time.time(),
+        }
+        # the body goes first, so that the meta always references a complete body
+        self._write(body_path, body)
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def touch(self, entry):
+        """Mark the entry as revalidated now."""
+        entry.fetched_at = time.time()
+        meta_path, _ = self._paths(entry.url)
+        meta = {'url': entry.url, 'status': entry.status, 'headers': dict(entry.headers),
+                'fetched_at': entry.fetched_at}
+        self._write(meta_path, json.dumps(meta).encode('utf-8'))
+
+    def prune(self):
+        """Evict the oldest responses until the cache fits into max_size."""
+        if not self.max_size:
+            return
+        entries = []
+        total = 0
+        for meta_path in self.directory.glob('*/*.json'):
+            body_path = meta_path.with_suffix('.body')
+            try:
+                size = meta_path.stat().st_size + body_path.stat().st_size
+                mtime = meta_path.stat().st_mtime
+            except OSError:
+                continue
+            entries.append((mtime, size, meta_path, body_path))
+            total += size
+        entries.sort()
+        evicted = 0
+        for _, size, meta_path, body_path in entries:
+            if total <= self.max_size:
+                break
+            for path in (meta_path, body_path):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            total -= size
+            evicted += 1
+        if evicted:
+            G_LOG.info('evicted %d responses from the cache, %d bytes left', evicted, total)
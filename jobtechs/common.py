@@ -1,5 +1,9 @@
 """Common utility functions used in other modules."""
 from collections import OrderedDict
+from itertools import islice
+import re
+
+CHARSET_RE = re.compile(r'charset=["\']?\s*([-\w.:]+)', re.IGNORECASE)
 
 def parse_headers(text):
     """Parse a string of headers (copied from Firefox) into a dict used in requests."""
@@ -15,6 +19,13 @@ Connection: keep-alive
 Upgrade-Insecure-Requests: 1
 """)
 
+def get_charset(headers):
+    """Return the charset of the Content-Type header, None if it is not declared.
+
+    Unlike requests' Response.encoding, there is no ISO-8859-1 default for text types."""
+    match = CHARSET_RE.search(headers.get('Content-Type', ''))
+    return match.group(1) if match else None
+
 def dump_html(text, filename):
     """Helper to save text into a file."""
     with open(filename, 'w') as file_:
@@ -35,3 +46,21 @@ def skip_blanks(lines):
 def iter_good_lines(lines):
     """Iterate over rstripped lines with skipped empty and comment lines."""
     return skip_blanks(rstrip_lines(skip_comments(lines)))
+
+def get_qsize(queue):
+    """Return the approximate number of items in the queue.
+
+    Returns None if the platform does not implement it for multiprocessing queues (macOS)."""
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return None
+
+def iter_chunks(items, size):
+    """Split an iterable into lists of at most size items."""
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,96 @@
+"""The module implements memory-efficient sets of seen urls.
+
+A Bloom filter keeps a fixed number of bits per url regardless of the url length:
+about 29 bits (under 4 bytes) for the false positive rate of 1e-6. A false positive
+makes a new url look seen, its rate is bounded by error_rate, there are no false
+negatives. ScalableBloomFilter grows with the number of urls, so that their
+number needs not be known in advance.
+"""
+
+from hashlib import blake2b
+import math
+
+
+class BloomFilter:
+    """A Bloom filter for capacity strings with the false positive rate error_rate."""
+
+    def __init__(self, capacity, error_rate=1e-6):
+        if not 0 < error_rate < 1:
+            raise ValueError('error_rate should be between 0 and 1')
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, item):
+        # double hashing: the positions are h1 + i * h2
+        digest = blake2b(item.encode('utf-8'), digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little') | 1
+        num_bits = self.num_bits
+        return [(hash1 + i * hash2) % num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, item):
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+    def add(self, item):
+        """Add the item, return True if it was (probably) added before."""
+        bits = self._bits
+        seen = True
+        for pos in self._positions(item):
+            mask = 1 << (pos & 7)
+            if not bits[pos >> 3] & mask:
+                seen = False
+                bits[pos >> 3] |= mask
+        if not seen:
+            self.count += 1
+        return seen
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size(self):
+        """The size of the bit array in bytes."""
+        return len(self._bits)
+
+
+class ScalableBloomFilter:
+    """A Bloom filter growing with the number of items.
+
+    When a filter is full, a new one growth times larger is added. The false
+    positive rates of the filters decrease geometrically by tightening_ratio,
+    so that the total rate stays below error_rate."""
+
+    def __init__(self, initial_capacity=1 << 20, error_rate=1e-6, growth=4,
+                 tightening_ratio=0.5):
+        self.error_rate = error_rate
+        self.growth = growth
+        self.tightening_ratio = tightening_ratio
+        self.filters = [BloomFilter(initial_capacity, error_rate * (1 - tightening_ratio))]
+
+    def __contains__(self, item):
+        return any(item in filter_ for filter_ in self.filters)
+
+    def add(self, item):
+        """Add the item, return True if it was (probably) added before."""
+        if item in self:
+            return True
+        last = self.filters[-1]
+        if last.count >= last.capacity:
+            last = BloomFilter(last.capacity * self.growth,
+                               last.error_rate * self.tightening_ratio)
+            self.filters.append(last)
+        last.add(item)
+        return False
+
+    def __len__(self):
+        return sum(len(filter_) for filter_ in self.filters)
+
+    @property
+    def size(self):
+        """The size of the bit arrays in bytes."""
+        return sum(filter_.size for filter_ in self.filters)
@@ -0,0 +1,360 @@
+"""The module implements the shared work queue and the global rate limits of
+a distributed run: a coordinator serves them over TCP and workers on several
+hosts take urls from the queue and put the results back.
+
+The coordinator serves a WorkQueue and GlobalRateLimits by a multiprocessing
+manager (CoordinatorManager), the workers call them through proxies. Everything
+is pickled, hence the coordinator and the workers have to share an authentication
+key (see get_authkey) and the port should not be reachable from untrusted hosts.
+
+The urls are leased: a url taken by a worker is remembered until the worker
+puts its result or error. A worker which does not call the queue for
+lease_timeout seconds is considered lost and the urls leased by it are queued
+again, its later results are dropped. The urls are processed at least once.
+
+Every request of a worker waits for a time slot of its host reserved
+by the coordinator (see GlobalHostLimiter), so that the rate limits hold for
+the requests of all the workers together.
+"""
+
+from collections import deque
+import heapq
+import logging
+from multiprocessing.managers import BaseManager
+import os
+import socket
+import threading
+import time
+
+from jobtechs.parser import NETLOC_TO_PARSER_MAP
+
+G_LOG = logging.getLogger(__name__)
+
+# the environment variable with the key shared by the coordinator and the workers
+AUTHKEY_ENV = 'JOBTECHS_AUTHKEY'
+
+# the seconds to wait after accepting a connection failed
+ACCEPT_RETRY_DELAY = 1.
+
+
+def get_authkey():
+    """Return the authentication key from the JOBTECHS_AUTHKEY environment variable.
+
+    Raises RuntimeError if it is not set."""
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise RuntimeError('{} should be set to a secret shared by the coordinator and '
+                           'the workers.'.format(AUTHKEY_ENV))
+    return authkey.encode('utf-8')
+
+
+def parse_address(address):
+    """Convert a 'host:port' string into a (host, port) pair."""
+    host, _, port = address.rpartition(':')
+    return host, int(port)
+
+
+class WorkQueue:
+    """The queue of urls shared by the workers and the coordinator.
+
+    The coordinator puts urls, the workers take them (take) and report
+    their results (put_result) and errors (put_error), which are put into
+    q_out and q_err of the coordinator. If maxsize is positive, put blocks
+    while maxsize urls are queued.
+
+    info is a dict passed to the workers as is, e.g. the digest of the terms.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, q_out, q_err, maxsize=0, lease_timeout=60, info=None):
+        self.q_out = q_out
+        self.q_err = q_err
+        self.maxsize = maxsize
+        self.lease_timeout = lease_timeout
+        self._info = dict(info or {}, lease_timeout=lease_timeout)
+        self._urls = deque()
+        # the numbers of the urls leased by the workers, by worker
+        self._leases = {}
+        # the time of the last call by worker
+        self._seen = {}
+        self._finished = False
+        lock = threading.Lock()
+        self._not_empty = threading.Condition(lock)
+        self._not_full = threading.Condition(lock)
+
+    def info(self):
+        """Return the info of the coordinator with the lease_timeout."""
+        return self._info
+
+    def put(self, url):
+        """Add a url, waits for free room if maxsize urls are queued."""
+        with self._not_full:
+            if self.maxsize > 0:
+                self._not_full.wait_for(lambda: len(self._urls) < self.maxsize)
+            self._urls.append(url)
+            self._not_empty.notify()
+
+    def qsize(self):
+        """The number of urls waiting to be taken."""
+        return len(self._urls)
+
+    def _touch(self, worker):
+        self._seen[worker] = time.monotonic()
+        return self._leases.setdefault(worker, {})
+
+    def take(self, worker, timeout=1.):
+        """Lease the next url to the worker.
+
+        Returns None if there is no url within timeout seconds or the run is finished."""
+        with self._not_empty:
+            self._touch(worker)
+            if not self._not_empty.wait_for(lambda: self._urls or self._finished, timeout):
+                return None
+            if not self._urls:
+                return None
+            url = self._urls.popleft()
+            self._not_full.notify()
+            leases = self._touch(worker)
+            leases[url] = leases.get(url, 0) + 1
+            return url
+
+    def _release(self, worker, url):
+        leases = self._touch(worker)
+        count = leases.get(url)
+        if not count:
+            # the lease has expired, the url is processed again by another worker
+            return False
+        if count > 1:
+            leases[url] = count - 1
+        else:
+            del leases[url]
+        return True
+
+    def put_result(self, worker, result):
+        """Report the result of a url leased to the worker.
+
+        Returns False if the lease has expired and the result is dropped."""
+        with self._not_empty:
+            if not self._release(worker, result.url):
+                return False
+        self.q_out.put(result)
+        return True
+
+    def put_error(self, worker, url, error):
+        """Report the error of a url leased to the worker.
+
+        Returns False if the lease has expired and the error is dropped."""
+        with self._not_empty:
+            if not self._release(worker, url):
+                return False
+        self.q_err.put((url, error))
+        return True
+
+    def heartbeat(self, worker):
+        """Mark the worker alive."""
+        with self._not_empty:
+            self._touch(worker)
+
+    def leave(self, worker):
+        """Unregister the worker, the urls leased by it are queued again."""
+        with self._not_empty:
+            self._requeue(worker)
+
+    def _requeue(self, worker):
+        leases = self._leases.pop(worker, {})
+        self._seen.pop(worker, None)
+        urls = [url for url, count in leases.items() for _ in range(count)]
+        # the urls waited long enough
+        self._urls.extendleft(reversed(urls))
+        self._not_empty.notify(len(urls))
+        return len(urls)
+
+    def expire(self):
+        """Queue again the urls leased by the workers silent for lease_timeout seconds.
+
+        Returns the number of the urls queued again."""
+        deadline = time.monotonic() - self.lease_timeout
+        requeued = 0
+        with self._not_empty:
+            for worker, seen in list(self._seen.items()):
+                if seen < deadline:
+                    count = self._requeue(worker)
+                    G_LOG.warning('worker %s lost, %d urls queued again', worker, count)
+                    requeued += count
+        return requeued
+
+    def finish(self):
+        """Mark that no more urls are going to be added, the workers stop taking them."""
+        with self._not_empty:
+            self._finished = True
+            self._not_empty.notify_all()
+
+    def is_finished(self):
+        """Whether the run is finished."""
+        return self._finished
+
+    def workers(self):
+        """Return the number of the workers which have not left."""
+        with self._not_empty:
+            return len(self._seen)
+
+
+class GlobalRateLimits:
+    """Time slots of the requests of all the workers by host.
+
+    The aggregator hosts (see NETLOC_TO_PARSER_MAP) are limited to max_rps with
+    bursts of burst requests, all the other hosts to host_rps; 0 turns a limit off.
+    The slots are reserved by the virtual scheduling algorithm, as by TokenBucket.
+    The state of a host is dropped once its last reserved slot has passed.
+    """
+
+    def __init__(self, max_rps=3, burst=1, host_rps=3):
+        self.max_rps = max_rps
+        self.burst = max(burst, 1)
+        self.host_rps = host_rps
+        self._lock = threading.Lock()
+        # theoretical arrival times and the numbers of requests by host
+        self._tats = {}
+        self._counts = {}
+        # (theoretical arrival time, netloc) of the reservations, see _evict
+        self._expiring = []
+
+    def _limit(self, netloc):
+        if netloc in NETLOC_TO_PARSER_MAP:
+            return self.max_rps, self.burst
+        return self.host_rps, 1
+
+    def _evict(self, now):
+        while self._expiring and self._expiring[0][0] <= now:
+            _, netloc = heapq.heappop(self._expiring)
+            if self._tats.get(netloc, now) <= now:
+                # a past arrival time limits nothing
+                self._tats.pop(netloc, None)
+
+    def reserve(self, netloc):
+        """Reserve the next time slot of the host and return the seconds to wait for it."""
+        rate, burst = self._limit(netloc)
+        with self._lock:
+            self._counts[netloc] = self._counts.get(netloc, 0) + 1
+            if rate <= 0:
+                return 0.
+            interval = 1. / rate
+            now = time.monotonic()
+            self._evict(now)
+            tat = max(self._tats.get(netloc, 0.), now)
+            start = max(tat - (burst - 1) * interval, now)
+            self._tats[netloc] = tat + interval
+            heapq.heappush(self._expiring, (tat + interval, netloc))
+        return start - now
+
+    def counts(self):
+        """Return a dict from hosts to the numbers of the reserved slots."""
+        with self._lock:
+            return dict(self._counts)
+
+
+class GlobalHostLimiter:
+    """Waits for the time slots reserved by GlobalRateLimits of the coordinator
+    for the hosts (see ThrottledFetcher's host_limiter)."""
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, limits):
+        self.limits = limits
+
+    def acquire(self, netloc):
+        """Wait for the next time slot of the host."""
+        delay = self.limits.reserve(netloc)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class RemoteSink:
+    """A sink putting the results of a worker into the WorkQueue of the coordinator."""
+
+    def __init__(self, work, worker):
+        self.work = work
+        self.worker = worker
+        self.rows = 0
+        self.dropped = 0
+
+    def write(self, result):
+        """Send a result to the coordinator.
+
+        The result is dropped if its lease has expired or the coordinator is gone."""
+        try:
+            sent = self.work.put_result(self.worker, result)
+        except (EOFError, ConnectionError):
+            G_LOG.error('the coordinator is gone, result of %s dropped', result.url)
+            sent = False
+        if sent:
+            self.rows += 1
+        else:
+            self.dropped += 1
+
+    def close(self):
+        """The results are sent as they come, there is nothing to flush."""
+
+
+class CoordinatorManager(BaseManager):
+    """The manager of the WorkQueue (get_work) and the GlobalRateLimits (get_limits)
+    of a coordinator, the workers connect with it (see connect)."""
+
+
+CoordinatorManager.register('get_work')
+CoordinatorManager.register('get_limits')
+
+
+def _accept(server):
+    # Server.accepter, which serve_forever runs, accepts until the process exits,
+    # and serve_forever resets sys.stdout when it stops
+    while True:
+        try:
+            conn = server.listener.accept()
+        except OSError as err:
+            if server.stop_event.is_set():
+                break
+            # e.g. out of file descriptors, waiting lets the connections close
+            G_LOG.error('accepting a connection failed | %s', err)
+            time.sleep(ACCEPT_RETRY_DELAY)
+            continue
+        if server.stop_event.is_set():
+            conn.close()
+            break
+        threading.Thread(target=server.handle_request, args=(conn,), daemon=True).start()
+
+
+def serve(work, limits, address, authkey):
+    """Serve the work queue and the limits at the (host, port) address in a thread.
+
+    Returns the server, its address is the bound one and its accept_thread accepts
+    the connections until stop_serving."""
+    class ServingManager(CoordinatorManager):
+        # pylint: disable=missing-docstring
+        pass
+
+    # the registry of the subclass is its own copy
+    ServingManager.register('get_work', callable=lambda: work)
+    ServingManager.register('get_limits', callable=lambda: limits)
+    server = ServingManager(address=address, authkey=authkey).get_server()
+    server.stop_event = threading.Event()
+    server.accept_thread = threading.Thread(target=_accept, args=(server,), daemon=True)
+    server.accept_thread.start()
+    return server
+
+
+def stop_serving(server):
+    """Stop accepting the connections of the workers."""
+    server.stop_event.set()
+    host, port = server.address
+    # wakes up the accepting thread
+    socket.create_connection((host if host not in ('', '0.0.0.0') else '127.0.0.1', port)).close()
+    server.listener.close()
+
+
+def connect(address, authkey):
+    """Connect to a coordinator at the (host, port) address.
+
+    Returns proxies of its WorkQueue and GlobalRateLimits."""
+    manager = CoordinatorManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.get_work(), manager.get_limits()
@@ -5,32 +5,183 @@ results to the output queue and the error queue, which are shared among several
 fetchers. The processing of the pages is performed in several threads
 by ThreadExecutor. The executor's map method allows processing the input queue
 while it is filled by other processes.
+
+Each thread keeps its own requests.Session created by a SessionFactory, so that
+connections to the same host are kept alive between the requests.
+
+If a metrics queue is given, the stages of processing each url are timed
+(see jobtechs.metrics) and the metrics are sent to the queue every second.
 """
 
 import concurrent.futures
+from collections import defaultdict, deque
 import logging
 import multiprocessing as mp
-import random
+import os
 import threading
 import time
+import weakref
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
 
-from jobtechs.common import DEFAULT_HEADERS
+from jobtechs.common import DEFAULT_HEADERS, get_charset
+from jobtechs.metrics import (
+    Metrics, MetricsReporter, current_trace, end_trace, start_trace, timed)
+from jobtechs.profiler import StackSampler
+from jobtechs.throttle import HostScheduler, TokenBucket, parse_retry_after
 
 G_LOG = logging.getLogger(__name__)
 
+
+class TimedHTTPConnection(HTTPConnection):
+    """A connection timing its establishing as the connect stage of the current trace."""
+
+    def connect(self):
+        with timed('connect'):
+            super().connect()
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """A connection timing its establishing, including the TLS handshake,
+    as the connect stage of the current trace."""
+
+    def connect(self):
+        with timed('connect'):
+            super().connect()
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    # pylint: disable=missing-docstring
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    # pylint: disable=missing-docstring
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """An adapter whose connections are timed (see TimedHTTPConnection)."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        # pylint: disable=arguments-differ
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+class SessionFactory:
+    """A configuration of HTTP sessions used by fetchers.
+
+    pool_connections is the number of hosts the connections are kept alive for,
+    pool_maxsize is the number of connections kept alive for each host.
+    retries is the number of retries on connection errors and 429/5xx responses
+    with exponential backoff (backoff_factor) respecting Retry-After.
+    """
+    # pylint: disable=too-many-arguments,too-few-public-methods
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, connect_timeout=10,
+                 read_timeout=30, retries=2, backoff_factor=0.5):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+
+    def make_session(self):
+        """Create a new session with the default headers and a pooled adapter."""
+        session = requests.Session()
+        session.headers.update(DEFAULT_HEADERS)
+        retry = Retry(
+            total=self.retries, backoff_factor=self.backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            # the last response is returned, raise_for_status reports it
+            raise_on_status=False)
+        adapter = TimedHTTPAdapter(
+            pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+            max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+
+def iter_pools(session):
+    """Iterate over urllib3 connection pools currently kept by the session adapters."""
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                yield pool
+
+def get_throttling(res):
+    """Return the status and the Retry-After delay of the response.
+
+    If the response or any of the responses retried by urllib3 asked to slow down,
+    the status of the latter is returned."""
+    status = res.status_code
+    retries = getattr(res.raw, 'retries', None)
+    for item in getattr(retries, 'history', ()):
+        if item.status in HostScheduler.THROTTLING_STATUSES:
+            status = item.status
+    return status, parse_retry_after(res.headers.get('Retry-After'))
+
+
 class ThrottledFetcher(mp.Process):
     """The class represents a fetcher which can be configured to limit its rps rate.
 
     It is a demonic process, so that the main process would not wait for it after it exits.
     Some processes should populate its q_in and then the main process should join its q_in.
     A None value in q_in marks the end of the processing.
-    It is assumed that the fetcher is the only consumer of its q_in."""
+    It is assumed that the fetcher is the only consumer of its q_in.
+
+    The numbers of requests sent and new connections opened by the fetcher
+    are counted in requests_sent and connections_new shared values.
+
+    The requests are throttled by rate_limiter (a TokenBucket), which may be shared
+    with other fetchers requesting the same host. If it is not given, the fetcher
+    creates its own one for max_rps (if positive). If host_limiter is given,
+    every request waits as well for host_limiter.acquire(netloc) of its host
+    (e.g. the global limits of a distributed run, see GlobalHostLimiter).
+
+    If a HostScheduler is given, the urls from q_in are distributed among
+    max_workers threads by the scheduler, which adapts the load on each host
+    to its responses.
+
+    If a ResponseCache is given, fresh cached responses are served without
+    requests and throttling, stale ones are revalidated with conditional requests.
+
+    If queue_size is positive, q_in holds at most queue_size urls and putting
+    more blocks until the fetcher takes them. The fetcher takes a url from q_in
+    only when a thread (or the scheduler, which should be bounded by its max_queued)
+    has room for it, so that a slow fetcher slows down its producers.
+
+    If q_metrics is given, the fetcher times the stages of processing each url
+    and puts its metrics into q_metrics every second, along with the rows of
+    the timings of every url if trace_urls is True (see MetricsReporter).
+    The metrics are labeled by the netloc of the parser ('default' for a generic
+    one) and the parser class.
+
+    If q_pages is given, the fetcher only requests the pages and puts them into
+    q_pages for ParseWorker processes, which parse them and put the results and
+    the errors into q_out and q_err. Otherwise the pages are parsed by the threads
+    requesting them. The parsers of the workers are looked up by parser_key.
+
+    If profile_path is given, the threads of the fetcher are sampled by
+    a StackSampler and the samples are saved to a part file of the profile
+    at profile_path when the fetcher stops (see merge_profiles)."""
     # pylint: disable=too-many-instance-attributes,too-many-arguments
 
     def __init__(self, parser, terms_extractor, q_out=None, q_err=None,
-                 name=None, max_workers=None, max_rps=3):
+                 name=None, max_workers=None, max_rps=3, session_factory=None,
+                 rate_limiter=None, scheduler=None, cache=None, queue_size=0,
+                 q_metrics=None, trace_urls=False, profile_path=None, q_pages=None,
+                 host_limiter=None):
         super().__init__(name=None)
         if not q_out:
             q_out = mp.Queue()
@@ -39,24 +190,122 @@ class ThrottledFetcher(mp.Process):
         self.daemon = True
         self.parser = parser
         self.terms_extractor = terms_extractor
-        self.q_in = mp.JoinableQueue()
+        self.q_in = mp.JoinableQueue(queue_size)
         self.q_out = q_out
         self.q_err = q_err
         self.max_workers = max_workers
-        self._last_call = 0
-        self._last_call_lock = threading.Lock()
-        self.min_period = 1./max_rps if max_rps > 0 else 0
+        if rate_limiter is None and max_rps > 0:
+            rate_limiter = TokenBucket(max_rps)
+        self.rate_limiter = rate_limiter
+        self.host_limiter = host_limiter
+        self.scheduler = scheduler
+        self.cache = cache
+        self.session_factory = session_factory or SessionFactory()
+        self.requests_sent = mp.Value('L', 0)
+        self.connections_new = mp.Value('L', 0)
+        self.q_metrics = q_metrics
+        self.trace_urls = trace_urls
+        self.profile_path = profile_path
+        self.q_pages = q_pages
+        self._reporter = None
+        # whether the None stopping the processing was taken from q_in
+        self._stop_received = False
+        # the times the urls were taken from q_in at, by url
+        self._received = defaultdict(deque)
+        self._received_lock = threading.Lock()
+        # thread local sessions are created in the fetcher process
+        self._local = None
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    @property
+    def parser_key(self):
+        """The key of the parser: the netloc of an aggregator parser or 'default'."""
+        return getattr(self.parser, 'netloc', None) or 'default'
+
+    @property
+    def connections_reused(self):
+        """The number of requests sent over an already established connection."""
+        return self.requests_sent.value - self.connections_new.value
+
+    def _get_session(self):
+        """Return the session of the current thread."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.session_factory.make_session()
+            # pool -> (num_connections, num_requests) at the last check
+            self._local.pool_counters = weakref.WeakKeyDictionary()
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def _count_connections(self, session):
+        """Add connections opened and requests sent since the last check to the counters."""
+        pool_counters = self._local.pool_counters
+        connections_new = requests_sent = 0
+        for pool in iter_pools(session):
+            num_connections, num_requests = pool_counters.get(pool, (0, 0))
+            connections_new += pool.num_connections - num_connections
+            requests_sent += pool.num_requests - num_requests
+            pool_counters[pool] = pool.num_connections, pool.num_requests
+        with self.requests_sent.get_lock():
+            self.requests_sent.value += requests_sent
+        with self.connections_new.get_lock():
+            self.connections_new.value += connections_new
+
+    def _fetch(self, url):
+        """Request the url with the session of the current thread.
+
+        If the response is cached, the request is conditional."""
+        session = self._get_session()
+        entry = self.cache.get(url) if self.cache else None
+        trace = current_trace()
+        connect = trace.stages.get('connect', 0.) if trace else 0.
+        started = time.perf_counter()
+        try:
+            # the body is read separately to tell the time to the first byte
+            res = session.get(url, headers=entry and entry.validators(),
+                              timeout=self.session_factory.timeout, stream=True)
+            if trace is not None:
+                connect = trace.stages.get('connect', 0.) - connect
+                trace.add('ttfb', time.perf_counter() - started - connect)
+            with timed('download'):
+                content = res.content
+        finally:
+            self._count_connections(session)
+        if trace is not None:
+            trace.bytes += len(content)
+        if self.cache:
+            if entry is not None and res.status_code == 304:
+                self.cache.touch(entry)
+                return entry.to_response()
+            self.cache.put(url, res.status_code, res.headers, content)
+        return res
 
     def _iter_q_in(self):
         # it is assumed that the fetcher is the only consumer of the q_in
-        # None value stops processing
+        # None value stops processing, it is marked done by run
         while True:
             url = self.q_in.get()
             if url is None:
-                self.q_in.task_done()
+                self._stop_received = True
                 break
+            if self._reporter is not None:
+                with self._received_lock:
+                    self._received[url].append(time.perf_counter())
             yield url
 
+    def _start_trace(self, url):
+        """Start the trace of the url with the time it waited since it was taken from q_in."""
+        trace = start_trace(url, self.parser_key, type(self.parser).__name__)
+        with self._received_lock:
+            received = self._received.get(url)
+            if received:
+                trace.add('queue', time.perf_counter() - received.popleft())
+                if not received:
+                    del self._received[url]
+        return trace
+
     def _process_url(self, url):
         """Request the url, parse its request and put into q_out.
 
@@ -64,26 +313,44 @@ class ThrottledFetcher(mp.Process):
         """
         # pylint: disable=broad-except
 
-        if self.min_period:
-            while True:
-                cur_time = time.time()
-                with self._last_call_lock:
-                    next_call = self._last_call + self.min_period
-                    diff = cur_time - next_call
-                    if diff >= 0:
-                        self._last_call = cur_time
-                        break
-                # add some additional timeout, so that several threads
-                # would not wake up simultaneously
-                time.sleep(-diff + random.random() * self.min_period * 2)
+        latency = status = retry_after = None
+        outcome = 'failed'
+        trace = self._start_trace(url) if self._reporter is not None else None
         try:
-            res = requests.get(url, headers=DEFAULT_HEADERS)
+            entry = self.cache.get_fresh(url) if self.cache else None
+            if entry is not None:
+                res = entry.to_response()
+            else:
+                if self.rate_limiter or self.host_limiter:
+                    with timed('throttle'):
+                        if self.rate_limiter:
+                            self.rate_limiter.acquire()
+                        if self.host_limiter:
+                            self.host_limiter.acquire(urlparse(url).netloc)
+                started = time.monotonic()
+                res = self._fetch(url)
+                latency = time.monotonic() - started
+                status, retry_after = get_throttling(res)
             res.raise_for_status()
-            result, error = self.parser.parse_page(url, res.text, self.terms_extractor)
+            fetched = 'ok' if entry is None else 'cached'
+            if self.q_pages is not None:
+                if trace is not None:
+                    # the trace is finished by the parsing process
+                    end_trace()
+                    trace.outcome = fetched
+                self.q_pages.put((self.parser_key, url, res.content, get_charset(res.headers),
+                                  trace, time.time()))
+                trace = None
+                return True
+            # the page is decoded by lxml, requests does not sniff the charset
+            result, error = self.parser.parse_page(
+                url, res.content, self.terms_extractor, get_charset(res.headers))
             if error:
                 G_LOG.error('parsing failed url=%s | %s', url, error)
+                outcome = 'error'
                 self.q_err.put((url, error))
             else:
+                outcome = fetched
                 self.q_out.put(result)
 
         # we should probably gracefully shutdown: for that we need to pass a message
@@ -98,16 +365,71 @@ class ThrottledFetcher(mp.Process):
             G_LOG.exception('Uncaught exception on processing url=%s | %s', url, str(err))
             self.q_err.put((url, str(err)))
         finally:
+            if self.scheduler:
+                self.scheduler.done(url, latency, status, retry_after)
+            if trace is not None:
+                trace.outcome = outcome
+                self._reporter.add_trace(end_trace())
             self.q_in.task_done()
         return True
 
+    def _process_scheduled(self):
+        """Process urls given by the scheduler until it is closed and empty."""
+        while True:
+            url = self.scheduler.get()
+            if url is None:
+                break
+            self._process_url(url)
+
     def run(self):
         """The method starts max_workers threads and starts processing urls from the q_in.
 
         Thre results are put into q_out, the url requesting or parsing of which
         resulted in an error are put into q_err.
         """
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-            results = executor.map(self._process_url, self._iter_q_in())
-            for _ in results:
-                pass
+        self._local = threading.local()
+        sampler = None
+        if self.profile_path:
+            sampler = StackSampler('fetcher ' + self.parser_key)
+            sampler.start()
+        if self.q_metrics is not None:
+            self._reporter = MetricsReporter(Metrics(), self.q_metrics, traces=self.trace_urls)
+            self._reporter.start()
+        try:
+            self._run()
+        finally:
+            if self._reporter is not None:
+                self._reporter.stop()
+                # the metrics reach the queue before the end of processing is reported
+                self.q_metrics.close()
+                self.q_metrics.join_thread()
+            if sampler is not None:
+                sampler.stop()
+                sampler.save(self.profile_path)
+            # the None stopping the processing, it is done when all the urls are
+            if self._stop_received:
+                self.q_in.task_done()
+
+    def _run(self):
+        if self.scheduler is None:
+            # the default of ThreadPoolExecutor
+            max_workers = self.max_workers or min(32, (os.cpu_count() or 1) + 4)
+            # executor.map would take all the urls at once, a url is submitted
+            # only when a thread is about to be free
+            slots = threading.BoundedSemaphore(2 * max_workers)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for url in self._iter_q_in():
+                    slots.acquire()
+                    executor.submit(self._process_url, url).add_done_callback(
+                        lambda _: slots.release())
+        else:
+            max_workers = self.max_workers or self.scheduler.max_concurrency
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for _ in range(max_workers):
+                    executor.submit(self._process_scheduled)
+                for url in self._iter_q_in():
+                    # fresh cached pages are not requested, hence not paced
+                    self.scheduler.put(url, paced=not (self.cache and self.cache.is_fresh(url)))
+                self.scheduler.close()
+        for session in self._sessions:
+            session.close()
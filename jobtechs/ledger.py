@@ -0,0 +1,154 @@
+"""The module implements a persistent ledger of the processed urls.
+
+The ledger is an SQLite database keeping the state of every url by hash_url
+of the normalized url: queued when the url is sent to a fetcher, parsed when
+its result is written, failed along with the error message or followed
+when the page embeds an external job description requested instead.
+A followed url keeps the key of the job description in the target column.
+A run with the same ledger skips the parsed urls and the followed ones whose
+job description is parsed, so that an interrupted run is resumed and
+the failed urls are retried.
+
+Updates are buffered and written by batches. The ledger is used only by
+the main process, the fetchers report the outcomes through the result queues.
+"""
+
+import sqlite3
+import threading
+import time
+
+from jobtechs.common import iter_chunks
+from jobtechs.parser import hash_url, normalize_url
+
+QUEUED, PARSED, FAILED, FOLLOWED = 'queued', 'parsed', 'failed', 'followed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS urls (
+    key TEXT PRIMARY KEY,
+    url TEXT NOT NULL,
+    state TEXT NOT NULL,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    target TEXT
+)
+'''
+
+UPSERT = '''
+INSERT INTO urls (key, url, state, error, attempts, updated_at, target)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(key) DO UPDATE SET
+    state = excluded.state, error = excluded.error,
+    attempts = attempts + excluded.attempts, updated_at = excluded.updated_at,
+    target = excluded.target
+'''
+
+# the finished urls: parsed or followed to a parsed job description
+SELECT_FINISHED = '''
+SELECT key FROM urls WHERE key IN ({}) AND (
+    state = ? OR state = ? AND target IN (SELECT key FROM urls WHERE state = ?))
+'''
+
+
+def url_key(url):
+    """Return the key of the url in the ledger."""
+    return hash_url(normalize_url(url))
+
+
+class Ledger:
+    """A ledger of url states in the SQLite database at the path.
+
+    The buffered updates are written when there are batch_size of them
+    or flush_interval seconds passed since the last write."""
+
+    def __init__(self, path, batch_size=1000, flush_interval=5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(SCHEMA)
+        # the ledgers of earlier versions have no target column
+        if 'target' not in {row[1] for row in self._conn.execute('PRAGMA table_info(urls)')}:
+            self._conn.execute('ALTER TABLE urls ADD COLUMN target TEXT')
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._flushed_at = time.monotonic()
+        self.skipped = 0
+
+    def _add(self, url, state, error=None, target=None):
+        with self._lock:
+            self._pending.append((url_key(url), url, state, error, int(state == QUEUED),
+                                  time.time(), target))
+            if (len(self._pending) >= self.batch_size
+                    or time.monotonic() - self._flushed_at >= self.flush_interval):
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            with self._conn:
+                self._conn.executemany(UPSERT, self._pending)
+            self._pending = []
+        self._flushed_at = time.monotonic()
+
+    def flush(self):
+        """Write the buffered updates."""
+        with self._lock:
+            self._flush()
+
+    def mark_parsed(self, url):
+        """Record that the result of the url is written."""
+        self._add(url, PARSED)
+
+    def mark_failed(self, url, error):
+        """Record that requesting or parsing of the url failed with the error."""
+        self._add(url, FAILED, error)
+
+    def mark_followed(self, url, target_url):
+        """Record that the external job description found on the page of the url is requested.
+
+        target_url is the url of the job description."""
+        self._add(url, FOLLOWED, target=url_key(target_url))
+
+    def get_state(self, url):
+        """Return the state of the url and its error, (None, None) if the url is unknown.
+
+        The buffered updates are looked up without writing them."""
+        key = url_key(url)
+        with self._lock:
+            for row in reversed(self._pending):
+                if row[0] == key:
+                    return row[2], row[3]
+            row = self._conn.execute(
+                'SELECT state, error FROM urls WHERE key = ?', (key,)).fetchone()
+        return row if row else (None, None)
+
+    def iter_unfinished(self, urls, chunk_size=500):
+        """Iterate over the unfinished urls marking them as queued.
+
+        The urls parsed and the urls followed to a parsed job description are skipped.
+        The urls are checked by chunks of chunk_size."""
+        for chunk in iter_chunks(urls, chunk_size):
+            keys = [url_key(url) for url in chunk]
+            with self._lock:
+                finished = {key for key, in self._conn.execute(
+                    SELECT_FINISHED.format(','.join('?' * len(keys))),
+                    keys + [PARSED, FOLLOWED, PARSED])}
+            for url, key in zip(chunk, keys):
+                if key in finished:
+                    self.skipped += 1
+                    continue
+                self._add(url, QUEUED)
+                yield url
+
+    def counts(self):
+        """Return a dict from states to the numbers of urls."""
+        self.flush()
+        with self._lock:
+            return dict(self._conn.execute('SELECT state, count(*) FROM urls GROUP BY state'))
+
+    def close(self):
+        """Write the buffered updates and close the database."""
+        self.flush()
+        self._conn.close()
@@ -0,0 +1,315 @@
+"""The module collects per-stage timings and counters of the url processing.
+
+The code processing a url starts a Trace in its thread (start_trace) and the
+stages it goes through are timed into it (timed, Trace.add). Outside of a trace
+timing costs a thread-local lookup.
+
+The stages (STAGES):
+
+- queue: waiting in the fetcher for a worker thread and the host schedule;
+- throttle: waiting for the rate limiter of the aggregator;
+- dns, connect: resolving the host and opening a connection (the threaded
+  fetchers do not tell them apart and report both, with TLS, as connect);
+- ttfb: from sending the request to the response headers (without connect);
+- download: reading the response body;
+- pages: waiting for a parsing process (see parsepool.ParseWorker);
+- parse: parsing the html (the streamed body text is parsed as it is matched);
+- describe: extracting the company, the site and the description from the tree;
+- match: finding the terms in the description;
+- write: writing a result to the sink (in the main process).
+
+A finished trace is recorded into Metrics: a histogram of each stage and
+counters of urls and bytes by the fetcher (an aggregator netloc or 'default')
+and the parser class. Each fetcher process keeps its own Metrics and sends
+the increments (see MetricsReporter) to the main process, which merges them
+and writes them in the Prometheus text format (see Metrics.to_prometheus).
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+
+G_LOG = logging.getLogger(__name__)
+
+STAGES = ('queue', 'throttle', 'dns', 'connect', 'ttfb', 'download', 'pages', 'parse',
+          'describe', 'match', 'write')
+
+# the upper bounds of the histogram buckets in seconds, the last one is +Inf
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5., 10., 30.)
+
+_LOCAL = threading.local()
+
+# the end of the items of iter_timed
+_END = object()
+
+
+class Trace:
+    """Stage timings of processing a single url."""
+    __slots__ = ('url', 'fetcher', 'parser', 'stages', 'bytes', 'outcome')
+
+    def __init__(self, url, fetcher='', parser=''):
+        self.url = url
+        self.fetcher = fetcher
+        self.parser = parser
+        self.stages = {}
+        self.bytes = 0
+        self.outcome = ''
+
+    def add(self, stage, seconds):
+        """Add seconds to the time of the stage."""
+        self.stages[stage] = self.stages.get(stage, 0.) + seconds
+
+    def to_row(self):
+        """Return the trace as a row of a timings file (see TIMINGS_HEADER)."""
+        return [self.url, self.fetcher, self.parser, self.outcome, str(self.bytes)] + [
+            '{:.6f}'.format(self.stages[stage]) if stage in self.stages else ''
+            for stage in STAGES]
+
+
+TIMINGS_HEADER = ['url', 'fetcher', 'parser', 'outcome', 'bytes'] + list(STAGES)
+
+
+def start_trace(url, fetcher='', parser=''):
+    """Start a trace of the url in the current thread and return it."""
+    trace = _LOCAL.trace = Trace(url, fetcher, parser)
+    return trace
+
+
+def resume_trace(trace):
+    """Continue the trace started in another thread or process in the current thread."""
+    _LOCAL.trace = trace
+    return trace
+
+
+def end_trace():
+    """Finish the trace of the current thread and return it, None if there is none."""
+    trace = getattr(_LOCAL, 'trace', None)
+    _LOCAL.trace = None
+    return trace
+
+
+def current_trace():
+    """Return the trace of the current thread, None if there is none."""
+    return getattr(_LOCAL, 'trace', None)
+
+
+@contextmanager
+def timed(stage):
+    """Time the block as the stage of the trace of the current thread, if any."""
+    trace = getattr(_LOCAL, 'trace', None)
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(stage, time.perf_counter() - started)
+
+
+def iter_timed(items, stage, within=None):
+    """Iterate over items timing the producing of each of them as the stage.
+
+    It is used for lazily produced items, e.g. chunks of a streamed text.
+    The items are usually consumed by a block timed as another stage, the time
+    of producing them is not counted to the within stage then."""
+    trace = getattr(_LOCAL, 'trace', None)
+    if trace is None:
+        yield from items
+        return
+    items = iter(items)
+    while True:
+        started = time.perf_counter()
+        item = next(items, _END)
+        elapsed = time.perf_counter() - started
+        trace.add(stage, elapsed)
+        if within:
+            trace.add(within, -elapsed)
+        if item is _END:
+            return
+        yield item
+
+
+# the label values of the timings of a stage
+StageKey = namedtuple('StageKey', 'stage fetcher parser')
+# the label values of the counters of urls
+UrlsKey = namedtuple('UrlsKey', 'fetcher parser outcome')
+
+
+class Metrics:
+    """Stage histograms and counters of urls and bytes fetched, thread-safe.
+
+    Histograms map a StageKey to a list of the bucket counts (BUCKETS and +Inf),
+    the number of observations and their sum."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.urls = {}
+        self.bytes = {}
+
+    def _observe(self, key, seconds):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(BUCKETS) + 3)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[i] += 1
+                break
+        else:
+            histogram[len(BUCKETS)] += 1
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+    def observe(self, stage, seconds, fetcher='', parser=''):
+        """Add a time of the stage."""
+        with self._lock:
+            self._observe(StageKey(stage, fetcher, parser), seconds)
+
+    def record(self, trace):
+        """Add the stage timings, the url and the bytes fetched of a finished trace."""
+        with self._lock:
+            for stage, seconds in trace.stages.items():
+                self._observe(StageKey(stage, trace.fetcher, trace.parser), seconds)
+            key = UrlsKey(trace.fetcher, trace.parser, trace.outcome)
+            self.urls[key] = self.urls.get(key, 0) + 1
+            if trace.bytes:
+                self.bytes[trace.fetcher] = self.bytes.get(trace.fetcher, 0) + trace.bytes
+
+    def take(self):
+        """Return the collected metrics as a picklable dict and reset them."""
+        with self._lock:
+            state = {'histograms': self.histograms, 'urls': self.urls, 'bytes': self.bytes}
+            self.histograms, self.urls, self.bytes = {}, {}, {}
+        return state
+
+    def merge(self, state):
+        """Add the metrics taken from other Metrics (see take)."""
+        with self._lock:
+            for key, histogram in state['histograms'].items():
+                total = self.histograms.get(key)
+                if total is None:
+                    self.histograms[key] = list(histogram)
+                else:
+                    for i, value in enumerate(histogram):
+                        total[i] += value
+            for name in ('urls', 'bytes'):
+                totals = getattr(self, name)
+                for key, value in state[name].items():
+                    totals[key] = totals.get(key, 0) + value
+
+    def stage_totals(self):
+        """Return a dict from stages to the (number, seconds) of their timings."""
+        totals = {}
+        with self._lock:
+            for key, histogram in self.histograms.items():
+                count, seconds = totals.get(key.stage, (0, 0.))
+                totals[key.stage] = count + histogram[-2], seconds + histogram[-1]
+        return {stage: totals[stage] for stage in STAGES if stage in totals}
+
+    def summary(self):
+        """Return a line of the mean times of the stages, the urls and the bytes fetched."""
+        stages = ', '.join('{} {:.1f}ms'.format(stage, seconds / count * 1000)
+                           for stage, (count, seconds) in self.stage_totals().items())
+        with self._lock:
+            urls = sum(self.urls.values())
+            fetched = sum(self.bytes.values())
+        return '{} urls, {:.1f} MB fetched, mean stage times: {}'.format(
+            urls, fetched / 1e6, stages or '-')
+
+    def to_prometheus(self, gauges=None):
+        """Return the metrics in the Prometheus text exposition format.
+
+        gauges is a dict from queue names to their depths (see queue_depths)."""
+        lines = [
+            '# HELP jobtechs_stage_seconds Time spent by urls in the processing stages.',
+            '# TYPE jobtechs_stage_seconds histogram',
+        ]
+        with self._lock:
+            for key in sorted(self.histograms):
+                histogram = self.histograms[key]
+                labels = 'stage="{}",fetcher="{}",parser="{}"'.format(*key)
+                count = 0
+                for bound, value in zip(BUCKETS + ('+Inf',), histogram):
+                    count += value
+                    lines.append('jobtechs_stage_seconds_bucket{{{},le="{}"}} {}'.format(
+                        labels, bound, count))
+                lines.append('jobtechs_stage_seconds_sum{{{}}} {:.6f}'.format(
+                    labels, histogram[-1]))
+                lines.append('jobtechs_stage_seconds_count{{{}}} {}'.format(
+                    labels, histogram[-2]))
+            lines += ['# HELP jobtechs_urls_total Processed urls by the outcome.',
+                      '# TYPE jobtechs_urls_total counter']
+            lines += ['jobtechs_urls_total{{fetcher="{}",parser="{}",outcome="{}"}} {}'.format(
+                *key, value) for key, value in sorted(self.urls.items())]
+            lines += ['# HELP jobtechs_fetched_bytes_total Bytes of the fetched pages.',
+                      '# TYPE jobtechs_fetched_bytes_total counter']
+            lines += ['jobtechs_fetched_bytes_total{{fetcher="{}"}} {}'.format(key, value)
+                      for key, value in sorted(self.bytes.items())]
+        if gauges:
+            lines += ['# HELP jobtechs_queue_depth Items in the queues between the stages.',
+                      '# TYPE jobtechs_queue_depth gauge']
+            lines += ['jobtechs_queue_depth{{queue="{}"}} {}'.format(name, depth)
+                      for name, depth in sorted(gauges.items()) if depth is not None]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, gauges=None):
+        """Write the metrics to the file at the path atomically, e.g. for the textfile
+        collector of the node exporter."""
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as file_:
+            file_.write(self.to_prometheus(gauges))
+        os.replace(tmp_path, path)
+
+
+class MetricsReporter:
+    """Sends the metrics of a fetcher process to the main process every interval seconds.
+
+    The metrics taken from metrics (see Metrics.take) are put into the queue
+    with the finished traces, if traces are collected (see add_trace)."""
+
+    def __init__(self, metrics, queue, interval=1., traces=False):
+        self.metrics = metrics
+        self.queue = queue
+        self.interval = interval
+        self.traces = [] if traces else None
+        # add_trace is called by the fetcher threads
+        self._traces_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_trace(self, trace):
+        """Record a finished trace."""
+        self.metrics.record(trace)
+        if self.traces is not None:
+            row = trace.to_row()
+            with self._traces_lock:
+                self.traces.append(row)
+
+    def report(self):
+        """Send the metrics collected since the last report."""
+        state = self.metrics.take()
+        if self.traces is not None:
+            with self._traces_lock:
+                state['traces'], self.traces = self.traces, []
+        if state['urls'] or state['histograms'] or state.get('traces'):
+            self.queue.put(state)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        """Start reporting in a thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread and send the rest of the metrics."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+        self.report()
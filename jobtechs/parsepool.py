@@ -0,0 +1,143 @@
+"""Functions run in a pool of parsing processes.
+
+The parsers and the terms extractor are passed to each process once,
+by the pool initializer, the tasks reference a parser by its key
+(a netloc or 'default').
+
+ParseWorker processes run the same functions for the fetchers, which only
+request the pages (see ThrottledFetcher).
+"""
+
+import concurrent.futures
+import logging
+import multiprocessing as mp
+import multiprocessing.util
+import os
+import time
+
+from jobtechs.metrics import Metrics, MetricsReporter, end_trace, resume_trace, start_trace
+from jobtechs.profiler import StackSampler
+
+G_LOG = logging.getLogger(__name__)
+
+# parsers and the terms extractor of the current process, see init_worker
+_WORKER_STATE = {}
+
+def _save_profile(sampler, profile_path):
+    sampler.stop()
+    sampler.save(profile_path)
+
+def init_worker(parsers, terms_extractor, profile_path=None):
+    """Initialize a parsing process with a dict of parsers and a terms extractor.
+
+    If profile_path is given, the process is sampled until it exits (see StackSampler)."""
+    _WORKER_STATE['parsers'] = parsers
+    _WORKER_STATE['terms_extractor'] = terms_extractor
+    if profile_path:
+        sampler = StackSampler('parser')
+        sampler.start()
+        # run by the process on exit, like atexit in the main process
+        multiprocessing.util.Finalize(None, _save_profile, (sampler, profile_path),
+                                      exitpriority=10)
+
+def parse_page(parser_key, url, text, encoding=None):
+    """Parse a page with the parser by parser_key, returns (Result, error)."""
+    parser = _WORKER_STATE['parsers'][parser_key]
+    return parser.parse_page(url, text, _WORKER_STATE['terms_extractor'], encoding)
+
+def parse_page_timed(parser_key, url, text, encoding=None):
+    """Parse a page as parse_page does and time the parsing stages.
+
+    Returns (Result, error, stages), stages map the stages to their times
+    in seconds (see jobtechs.metrics)."""
+    start_trace(url)
+    try:
+        result, error = parse_page(parser_key, url, text, encoding)
+    finally:
+        trace = end_trace()
+    return result, error, trace.stages
+
+def parse_pages(parser_key, pages):
+    """Parse a list of (url, text, encoding) triples with the parser by parser_key.
+
+    Returns a list of (Result, error) pairs."""
+    parser = _WORKER_STATE['parsers'][parser_key]
+    return parser.parse_pages(pages, _WORKER_STATE['terms_extractor'])
+
+def make_pool(parsers, terms_extractor, max_workers=None, profile_path=None):
+    """Create a pool of parsing processes, by default one per core.
+
+    If profile_path is given, the processes are profiled (see init_worker)."""
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers or os.cpu_count(),
+        initializer=init_worker, initargs=(parsers, terms_extractor, profile_path))
+
+
+class ParseWorker(mp.Process):
+    """A process parsing the pages fetched by the fetchers.
+
+    The pages are taken from q_pages as (parser key, url, body, encoding, trace,
+    time) tuples, where trace is the Trace of the url started by the fetcher
+    (or None) and time is the time.time() it was put at. The results are put
+    into q_out and the errors into q_err, as the fetchers do. A None value
+    in q_pages stops the worker, each worker should get one.
+
+    The workers share q_pages, so that the pages of all the fetchers are parsed
+    by as many processes as there are cores, while the fetcher threads only wait
+    for the network. If q_metrics is given, the traces of the urls are finished
+    by the worker (see ThrottledFetcher)."""
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(self, parsers, terms_extractor, q_pages, q_out, q_err, q_metrics=None,
+                 trace_urls=False, profile_path=None):
+        super().__init__()
+        self.daemon = True
+        self.parsers = parsers
+        self.terms_extractor = terms_extractor
+        self.q_pages = q_pages
+        self.q_out = q_out
+        self.q_err = q_err
+        self.q_metrics = q_metrics
+        self.trace_urls = trace_urls
+        self.profile_path = profile_path
+
+    def _parse(self, parser_key, url, body, encoding):
+        # pylint: disable=broad-except
+        try:
+            result, error = parse_page(parser_key, url, body, encoding)
+        except Exception as err:
+            G_LOG.exception('Uncaught exception on parsing url=%s | %s', url, str(err))
+            return None, str(err)
+        if error:
+            G_LOG.error('parsing failed url=%s | %s', url, error)
+        return result, error
+
+    def run(self):
+        """Parse the pages from q_pages until a None value."""
+        init_worker(self.parsers, self.terms_extractor, self.profile_path)
+        reporter = None
+        if self.q_metrics is not None:
+            reporter = MetricsReporter(Metrics(), self.q_metrics, traces=self.trace_urls)
+            reporter.start()
+        while True:
+            page = self.q_pages.get()
+            if page is None:
+                break
+            parser_key, url, body, encoding, trace, sent = page
+            if reporter is None:
+                trace = None
+            if trace is not None:
+                trace.add('pages', max(time.time() - sent, 0.))
+                resume_trace(trace)
+            result, error = self._parse(parser_key, url, body, encoding)
+            if trace is not None:
+                end_trace()
+                if error:
+                    trace.outcome = 'error'
+                reporter.add_trace(trace)
+            if error:
+                self.q_err.put((url, error))
+            else:
+                self.q_out.put(result)
+        if reporter is not None:
+            reporter.stop()
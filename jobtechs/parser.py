@@ -2,48 +2,142 @@
 
 """
 
+from array import array
+import codecs
 from collections import deque, namedtuple
 from hashlib import sha1
 import logging
 import pathlib
 import re
 import sys
-from urllib.parse import urlparse, parse_qs, urlencode
+import threading
+from urllib.parse import urlparse, urlunparse, parse_qs, parse_qsl, urlencode
 
+import lxml.etree
 import lxml.html as etree
 
 from jobtechs.common import iter_good_lines
+from jobtechs.metrics import iter_timed, timed
 
 G_LOG = logging.getLogger(__name__)
 
+# splitting of texts into words, see iter_words
+WORDS_SPLIT_RE = re.compile(r'(\W+)')
+WORD_SUFFIX_RE = re.compile(r'([#+]+)\W')
+# the longest prefix ending with a space followed by a word character, the text can be
+# split there into pieces scanned separately (see TermsAutomaton.extract_from_chunks)
+CHUNK_CUT_RE = re.compile(r'.*\s(?=\w)', re.DOTALL)
+
 def hash_url(url):
     """Hash url to use as a page of a filename"""
     return sha1(url.encode('utf-8')).hexdigest()
 
+def normalize_url(url):
+    """Normalize the url: lowercase the schema and the domain, drop the default port
+    and the fragment."""
+    urlp = urlparse(url.strip())
+    scheme = urlp.scheme.lower()
+    netloc = urlp.netloc.lower()
+    default_port = {'http': ':80', 'https': ':443'}.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    return urlunparse((scheme, netloc, urlp.path or '/', urlp.params, urlp.query, ''))
+
+# byte order marks take precedence over any other encoding declarations
+BOMS = ((codecs.BOM_UTF8, 'utf-8'), (codecs.BOM_UTF16_LE, 'utf-16-le'),
+        (codecs.BOM_UTF16_BE, 'utf-16-be'))
+META_CHARSET_RE = re.compile(rb'<meta[^>]+charset=["\']?\s*([-\w.:]+)', re.IGNORECASE)
+# the number of the first bytes of a page searched for a meta charset
+META_CHARSET_LIMIT = 2048
+# browsers decode pages declared as latin-1 or ascii as windows-1252
+ENCODING_ALIASES = {'ascii': 'cp1252', 'latin-1': 'cp1252', 'iso8859-1': 'cp1252'}
+
+def guess_encoding(content, encoding=None):
+    """Return the encoding of html bytes.
+
+    It is taken from a BOM, the encoding hint (the charset of the Content-Type header),
+    a meta charset at the beginning of the page, the first one known to Python,
+    and defaults to utf-8. No decoding is done, the page is not sniffed by chardet."""
+    for bom, name in BOMS:
+        if content.startswith(bom):
+            return name
+    match = META_CHARSET_RE.search(content, 0, META_CHARSET_LIMIT)
+    meta_encoding = match.group(1).decode('ascii') if match else None
+    for name in (encoding, meta_encoding):
+        if not name:
+            continue
+        try:
+            name = codecs.lookup(name).name
+        except LookupError:
+            continue
+        return ENCODING_ALIASES.get(name, name)
+    return 'utf-8'
+
+# html parsers by encodings, a parser per thread since a parser serializes its use
+_LOCAL = threading.local()
+
+def get_html_parser(encoding):
+    """Return an lxml.html parser of the current thread decoding bytes with the encoding.
+
+    Raises LookupError if the encoding is unknown to libxml2."""
+    parsers = _LOCAL.__dict__.setdefault('html_parsers', {})
+    parser = parsers.get(encoding)
+    if parser is None:
+        parser = parsers[encoding] = etree.HTMLParser(encoding=encoding)
+    return parser
+
+def parse_html(text, encoding=None):
+    """Parse a page given as str or bytes into a tree.
+
+    Bytes are decoded by lxml itself with the guessed encoding (see guess_encoding),
+    encoding is a hint, e.g. the charset of the Content-Type header."""
+    with timed('parse'):
+        if isinstance(text, str):
+            return etree.fromstring(text)
+        encoding = guess_encoding(text, encoding)
+        try:
+            parser = get_html_parser(encoding)
+        except LookupError:
+            return etree.fromstring(text.decode(encoding, 'replace'))
+        return etree.fromstring(text, parser=parser)
+
+# query parameters which only track the source of a visit
+TRACKING_PARAMS = frozenset(('utm_source', 'utm_medium', 'utm_campaign', 'utm_term',
+                             'utm_content', 'gclid', 'fbclid', 'gns', 'gh_src'))
+
+def strip_tracking_params(url):
+    """Normalize the url and drop TRACKING_PARAMS from its query."""
+    url = normalize_url(url)
+    urlp = urlparse(url)
+    if not urlp.query:
+        return url
+    query = parse_qsl(urlp.query, keep_blank_values=True)
+    kept = [(name, value) for name, value in query if name.lower() not in TRACKING_PARAMS]
+    if len(kept) == len(query):
+        return url
+    return urlunparse(urlp._replace(query=urlencode(kept)))
+
 def extract_site_url(url):
     """Extract schema + domain from the url."""
     urlp = urlparse(url)
     return '{}://{}'.format(urlp.scheme, urlp.netloc)
 
-def iter_n_grams(text, max_n):
-    """Iterate over word n-grams extracted from the text.
+def iter_words(text):
+    """Iterate over words extracted from the text as (word, breaks) pairs.
 
-    On each new word The iterator produces ngrams from 1 to max_n,
-    if the word is separated by a space. If there is a puctuation before
-    the word, we do not produce n-grams, since a punctuation is not
-    supposed to be within a term.
+    breaks is True if there is a punctuation before the word, that is
+    the word can not continue a term started by the previous words,
+    since a punctuation is not supposed to be within a term.
 
     We slightly extend the parser to support terms like c++, c#,
     .net and node.js, but the approach requires manual intervention.
-    It is better to build something based on DFA.
     """
     if not text:
-        return []
+        return
     # symbols that joint two words into one: node.js, Transact-SQL, PL/SQL
     word_joiners = {'-', '.', '/'}
 
-    chunks = re.split(r'(\W+)', text)
-    words = deque(maxlen=max_n)
+    chunks = WORDS_SPLIT_RE.split(text)
     i = 0
     len_chunks = len(chunks)
     prev_sep = ' '
@@ -71,14 +165,33 @@ def iter_n_grams(text, max_n):
         if i < len_chunks - 2:
             next_sep = chunks[i+1]
             # there is # or + at the end of the word
-            match = re.match(r'([#+]+)\W', next_sep)
+            match = WORD_SUFFIX_RE.match(next_sep)
             if match:
                 word += match.group(1)
                 # cut the symbols from the separator
                 next_sep = next_sep[len(match.group(1)):]
 
+        yield word, bool(prev_sep.strip())
+        if i < len_chunks - 2:
+            prev_sep = next_sep
+        i += 2
+
+
+def iter_n_grams(text, max_n):
+    """Iterate over word n-grams extracted from the text.
+
+    On each new word The iterator produces ngrams from 1 to max_n,
+    if the word is separated by a space. If there is a puctuation before
+    the word, we do not produce n-grams, since a punctuation is not
+    supposed to be within a term.
+
+    The words are split by iter_words. The number of produced n-grams
+    grows with max_n, see TermsAutomaton for a linear alternative.
+    """
+    words = deque(maxlen=max_n)
+    for word, breaks in iter_words(text):
         yield (word,)
-        if prev_sep.strip():
+        if breaks:
             words.clear()
         words.append(word)
         if max_n > 1:
@@ -86,9 +199,183 @@ def iter_n_grams(text, max_n):
             # yield max_n_gram
             for j in range(2, len(max_n_gram)+1):
                 yield max_n_gram[-j:]
-        if i < len_chunks - 2:
-            prev_sep = next_sep
-        i += 2
+
+
+class Vocabulary:
+    """A frozen vocabulary of terms mapping term-tuples to integer ids and back.
+
+    The terms are ordered by their names, so that sorted term ids give
+    sorted names. Each vocabulary is registered by the digest of its names,
+    which allows passing the digest between processes instead of the terms
+    (see Result).
+    """
+    _registry = {}
+
+    def __init__(self, terms):
+        self.names = tuple(sorted({' '.join(term) for term in terms}))
+        self.terms = tuple(tuple(name.split(' ')) for name in self.names)
+        self.ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        # the smallest array type able to hold the ids
+        self.typecode = 'H' if len(self.names) <= 0xffff else 'I'
+        self.digest = sha1('\n'.join(self.names).encode('utf-8')).hexdigest()
+        self._registry[self.digest] = self
+
+    def __len__(self):
+        return len(self.names)
+
+    def __reduce__(self):
+        # unpickling registers the vocabulary in the receiving process
+        return (Vocabulary, (self.terms,))
+
+    @classmethod
+    def get(cls, digest):
+        """Return a vocabulary registered in the current process by its digest."""
+        return cls._registry[digest]
+
+    @classmethod
+    def unregister(cls, digest):
+        """Forget a vocabulary registered in the current process by its digest."""
+        cls._registry.pop(digest, None)
+
+    def to_array(self, term_ids):
+        """Convert term ids into a sorted compact array."""
+        return array(self.typecode, sorted(term_ids))
+
+    def to_names(self, term_ids):
+        """Convert term ids into a list of names sorted alphabetically."""
+        return [self.names[term_id] for term_id in sorted(term_ids)]
+
+
+class TermsAutomaton:
+    """An Aho-Corasick automaton over word tokens.
+
+    The automaton is built from a mapping of term-tuples to term ids.
+    States are numbered from 0 (the root). For each state we keep a dict of
+    transitions by the next word, a failure link to the state of the longest
+    proper suffix of the path and a tuple of ids of terms ending in the state.
+
+    Scanning a text is a single pass over its words (see iter_words):
+    a punctuation before a word resets the automaton to the root.
+    """
+
+    def __init__(self, terms):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for term, term_id in terms.items():
+            self._add_term(term, term_id)
+        self._build_failure_links()
+
+    def _add_term(self, term, term_id):
+        state = 0
+        for word in term:
+            next_state = self._goto[state].get(word)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+                self._goto[state][word] = next_state
+            state = next_state
+        self._output[state] = (term_id,)
+
+    def _build_failure_links(self):
+        goto, fail, output = self._goto, self._fail, self._output
+        # breadth-first, so that the failure state is always processed before the state
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, next_state in goto[state].items():
+                queue.append(next_state)
+                fail_state = fail[state]
+                while fail_state and word not in goto[fail_state]:
+                    fail_state = fail[fail_state]
+                fail[next_state] = goto[fail_state].get(word, 0)
+                output[next_state] += output[fail[next_state]]
+
+    def iter_matches(self, text):
+        """Iterate over ids of terms found in the text (in order of their ends)."""
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for word, breaks in iter_words(text):
+            if breaks:
+                state = 0
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            yield from output[state]
+
+    def _scan_piece(self, piece, state, breaks_before, found, final):
+        """Feed words of a piece of a text to the automaton starting in the state.
+
+        A piece which is not final ends with a space, which gives a trailing empty word
+        (see iter_words). The word is not fed, instead whether it breaks terms
+        is returned along with the state to continue from."""
+        goto, fail, output = self._goto, self._fail, self._output
+        words = iter_words(piece)
+        last = next(words, None)
+        for item in words:
+            word, breaks = last
+            last = item
+            if breaks or breaks_before:
+                state = 0
+                breaks_before = False
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+            if output[state]:
+                found.update(output[state])
+        if last is None:
+            return state, breaks_before
+        if not final:
+            return state, breaks_before or last[1]
+        word, breaks = last
+        if breaks or breaks_before:
+            state = 0
+        while state and word not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(word, 0)
+        found.update(output[state])
+        return state, False
+
+    def extract_from_chunks(self, chunks):
+        """Return a set of term ids found in a text given by an iterable of its chunks.
+
+        The chunks are lowercased and buffered until a space followed by a word,
+        where the text can be split without changing its words."""
+        found = set()
+        state = 0
+        breaks_before = False
+        buffer = ''
+        for chunk in chunks:
+            buffer += chunk.lower()
+            match = CHUNK_CUT_RE.match(buffer)
+            if match:
+                piece, buffer = buffer[:match.end()], buffer[match.end():]
+                state, breaks_before = self._scan_piece(piece, state, breaks_before, found, False)
+        self._scan_piece(buffer, state, breaks_before, found, True)
+        return found
+
+    def extract_many(self, texts):
+        """Return a list of sets of term ids found in each of the texts.
+
+        The scanning loop is inlined to avoid per-text method calls and lookups.
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        results = []
+        for text in texts:
+            found = set()
+            state = 0
+            for word, breaks in iter_words(text.lower()):
+                if breaks:
+                    state = 0
+                while state and word not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(word, 0)
+                if output[state]:
+                    found.update(output[state])
+            results.append(found)
+        return results
 
 
 class TermsExtractor:
@@ -99,55 +386,147 @@ class TermsExtractor:
 
     For simplicity we will lowercase all words and slightly normalize
     the text.
+
+    The terms are interned into a Vocabulary, the extraction methods return
+    sets of term ids.
     """
     # pylint: disable=no-self-use
     def __init__(self, terms_filename):
         self.terms_filename = terms_filename
-        self._terms = set()
+        self.vocabulary = Vocabulary(())
+        # term-tuple -> term id
+        self._terms = {}
         # the longest n in terms n-grams
         self.max_n = 1
         self.reload_terms()
 
     def reload_terms(self):
         """Reload the terms into the internal state from the terms file."""
-        self._terms.clear()
-        max_n = 1
         with open(self.terms_filename) as file_:
-            for line in iter_good_lines(file_):
-                term = tuple(line.lower().split())
-                self._terms.add(term)
-                if len(term) > max_n:
-                    max_n = len(term)
-        self.max_n = max_n
+            vocabulary = Vocabulary(tuple(line.lower().split()) for line in iter_good_lines(file_))
+        self.vocabulary = vocabulary
+        self._terms = vocabulary.ids
+        self.max_n = max((len(term) for term in vocabulary.terms), default=1)
+
+    def current(self):
+        """Return the extractor to parse a page with.
+
+        A page is parsed with a single extractor, while a reloadable one
+        (see jobtechs.sharedterms) may switch to a new version of the terms."""
+        return self
 
     def iter_n_grams(self, text):
         """Iterate over n-grams parsed from text."""
         return iter_n_grams(text, self.max_n)
 
     def extract_terms(self, text):
-        """Extract terms from the text description."""
+        """Extract ids of terms from the text description."""
         text = text.lower()
+        terms = self._terms
         # iterate through n_grams and collect matches in common
         common = {
-            n_gram for n_gram in self.iter_n_grams(text)
-            if n_gram in self._terms
+            terms[n_gram] for n_gram in self.iter_n_grams(text)
+            if n_gram in terms
         }
         return common
 
+    def extract_terms_many(self, texts):
+        """Extract terms from an iterable of text descriptions.
+
+        Returns a list with a set of term ids for each of the texts.
+        """
+        terms = self._terms
+        max_n = self.max_n
+        return [
+            {terms[n_gram] for n_gram in iter_n_grams(text.lower(), max_n) if n_gram in terms}
+            for text in texts
+        ]
+
+    def extract_terms_from_chunks(self, chunks):
+        """Extract ids of terms from a text description given by an iterable of its chunks."""
+        return self.extract_terms(''.join(chunks))
+
     def terms_to_list(self, terms):
-        """Convert set of term-tuples into a sorted list of strings."""
-        return sorted(' '.join(term) for term in terms)
+        """Convert set of term ids into a sorted list of strings."""
+        return self.vocabulary.to_names(terms)
+
+    def terms_to_ids(self, terms):
+        """Convert set of term ids into a compact sorted array."""
+        return self.vocabulary.to_array(terms)
+
+
+class AutomatonTermsExtractor(TermsExtractor):
+    """Terms extractor scanning the text in a single pass with a TermsAutomaton.
+
+    It finds the same terms as TermsExtractor, but the cost of a page does not
+    depend on the length of the longest term.
+    """
+
+    def __init__(self, terms_filename):
+        self._automaton = TermsAutomaton({})
+        super().__init__(terms_filename)
+
+    def reload_terms(self):
+        """Reload the terms from the terms file and rebuild the automaton."""
+        super().reload_terms()
+        # the automaton is replaced at once, so that concurrent extractions
+        # use either the old or the new one
+        self._automaton = TermsAutomaton(self._terms)
+
+    def extract_terms(self, text):
+        """Extract ids of terms from the text description."""
+        return set(self._automaton.iter_matches(text.lower()))
+
+    def extract_terms_from_chunks(self, chunks):
+        """Extract ids of terms from a text description given by an iterable of its chunks.
+
+        The chunks are scanned as they come, without joining them into a single text."""
+        return self._automaton.extract_from_chunks(chunks)
+
+    def extract_terms_many(self, texts):
+        """Extract terms from an iterable of text descriptions.
+
+        Returns a list with a set of term ids for each of the texts.
+        """
+        return self._automaton.extract_many(texts)
+
+
+# terms extractor implementations by name
+TERMS_EXTRACTORS = {
+    'ngrams': TermsExtractor,
+    'automaton': AutomatonTermsExtractor,
+}
 
 
 class Result:
-    """Object representing page parsing results."""
-    # pylint: disable=too-few-public-methods
+    """Object representing page parsing results.
 
-    def __init__(self, url, company, techs, site):
+    The found techs are kept as an array of ids of the vocabulary terms,
+    the names are produced only on printing. A pickled result references
+    the vocabulary by its digest, so that passing results through
+    queues does not copy the names.
+    """
+    __slots__ = ('url', 'company', 'term_ids', 'site', 'vocabulary')
+
+    def __init__(self, url, company, term_ids, site, vocabulary):
+        # pylint: disable=too-many-arguments
         self.url = url
         self.company = company
-        self.techs = techs
+        self.term_ids = term_ids
         self.site = site
+        self.vocabulary = vocabulary
+
+    @property
+    def techs(self):
+        """A list of names of the found techs."""
+        return [self.vocabulary.names[term_id] for term_id in self.term_ids]
+
+    def __getstate__(self):
+        return self.url, self.company, self.term_ids, self.site, self.vocabulary.digest
+
+    def __setstate__(self, state):
+        self.url, self.company, self.term_ids, self.site, digest = state
+        self.vocabulary = Vocabulary.get(digest)
 
     def __str__(self):
         return '{} | {} | {} | {}'.format(self.url, self.company,
@@ -157,25 +536,227 @@ class Result:
 JobId = namedtuple('JobId', 'company_id job_id')
 
 
-class PageParser:
+SCRIPT_SRCS_XPATH = lxml.etree.XPath('.//script/@src')
+
+
+class PageContext:
+    """Data of a page computed once and shared by the parsers checking the page:
+    the parsed url and its query, the tree and the @src values of the scripts.
+
+    The text of the page may be bytes decoded with the encoding hint (see parse_html).
+    """
+
+    def __init__(self, url, text, tree=None, encoding=None):
+        self.url = url
+        self.text = text
+        self.encoding = encoding
+        self._tree = tree
+        self._urlp = None
+        self._query = None
+        self._script_srcs = None
+
+    @property
+    def tree(self):
+        """The parsed html."""
+        if self._tree is None:
+            self._tree = parse_html(self.text, self.encoding)
+        return self._tree
+
+    @property
+    def parsed_tree(self):
+        """The parsed html if it has been parsed already, None otherwise."""
+        return self._tree
+
+    @property
+    def urlp(self):
+        """The parsed url."""
+        if self._urlp is None:
+            self._urlp = urlparse(self.url)
+        return self._urlp
+
+    @property
+    def query(self):
+        """The parsed query string of the url."""
+        if self._query is None:
+            self._query = parse_qs(self.urlp.query)
+        return self._query
+
+    @property
+    def script_srcs(self):
+        """A list of @src values of the script elements."""
+        if self._script_srcs is None:
+            self._script_srcs = SCRIPT_SRCS_XPATH(self.tree)
+        return self._script_srcs
+
+    def find_script_src(self, marker):
+        """Return the first script @src containing the marker, '' if there is none."""
+        for src in self.script_srcs:
+            if marker in src:
+                return src
+        return ''
+
+
+class _BodyTextTarget:
+    """An lxml parser target collecting text chunks of the body element
+    except the contents of script and style elements."""
+    SKIPPED_TAGS = frozenset(('script', 'style'))
+
+    def __init__(self):
+        self.chunks = []
+        self._in_body = False
+        # the depth of the skipped element being parsed, 0 outside of them
+        self._skipped_depth = 0
+
+    def start(self, tag, attrib):
+        # pylint: disable=unused-argument
+        if self._skipped_depth or tag in self.SKIPPED_TAGS:
+            self._skipped_depth += 1
+        elif tag == 'body':
+            self._in_body = True
+
+    def end(self, tag):
+        if self._skipped_depth:
+            self._skipped_depth -= 1
+        elif tag == 'body':
+            self._in_body = False
+
+    def data(self, data):
+        if self._in_body and not self._skipped_depth:
+            self.chunks.append(data)
+
+    def close(self):
+        pass
+
+
+def iter_body_text(text, chunk_size=65536, encoding=None):
+    """Yield chunks of the text of the html body skipping script and style elements.
+
+    The html (str or bytes decoded as in parse_html) is fed to the parser
+    by chunk_size characters, no tree is built. Joined, the chunks are the same
+    as string(./body) of the tree without script and style elements."""
+    target = _BodyTextTarget()
+    if isinstance(text, str):
+        parser = lxml.etree.HTMLParser(target=target)
+    else:
+        encoding = guess_encoding(text, encoding)
+        try:
+            parser = lxml.etree.HTMLParser(target=target, encoding=encoding)
+        except LookupError:
+            text = text.decode(encoding, 'replace')
+            parser = lxml.etree.HTMLParser(target=target)
+    for start in range(0, len(text), chunk_size):
+        parser.feed(text[start:start + chunk_size])
+        chunks, target.chunks = target.chunks, []
+        yield from chunks
+    if text:
+        parser.close()
+    yield from target.chunks
+
+
+# the text fields of a job description page, see PageParser.prepare_job_page,
+# the description is an iterable of text chunks and may be consumed only once
+JobPage = namedtuple('JobPage', 'url company site description')
+
+# the file in the save_pages_to directory mapping saved page names to their urls
+PAGES_INDEX = 'index.tsv'
+
+# the error of a page embedding a job description of an aggregator followed by its url
+EXTERNAL_JOB_FOUND = 'External job description found:\t'
+
+
+def get_external_job_url(error):
+    """Return the url of the external job description reported by the error, None otherwise."""
+    if error and error.startswith(EXTERNAL_JOB_FOUND):
+        return error[len(EXTERNAL_JOB_FOUND):]
+    return None
+
+
+class SelectorsMeta(type):
+    """A metaclass compiling the XPath selectors of a parser class once, at class creation.
+
+    A class declares its selectors as a dict name -> XPath expression string,
+    the compiled lxml.etree.XPath objects of the class and its bases are kept
+    in the _xpaths dict (see PageParser.select).
+    """
+
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        xpaths = {}
+        for base in reversed(cls.__mro__[1:]):
+            xpaths.update(base.__dict__.get('_xpaths', {}))
+        for selector, expression in namespace.get('selectors', {}).items():
+            xpaths[selector] = lxml.etree.XPath(expression)
+        cls._xpaths = xpaths
+
+
+class PageParser(metaclass=SelectorsMeta):
     """A generic page parser. It may use parsers for vacancy aggregators (agg_parsers)
     to look for common markers of injected vacancies.
 
     save_pages_to parameter turns on saving of requested pages into the specified directory.
+    The names of the saved pages, their urls and encodings are appended to PAGES_INDEX
+    file in the directory.
+
+    Pages are given as bytes, as they were received, along with an encoding hint
+    (the charset of the Content-Type header), or as str. Bytes are saved as is
+    and decoded by lxml (see parse_html).
+
+    Parsing of a page is split in two steps: prepare_page extracts the JobPage fields
+    and finish_job_page makes a Result from the terms found in the description,
+    so that parse_pages can extract terms of many pages at once.
+
+    The aggregator parsers are indexed by their job_url_param, so that a page is
+    checked only by the parsers whose parameter is in the page url.
 
+    If a parser keeps the generic extraction methods, the description of a page
+    which has not been parsed into a tree is streamed by iter_body_text.
+
+    The XPath expressions used by a parser are declared in its selectors
+    and compiled once per class (see SelectorsMeta).
     """
     # pylint: disable=unused-argument,no-self-use
+    selectors = {
+        'description': 'string(./body)',
+        'scripts_and_styles': './/script | .//style',
+    }
 
     def __init__(self, save_pages_to=None, agg_parsers=None):
         if save_pages_to:
             save_pages_to = pathlib.Path(save_pages_to)
         self.save_pages_to = save_pages_to
         self._agg_parsers = [] if agg_parsers is None else agg_parsers
+        # url parameter -> parsers; parsers without a parameter check every page
+        self._agg_parsers_by_param = {}
+        self._agg_parsers_always = []
+        for parser in self._agg_parsers:
+            if parser.job_url_param:
+                self._agg_parsers_by_param.setdefault(parser.job_url_param, []).append(parser)
+            elif type(parser).check_for_job_url is not AggregatorParser.check_for_job_url:
+                self._agg_parsers_always.append(parser)
+
+    def find_external_job_url(self, context):
+        """Check the page by the aggregator parsers for a link to an external job description.
+
+        Returns the link or None."""
+        parsers = list(self._agg_parsers_always)
+        if self._agg_parsers_by_param and context.query:
+            for param, param_parsers in self._agg_parsers_by_param.items():
+                if param in context.query:
+                    parsers.extend(param_parsers)
+        for parser in parsers:
+            new_url = parser.check_for_job_url(context.url, context.text, context=context)
+            if new_url:
+                return new_url
+        return None
 
-    def save_if_needed(self, url, text, page_name=None):
+    def save_if_needed(self, url, text, page_name=None, encoding=None):
         """Save page contents if bool(self.save_pages_to) is True"""
         if not self.save_pages_to:
             return
+        if isinstance(text, str):
+            text, encoding = text.encode('utf-8'), 'utf-8'
+        else:
+            encoding = guess_encoding(text, encoding)
         if not page_name:
             page_name = hash_url(url)
         urlp = urlparse(url)
@@ -185,8 +766,14 @@ class PageParser:
         page_name = prefix + '.' + page_name + suffix
 
         G_LOG.info('saving page %s as %s', url, page_name)
-        with self.save_pages_to.joinpath(page_name).open(mode='w') as file_:
-            print(text, file=file_)
+        self.save_pages_to.joinpath(page_name).write_bytes(text)
+        # a single short write in the append mode, so that processes do not mix lines
+        with self.save_pages_to.joinpath(PAGES_INDEX).open(mode='a') as file_:
+            file_.write('{}\t{}\t{}\n'.format(page_name, url, encoding))
+
+    def select(self, selector, tree):
+        """Evaluate the compiled XPath of the selector on the tree."""
+        return self._xpaths[selector](tree)
 
     def _extract_company_name(self, url, text, tree):
         # we need a generic way of company name extraction from an arbitrary page
@@ -202,55 +789,105 @@ class PageParser:
         return extract_site_url(url)
 
     def _extract_description(self, url, text, tree):
-        return tree.xpath('string(./body)')
+        return self.select('description', tree)
 
-    def parse_job_page(self, url, text, extractor, tree=None):
-        """A generic method for parsing pages containing a job description.
+    def _streams_description(self):
+        cls = type(self)
+        return (cls._extract_description is PageParser._extract_description
+                and cls._extract_company_name is PageParser._extract_company_name
+                and cls._extract_company_site is PageParser._extract_company_site)
 
-        It is a template method, allowing to override methods for extracting terms,
+    def prepare_job_page(self, url, text, tree=None, encoding=None):
+        """A generic method for extracting the fields of a page containing a job description.
+
+        It is a template method, allowing to override methods for extracting the description,
         company name and site in inheritants.
         """
+        if tree is None and self._streams_description():
+            # the body is parsed as its text is matched
+            return JobPage(url, self._extract_company_name(url, text, None),
+                           self._extract_company_site(url, text, None),
+                           iter_timed(iter_body_text(text, encoding=encoding), 'parse', 'match'))
         if tree is None:
-            tree = etree.fromstring(text)
-
-        company = self._extract_company_name(url, text, tree)
-        site = self._extract_company_site(url, text, tree)
-
-        for elem in tree.xpath('.//script'):
-            elem.drop_tree()
-        for elem in tree.xpath('.//style'):
-            elem.drop_tree()
-
-        description = self._extract_description(url, text, tree)
-        ## print(description)
-        terms = extractor.extract_terms(description)
-        terms = extractor.terms_to_list(terms)
-        if not company and not terms and not site:
-            return None, 'Nothing extracted. The job is probably no longer active.'
+            tree = parse_html(text, encoding)
 
-        return Result(url, company, terms, site), None
+        with timed('describe'):
+            company = self._extract_company_name(url, text, tree)
+            site = self._extract_company_site(url, text, tree)
 
-    def parse_page(self, url, text, extractor):
-        """Default implementation of page parsing.
+            for elem in self.select('scripts_and_styles', tree):
+                elem.drop_tree()
 
-        It assumes we are parsing a job description and delegating parsing to parse_job_page."""
-        self.save_if_needed(url, text)
+            description = self._extract_description(url, text, tree)
+        return JobPage(url, company, site, (description,))
 
-        tree = etree.fromstring(text)
-
-        for parser in self._agg_parsers:
-            new_url = parser.check_for_job_url(url, text, tree)
-            if new_url:
-                return None, 'External job description found:\t' + new_url
+    def finish_job_page(self, page, terms, extractor):
+        """Make a Result from the prepared page and the set of term ids found in its description."""
+        terms = extractor.terms_to_ids(terms)
+        if not page.company and not terms and not page.site:
+            return None, 'Nothing extracted. The job is probably no longer active.'
 
-        return self.parse_job_page(url, text, extractor, tree)
+        return Result(page.url, page.company, terms, page.site, extractor.vocabulary), None
+
+    def parse_job_page(self, url, text, extractor, tree=None, encoding=None):
+        """A generic method for parsing pages containing a job description."""
+        extractor = extractor.current()
+        page = self.prepare_job_page(url, text, tree, encoding)
+        with timed('match'):
+            terms = extractor.extract_terms_from_chunks(page.description)
+        return self.finish_job_page(page, terms, extractor)
+
+    def prepare_page(self, url, text, encoding=None):
+        """Default implementation of page preparation.
+
+        It assumes we are parsing a job description and delegating parsing
+        to prepare_job_page. Returns a pair of JobPage and an error."""
+        self.save_if_needed(url, text, encoding=encoding)
+
+        context = PageContext(url, text, encoding=encoding)
+        new_url = self.find_external_job_url(context)
+        if new_url:
+            return None, EXTERNAL_JOB_FOUND + new_url
+
+        return self.prepare_job_page(url, text, context.parsed_tree, encoding), None
+
+    def parse_page(self, url, text, extractor, encoding=None):
+        """Parse the page and return a pair of Result and an error."""
+        extractor = extractor.current()
+        page, error = self.prepare_page(url, text, encoding)
+        if error:
+            return None, error
+        with timed('match'):
+            terms = extractor.extract_terms_from_chunks(page.description)
+        return self.finish_job_page(page, terms, extractor)
+
+    def parse_pages(self, pages, extractor):
+        """Parse an iterable of (url, text, encoding) triples.
+
+        The terms of all the descriptions are extracted in a single batch.
+        Returns a list of (Result, error) pairs."""
+        extractor = extractor.current()
+        prepared = [self.prepare_page(url, text, encoding) for url, text, encoding in pages]
+        job_pages = [page for page, error in prepared if not error]
+        terms = iter(extractor.extract_terms_many(
+            ''.join(page.description) for page in job_pages))
+        return [
+            (None, error) if error else self.finish_job_page(page, next(terms), extractor)
+            for page, error in prepared
+        ]
 
 
 class AggregatorParser:
-    """A base class fro the specific job aggregator site parsers."""
+    """A base class fro the specific job aggregator site parsers.
+
+    job_url_param is a url parameter of the pages which embed job descriptions
+    of the aggregator, only such pages are checked by check_for_job_url.
+    """
     # pylint: disable=unused-argument,no-self-use
     netloc = None
-    def check_for_job_url(self, url, text, tree=None):
+    job_url_param = None
+
+    def check_for_job_url(self, url, text, tree=None, context=None):
         """Check whether the page contains a link to an external job description.
 
         If the link is found, it is returned. None otherwise.
@@ -261,21 +898,42 @@ class AggregatorParser:
         """Find conpany_id and job_id on the page."""
         return
 
-    def parse_page(self, url, text, extractor):
-        """A generic implementation of text parsing for the aggregator sites.
+    @classmethod
+    def job_id_from_url(cls, url):
+        """Return the JobId of the job description at the url, None if the url is not
+        a job description url of a known form."""
+        return None
+
+    @classmethod
+    def job_url(cls, job_id):
+        """Return the canonical url of the job description by its JobId, None if
+        the aggregator has no canonical job urls."""
+        return None
+
+    @classmethod
+    def canonicalize_url(cls, url):
+        """Return the canonical form of the url: the job url if the url identifies a job,
+        the url without tracking parameters otherwise."""
+        job_id = cls.job_id_from_url(url)
+        job_url = cls.job_url(job_id) if job_id else None
+        return job_url or strip_tracking_params(url)
+
+    def prepare_page(self, url, text, encoding=None):
+        """A generic implementation of page preparation for the aggregator sites.
 
         We expect that the parsed page contains the job id. Otherwise, it is some
         other page on the aggregator site which hardly contains a job description."""
 
-        tree = etree.fromstring(text)
+        tree = parse_html(text, encoding)
 
         # check if the page is a job description
         job_id = self.extract_job_id(url, text, tree)
         if job_id:
-            self.save_if_needed(url, text, '{}.{}'.format(job_id.company_id, job_id.job_id))
-            return self.parse_job_page(url, text, extractor, tree)
+            self.save_if_needed(url, text, '{}.{}'.format(job_id.company_id, job_id.job_id),
+                                encoding)
+            return self.prepare_job_page(url, text, tree), None
 
-        self.save_if_needed(url, text)
+        self.save_if_needed(url, text, encoding=encoding)
         return None, 'The url is not a job description/vacancy.'
 
 
@@ -284,20 +942,40 @@ class IndeedParser(AggregatorParser, PageParser):
     # mobile version of jobs contains less noise:
     # https://www.indeed.com/m/viewjob?jk=ce09ccbdef05dafc
     netloc = "www.indeed.com"
+    # lxml lowercases the attribute names!
+    selectors = {
+        'alt_url': 'string(.//link[@rel="alternate" and @media="handheld"]/@href)',
+        'company_name': 'string(.//span[@class="company"])',
+        'description': 'string(.//span[@id="job_summary"])',
+    }
 
     def extract_job_id(self, url, text, tree):
-        alt_url = tree.xpath('string(.//link[@rel="alternate" and @media="handheld"]/@href)')
+        alt_url = self.select('alt_url', tree)
         if alt_url:
             job_id = re.search(r'[?]jk=(\w+)', alt_url)
             if job_id:
                 return JobId('', job_id.group(1))
 
+    @classmethod
+    def job_id_from_url(cls, url):
+        # the desktop and the mobile versions of a job, the other parameters track the visit:
+        # https://www.indeed.com/viewjob?jk=ce09ccbdef05dafc&from=serp
+        urlp = urlparse(url)
+        query = parse_qs(urlp.query)
+        if urlp.path in ('/viewjob', '/m/viewjob') and 'jk' in query:
+            return JobId('', query['jk'][0])
+        return None
+
+    @classmethod
+    def job_url(cls, job_id):
+        # the desktop version links the mobile one, which is used by extract_job_id
+        return 'https://{}/viewjob?{}'.format(cls.netloc, urlencode([('jk', job_id.job_id)]))
+
     def _extract_company_name(self, url, text, tree):
-        # lxml lowercases the attribute names!
-        return tree.xpath('string(.//span[@class="company"])')
+        return self.select('company_name', tree)
 
     def _extract_description(self, url, text, tree):
-        return tree.xpath('string(.//span[@id="job_summary"])')
+        return self.select('description', tree)
 
     def _extract_company_site(self, url, text, tree):
         # there is no link on th page
@@ -308,12 +986,22 @@ class IndeedParser(AggregatorParser, PageParser):
 class NewtonSoftwareParser(AggregatorParser, PageParser):
     """A parser for newton.newtonsoftware.com jobs."""
     netloc = "newton.newtonsoftware.com"
+    job_url_param = 'gni'
+    # lxml lowercases the attribute names!
+    selectors = {
+        'job_description': './/table[@id="gnewtonJobDescription"]',
+        'company_name':
+            'string(.//span[@id="indeed-apply-widget"]/@data-indeed-apply-jobcompanyname)',
+        'continue_url':
+            'string(.//span[@id="indeed-apply-widget"]/@data-indeed-apply-continueurl)',
+        'description': 'string(.//td[@id="gnewtonJobDescriptionText"])',
+    }
 
     def extract_job_id(self, url, text, tree):
         urlp = urlparse(url)
         query = parse_qs(urlp.query)
         if 'clientId' in query and 'id' in query and \
-            tree.xpath('.//table[@id="gnewtonJobDescription"]'):
+            self.select('job_description', tree):
 
             # ids are hex chars
             client_id = re.match(r'\w+$', query['clientId'][0])
@@ -322,32 +1010,44 @@ class NewtonSoftwareParser(AggregatorParser, PageParser):
                 return
             return JobId(client_id.group(0), job_id.group(0))
 
+    @classmethod
+    def job_id_from_url(cls, url):
+        # https://newton.newtonsoftware.com/career/JobIntroduction.action?clientId=..&id=..
+        urlp = urlparse(url)
+        query = parse_qs(urlp.query)
+        if urlp.path == '/career/JobIntroduction.action' and 'clientId' in query \
+                and 'id' in query:
+            return JobId(query['clientId'][0], query['id'][0])
+        return None
+
+    @classmethod
+    def job_url(cls, job_id):
+        query = [('clientId', job_id.company_id), ('id', job_id.job_id)]
+        return 'https://{}/career/JobIntroduction.action?{}'.format(cls.netloc, urlencode(query))
+
     def _extract_company_name(self, url, text, tree):
-        # lxml lowercases the attribute names!
-        return tree.xpath(
-            'string(.//span[@id="indeed-apply-widget"]/@data-indeed-apply-jobcompanyname)')
+        return self.select('company_name', tree)
 
     def _extract_company_site(self, url, text, tree):
-        continue_url = \
-            tree.xpath('string(.//span[@id="indeed-apply-widget"]/@data-indeed-apply-continueurl)')
+        continue_url = self.select('continue_url', tree)
         if continue_url:
             return extract_site_url(continue_url)
         return ''
 
     def _extract_description(self, url, text, tree):
-        return tree.xpath('string(.//td[@id="gnewtonJobDescriptionText"])')
+        return self.select('description', tree)
 
-    def check_for_job_url(self, url, text, tree=None):
+    def check_for_job_url(self, url, text, tree=None, context=None):
         """Check whether the page contains a link to an external job description.
 
         If the link is found, it is returned. None otherwise.
         """
-        if tree is None:
-            tree = etree.fromstring(text)
+        if context is None:
+            context = PageContext(url, text, tree)
 
         # an example url:
         # http://www.alteryx.com/careers?gnk=job&gni=8a7886f8518a669b01518ee8e5c07d58&gns=Indeed
-        query = parse_qs(urlparse(url).query)
+        query = context.query
         if 'gni' not in query or 'gnk' not in query or query['gnk'][0] != 'job':
             return
 
@@ -355,8 +1055,7 @@ class NewtonSoftwareParser(AggregatorParser, PageParser):
 
         # looking for [https:]//newton.newtonsoftware.com/career/iframe.action?clientId=[0-9af]+
         # src might lack the http(s) prefix using relative urls
-        marker = '//newton.newtonsoftware.com/career/iframe.action'
-        marker = tree.xpath('string(.//script[contains(@src, "{}")]/@src)'.format(marker))
+        marker = context.find_script_src('//newton.newtonsoftware.com/career/iframe.action')
         if not marker:
             return
 
@@ -365,11 +1064,7 @@ class NewtonSoftwareParser(AggregatorParser, PageParser):
         if 'clientId' not in query:
             return
 
-        client_id = query['clientId'][0]
-
-        query = [('clientId', client_id), ('id', job_id), ('source', 'Indeed')]
-
-        return 'https://{}/career/JobIntroduction.action?{}'.format(self.netloc, urlencode(query))
+        return self.job_url(JobId(query['clientId'][0], job_id))
 
 
 class GreenHouseParser(AggregatorParser, PageParser):
@@ -394,40 +1089,61 @@ class GreenHouseParser(AggregatorParser, PageParser):
     """
     # pylint: disable=unused-argument,no-self-use
     netloc = "boards.greenhouse.io"
+    job_url_param = 'gh_jid'
+    selectors = {
+        'permanent_url': 'string(head/meta[@property="og:url"]/@content)',
+        'jobs_url': 'string(.//div[@id="header"]/a/@href)',
+        'company_name': 'string(.//div[@id="header"]/span[@class="company-name"])',
+        'content': 'string(.//div[@id="content"])',
+    }
 
     def extract_job_id(self, url, text, tree):
         # example https://boards.greenhouse.io/pantheon/jobs/619056
-        permanent_url = tree.xpath('string(head/meta[@property="og:url"]/@content)').strip()
+        permanent_url = self.select('permanent_url', tree).strip()
         match = re.match(r'https://boards.greenhouse.io/([^/]+)/jobs/(\d+)$', permanent_url)
         if match:
             return JobId(match.group(1), match.group(2))
 
+    @classmethod
+    def job_id_from_url(cls, url):
+        # the embedded job description, b and other parameters reference the client site
+        urlp = urlparse(url)
+        query = parse_qs(urlp.query)
+        if urlp.path == '/embed/job_app' and 'for' in query and 'token' in query:
+            return JobId(query['for'][0], query['token'][0])
+        return None
+
+    @classmethod
+    def job_url(cls, job_id):
+        query = [('for', job_id.company_id), ('token', job_id.job_id)]
+        return 'https://{}/embed/job_app?{}'.format(cls.netloc, urlencode(query))
+
     def _extract_company_site(self, url, text, tree):
-        jobs_url = tree.xpath('string(.//div[@id="header"]/a/@href)')
+        jobs_url = self.select('jobs_url', tree)
         if jobs_url:
             return extract_site_url(jobs_url)
         return ''
 
     def _extract_company_name(self, url, text, tree):
-        chunk = tree.xpath('string(.//div[@id="header"]/span[@class="company-name"])').strip()
+        chunk = self.select('company_name', tree).strip()
         if chunk.startswith('at '):
             return chunk[3:]
         return chunk
 
     def _exract_description(self, url, text, tree):
-        return tree.xpath('string(.//div[@id="content"])')
+        return self.select('content', tree)
 
-    def check_for_job_url(self, url, text, tree=None):
+    def check_for_job_url(self, url, text, tree=None, context=None):
         """Check whether the page contains a link to an external job description.
 
         If the link is found, it is returned. None otherwise.
         """
-        if tree is None:
-            tree = etree.fromstring(text)
+        if context is None:
+            context = PageContext(url, text, tree)
 
         # the url should contain a numeric `gh_jid` parameter and there should be
         # a script tag with @src to boards.greenhouse.io
-        query = parse_qs(urlparse(url).query)
+        query = context.query
         if 'gh_jid' not in query:
             return
 
@@ -435,8 +1151,7 @@ class GreenHouseParser(AggregatorParser, PageParser):
 
         # looking for [https:]//boards.greenhouse.io/embed/job_board/js?for=pantheon
         # src might lack the http(s) prefix using relative urls
-        marker = '//boards.greenhouse.io/embed/job_board/js'
-        marker = tree.xpath('string(.//script[contains(@src, "{}")]/@src)'.format(marker))
+        marker = context.find_script_src('//boards.greenhouse.io/embed/job_board/js')
         if not marker:
             return
 
@@ -445,21 +1160,22 @@ class GreenHouseParser(AggregatorParser, PageParser):
         if 'for' not in query:
             return
 
-        client_id = query['for'][0]
-
-        query = [('for', client_id), ('token', job_id)]
-
-        return 'https://boards.greenhouse.io/embed/job_app?{}'.format(urlencode(query))
+        return self.job_url(JobId(query['for'][0], job_id))
 
 
 class HireBridgeParser(AggregatorParser, PageParser):
     """A parser for the jobs from recruit.hirebridge.com."""
     netloc = 'recruit.hirebridge.com'
+    selectors = {
+        'permanent_url': 'string(head/meta[@property="og:url"]/@content)',
+        'company_name': 'string(.//div[@id="logo"]/h1/img/@alt)',
+        'jobs_urls': './/div[@id="rightcol"]//a/@href',
+    }
 
     def extract_job_id(self, url, text, tree):
         # example url:
         # http://recruit.hirebridge.com/v3/Jobs/JobDetails.aspx?cid=7744&jid=451687&locvalue=1059
-        permanent_url = tree.xpath('string(head/meta[@property="og:url"]/@content)').strip()
+        permanent_url = self.select('permanent_url', tree).strip()
         if not permanent_url:
             return
         urlp = urlparse(permanent_url)
@@ -469,11 +1185,11 @@ class HireBridgeParser(AggregatorParser, PageParser):
         return
 
     def _extract_company_name(self, url, text, tree):
-        chunk = tree.xpath('string(.//div[@id="logo"]/h1/img/@alt)')
+        chunk = self.select('company_name', tree)
         return chunk
 
     def _extract_company_site(self, url, text, tree):
-        jobs_url = tree.xpath('.//div[@id="rightcol"]//a/@href')
+        jobs_url = self.select('jobs_urls', tree)
         jobs_url = [url1 for url1 in jobs_url if url1.startswith('http')]
         # naive assumption that the job descriptions contains references to its own site
         if jobs_url:
@@ -484,6 +1200,10 @@ class HireBridgeParser(AggregatorParser, PageParser):
 class JobviteParser(AggregatorParser, PageParser):
     """A parser for the jobs from jobs.jobvite.com."""
     netloc = "jobs.jobvite.com"
+    selectors = {
+        'jobs_urls': './/a/@href',
+        'company_name': 'string(.//div[@class="jv-logo"]/a/img/@alt)',
+    }
 
     def extract_job_id(self, url, text, tree):
         # example http://jobs.jobvite.com/cloudera/job/oNg44fwV
@@ -495,7 +1215,7 @@ class JobviteParser(AggregatorParser, PageParser):
         # else we may try to extract from the page
 
     def _extract_company_site(self, url, text, tree):
-        jobs_url = tree.xpath('.//a/@href')
+        jobs_url = self.select('jobs_urls', tree)
         jobs_url = [url1 for url1 in jobs_url if url1.startswith('http')]
         # naive assumption that the job descriptions contains references to its own site
         if jobs_url:
@@ -503,20 +1223,26 @@ class JobviteParser(AggregatorParser, PageParser):
         return ''
 
     def _extract_company_name(self, url, text, tree):
-        chunk = tree.xpath('string(.//div[@class="jv-logo"]/a/img/@alt)')
+        chunk = self.select('company_name', tree)
         return chunk
 
 
 class DiceParser(AggregatorParser, PageParser):
     """A parser for the jobs from www.dice.com."""
     netloc = "www.dice.com"
+    selectors = {
+        'company_id': 'string(head/meta[@name="groupId"]/@content)',
+        'job_id': 'string(head/meta[@name="jobId"]/@content)',
+        'company_name':
+            'string(.//li[@itemprop="hiringOrganization"]//span[@itemprop="name"])',
+    }
 
     def extract_job_id(self, url, text, tree):
         # <meta name="jobId" content="SM1-13765926">
         # <meta name="groupId" content="cybercod">
 
-        company_id = tree.xpath('string(head/meta[@name="groupId"]/@content)').strip()
-        job_id = tree.xpath('string(head/meta[@name="jobId"]/@content)').strip()
+        company_id = self.select('company_id', tree).strip()
+        job_id = self.select('job_id', tree).strip()
         if company_id and job_id:
             return JobId(company_id, job_id)
 
@@ -525,7 +1251,7 @@ class DiceParser(AggregatorParser, PageParser):
         return ''
 
     def _extract_company_name(self, url, text, tree):
-        chunk = tree.xpath('string(.//li[@itemprop="hiringOrganization"]//span[@itemprop="name"])')
+        chunk = self.select('company_name', tree)
         return chunk
 
 
@@ -540,3 +1266,15 @@ def build_netloc_to_parser_map():
     return the_map
 
 NETLOC_TO_PARSER_MAP = build_netloc_to_parser_map()
+
+
+def canonicalize_url(url):
+    """Return the canonical form of the url which the duplicates of the url share.
+
+    The urls of the job aggregators are canonicalized by the rules of their parsers
+    (see AggregatorParser.canonicalize_url), others are normalized and stripped
+    of tracking parameters."""
+    parser_cls = NETLOC_TO_PARSER_MAP.get(urlparse(url).netloc.lower())
+    if parser_cls is None:
+        return strip_tracking_params(url)
+    return parser_cls.canonicalize_url(url)
@@ -0,0 +1,174 @@
+"""The module implements a sampling profiler of all the threads of a process.
+
+A thread of StackSampler takes the stacks of the other threads of its process
+every interval seconds and counts them. It is wall-clock sampling: a thread waiting
+for the network or a queue is counted as well as a thread using the CPU, so that
+the samples show where the time of the threads goes. Sampling every 10 ms costs
+a few percent of a core.
+
+The samples of a process are saved in the collapsed stacks format, a line
+per stack: the frames from the root (the label of the process) to the leaf
+separated by ';' and the number of samples, e.g.
+
+    fetcher default;threading.Thread._bootstrap;...;jobtechs.parser.parse_html 42
+
+which is read by flamegraph.pl, speedscope and inferno. The files of several
+processes are merged by adding up the numbers (see merge_profiles).
+
+The stacks ending in a function waiting for a lock, a queue or a socket
+(WAITING_FUNCTIONS) are idle time, they are left out of the summary of the hot
+spots (see top_functions) but kept in the profile.
+"""
+
+from collections import Counter
+import glob
+import logging
+import os
+import sys
+import threading
+
+G_LOG = logging.getLogger(__name__)
+
+# the seconds between the samples
+SAMPLE_INTERVAL = 0.01
+
+# the Python functions blocking in C calls while waiting, see top_functions
+WAITING_FUNCTIONS = frozenset((
+    'threading.Condition.wait',
+    'threading.Thread._wait_for_tstate_lock',
+    'multiprocessing.connection.Connection._recv',
+    'multiprocessing.connection.Connection._send',
+    'multiprocessing.connection._poll',
+    'multiprocessing.synchronize.SemLock.__enter__',
+    'selectors._PollLikeSelector.select',
+    'selectors.EpollSelector.select',
+    'selectors.SelectSelector.select',
+    'socket.SocketIO.readinto',
+    'socket.socket.accept',
+    'ssl.SSLSocket.read',
+    'ssl.SSLSocket.recv_into',
+))
+
+
+class StackSampler:
+    """Counts the stacks of the threads of the process sampled every interval seconds.
+
+    The stacks are tuples of the names of the functions (module.qualname) from
+    the root to the leaf, the root is the label of the process."""
+
+    def __init__(self, label, interval=SAMPLE_INTERVAL):
+        self.label = label
+        self.interval = interval
+        self.counts = Counter()
+        # function names by code objects
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _frame_name(self, frame):
+        code = frame.f_code
+        name = self._names.get(code)
+        if name is None:
+            name = self._names[code] = '{}.{}'.format(
+                frame.f_globals.get('__name__', '?'), getattr(code, 'co_qualname', code.co_name))
+        return name
+
+    def sample(self):
+        """Count the current stacks of the threads except for the sampling one."""
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.append(self.label)
+            self.counts[tuple(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        """Start sampling in a thread."""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def save(self, path):
+        """Write the samples to a part file of the profile at the path (see merge_profiles)."""
+        write_collapsed(self.counts, '{}.{}.part'.format(path, os.getpid()))
+
+
+def write_collapsed(counts, path):
+    """Write a Counter of stacks in the collapsed stacks format atomically."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file_:
+        for stack, count in sorted(counts.items()):
+            file_.write('{} {}\n'.format(';'.join(stack), count))
+    os.replace(tmp_path, path)
+
+
+def read_collapsed(path):
+    """Read a file in the collapsed stacks format into a Counter of stacks."""
+    counts = Counter()
+    with open(path) as file_:
+        for line in file_:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                counts[tuple(stack.split(';'))] += int(count)
+    return counts
+
+
+def iter_parts(path):
+    """Iterate over the paths of the part files saved for the profile at the path."""
+    return iter(glob.glob(glob.escape(path) + '.*.part'))
+
+
+def merge_profiles(path):
+    """Merge the part files of the processes saved for the path into the profile at the path.
+
+    The part files are removed. Returns the merged Counter of stacks."""
+    counts = Counter()
+    for part_path in iter_parts(path):
+        counts.update(read_collapsed(part_path))
+        os.remove(part_path)
+    write_collapsed(counts, path)
+    return counts
+
+
+def top_functions(counts, limit=20, waiting=False):
+    """Return the functions with the most samples as (name, self samples, total samples)
+    sorted by the self samples.
+
+    The self samples of a function are the samples it is the leaf of, the total ones
+    include the samples of the functions it calls. The samples of waiting
+    (see WAITING_FUNCTIONS) are skipped unless waiting is True."""
+    own = Counter()
+    total = Counter()
+    for stack, count in counts.items():
+        if not waiting and stack[-1] in WAITING_FUNCTIONS:
+            continue
+        # the label of the process is not a function
+        own[stack[-1]] += count
+        for name in set(stack[1:]):
+            total[name] += count
+    return [(name, count, total[name]) for name, count in own.most_common(limit)]
+
+
+def format_top(counts, limit=20, waiting=False):
+    """Return a text table of top_functions, the percents are of the samples counted."""
+    samples = sum(count for stack, count in counts.items()
+                  if waiting or stack[-1] not in WAITING_FUNCTIONS) or 1
+    lines = ['{:>7} {:>7} {:>7}  {}'.format('self%', 'total%', 'samples', 'function')]
+    for name, own, total in top_functions(counts, limit, waiting):
+        lines.append('{:>7.1f} {:>7.1f} {:>7}  {}'.format(
+            own * 100 / samples, total * 100 / samples, own, name))
+    return '\n'.join(lines)
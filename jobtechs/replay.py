@@ -0,0 +1,104 @@
+"""The module implements re-parsing of the pages saved with --save-pages-to.
+
+The saved pages are named <netloc>.<page name>.html, the urls and the encodings
+of the pages are taken from the PAGES_INDEX file in the same directory. The parser of a page is
+chosen by the netloc prefix of its name. The pages are parsed in chunks by a pool
+of processes (see parsepool), the terms of a chunk are extracted in a single batch.
+"""
+
+import concurrent.futures
+import logging
+import os
+
+from jobtechs import parsepool
+from jobtechs.parser import PAGES_INDEX
+
+G_LOG = logging.getLogger(__name__)
+
+
+def read_pages_index(directory):
+    """Read a dict from page names to (url, encoding) from the PAGES_INDEX file in the directory.
+
+    The encoding is None for pages saved without it."""
+    index = {}
+    try:
+        with open(os.path.join(directory, PAGES_INDEX)) as file_:
+            for line in file_:
+                page_name, _, url = line.rstrip('\n').partition('\t')
+                url, _, encoding = url.partition('\t')
+                if url:
+                    index[page_name] = url, encoding or None
+    except FileNotFoundError:
+        G_LOG.warning('%s is missing in %s, the urls are unknown', PAGES_INDEX, directory)
+    return index
+
+
+def get_parser_key(page_name, netlocs):
+    """Return the longest netloc the page name starts with, 'default' if there is none."""
+    key = 'default'
+    for netloc in netlocs:
+        if page_name.startswith(netloc + '.') and (key == 'default' or len(netloc) > len(key)):
+            key = netloc
+    return key
+
+
+def iter_saved_pages(directory, netlocs):
+    """Iterate over (parser key, url, encoding, path) of the pages saved in the directory.
+
+    If the url of a page is unknown, the site url is restored from the page name."""
+    index = read_pages_index(directory)
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.endswith('.html') or not entry.is_file():
+                continue
+            parser_key = get_parser_key(entry.name, netlocs)
+            url, encoding = index.get(entry.name, (None, None))
+            if url is None:
+                if parser_key == 'default':
+                    # generic pages are named <netloc>.<sha1 of the url>.html
+                    netloc = entry.name[:-len('.html')].rsplit('.', 1)[0]
+                else:
+                    netloc = parser_key
+                url = 'http://{}/'.format(netloc)
+            yield parser_key, url, encoding, entry.path
+
+
+def parse_saved_pages(parser_key, items):
+    """Parse a chunk of (url, encoding, path) saved pages in a parsing process.
+
+    Returns a list of (url, Result, error)."""
+    pages = []
+    for url, encoding, path in items:
+        with open(path, 'rb') as file_:
+            pages.append((url, file_.read(), encoding))
+    parsed = parsepool.parse_pages(parser_key, pages)
+    return [(url, result, error) for (url, _, _), (result, error) in zip(pages, parsed)]
+
+
+def replay_pages(executor, directory, netlocs, chunk_size=100, max_pending=8):
+    """Parse the pages saved in the directory with the executor (see parsepool.make_pool).
+
+    Iterates over (url, Result, error) as the chunks are parsed. At most max_pending
+    chunks are submitted at once."""
+    chunks = {}
+    pending = set()
+
+    def submit(parser_key):
+        pending.add(executor.submit(parse_saved_pages, parser_key, chunks.pop(parser_key)))
+
+    def collect(return_when):
+        done, not_done = concurrent.futures.wait(pending, return_when=return_when)
+        pending.intersection_update(not_done)
+        for future in done:
+            yield from future.result()
+
+    for parser_key, url, encoding, path in iter_saved_pages(directory, netlocs):
+        chunk = chunks.setdefault(parser_key, [])
+        chunk.append((url, encoding, path))
+        if len(chunk) >= chunk_size:
+            submit(parser_key)
+            if len(pending) >= max_pending:
+                yield from collect(concurrent.futures.FIRST_COMPLETED)
+    for parser_key in list(chunks):
+        submit(parser_key)
+    yield from collect(concurrent.futures.ALL_COMPLETED)
@@ -1,35 +1,50 @@
-"""A script to apply a page parser to an HTML file.
+"""A script to apply a page parser to HTML files.
 
-Used for easier debugging and visual checks."""
+Used for easier debugging and visual checks. The terms of the files are extracted
+in batches of --chunk-size descriptions (see extract_terms_many)."""
 
 import argparse
-from jobtechs.parser import NETLOC_TO_PARSER_MAP, TermsExtractor
+from jobtechs.common import iter_chunks
+from jobtechs.parser import NETLOC_TO_PARSER_MAP, TERMS_EXTRACTORS
+# registers the mapped terms extractor
+import jobtechs.termsdb  # pylint: disable=unused-import
 
 def main():
     # pylint: disable=missing-docstring
     parser = argparse.ArgumentParser()
     parser.add_argument('parser_netloc', choices=list(NETLOC_TO_PARSER_MAP.keys()))
     parser.add_argument(
-        'infile', type=argparse.FileType('r'),
-        help='An HTML-file we are trying to apply the parser to.')
+        'infile', nargs='+', type=argparse.FileType('rb'),
+        help='HTML-files we are trying to apply the parser to.')
     parser.add_argument(
         '--techs-file', default='techs.txt',
         help='A file where the searched techs are listed: each tech on a separate line.')
+    parser.add_argument(
+        '--terms-engine', choices=list(TERMS_EXTRACTORS.keys()), default='automaton',
+        help='An implementation of the terms extractor.')
+    parser.add_argument(
+        '--chunk-size', type=int, default=100,
+        help='The number of files whose terms are extracted at once. Defaults to 100.')
 
     args = parser.parse_args()
 
     page_parser = NETLOC_TO_PARSER_MAP[args.parser_netloc]()
-    text = args.infile.read()
-    extractor = TermsExtractor(args.techs_file)
+    extractor = TERMS_EXTRACTORS[args.terms_engine](args.techs_file)
     url = ''
-    res, err = page_parser.parse_page(url, text, extractor)
-    if err:
-        print(err)
-    else:
-        print(res.url)
-        print(res.company)
-        print(*res.techs, sep=', ')
-        print(res.site)
+    # the files are read as their chunks are parsed
+    pages = ((url, infile.read(), None) for infile in args.infile)
+    results = (result for chunk in iter_chunks(pages, args.chunk_size)
+               for result in page_parser.parse_pages(chunk, extractor))
+    for infile, (res, err) in zip(args.infile, results):
+        if len(args.infile) > 1:
+            print('==>', infile.name, '<==')
+        if err:
+            print(err)
+        else:
+            print(res.url)
+            print(res.company)
+            print(*res.techs, sep=', ')
+            print(res.site)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,39 @@
+"""A script to compile a techs file into a binary terms dictionary.
+
+The dictionary is mapped into memory by the fetchers instead of loading the techs
+file into each of them (see jobtechs.termsdb). Pass it to extract_techs with
+--techs-file, it is detected by its format.
+"""
+
+import argparse
+import logging
+import sys
+import time
+
+from jobtechs.termsdb import compile_terms, read_terms, write_terms_db
+
+G_LOG = logging.getLogger(__name__)
+
+
+def main():
+    # pylint: disable=missing-docstring
+    parser = argparse.ArgumentParser(description=sys.modules[__name__].__doc__)
+    parser.add_argument(
+        'techs_file',
+        help='A file where the searched techs are listed: each tech on a separate line.')
+    parser.add_argument(
+        'output',
+        help='A file the compiled dictionary is written to, it is replaced atomically.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    start = time.time()
+    terms = read_terms(args.techs_file)
+    data = compile_terms(terms)
+    write_terms_db(data, args.output)
+    G_LOG.info('%d terms compiled into %s (%d bytes) in %.3f s',
+               len(terms), args.output, len(data), time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
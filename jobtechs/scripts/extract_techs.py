@@ -1,7 +1,8 @@
 """A script to generate a list of products we are interested in found in job descriptions.
 
-It takes a list of urls from infile (stdin by default) and returns a |-separated output
-for each url. The script requires a file with techs we are searching for, the file is
+It takes a list of urls from infile (stdin by default) and writes the found techs for
+each url to stdout or --output in one of --output-format formats (|-separated text
+by default). The script requires a file with techs we are searching for, the file is
 specified by --techs-file option. The urls that led to exceptions are written to a separate
 file, configured by --errors-file.
 """
@@ -9,68 +10,249 @@ file, configured by --errors-file.
 import argparse
 import logging
 import multiprocessing as mp
+import os
 import pathlib
+import signal
+import socket
 import sys
 import time
 import threading
+from collections import deque
 from urllib.parse import urlparse
 
-from jobtechs.common import iter_good_lines
-from jobtechs.fetcher import ThrottledFetcher
-from jobtechs.parser import NETLOC_TO_PARSER_MAP, TermsExtractor, PageParser
+from jobtechs import parsepool
+from jobtechs.parsepool import ParseWorker
+from jobtechs.asyncfetch import AsyncFetcher
+from jobtechs.cache import ResponseCache
+from jobtechs.common import get_qsize, iter_good_lines
+from jobtechs.dedup import ScalableBloomFilter
+from jobtechs.distributed import (
+    AUTHKEY_ENV, GlobalHostLimiter, GlobalRateLimits, RemoteSink, WorkQueue, connect, get_authkey,
+    parse_address, serve, stop_serving)
+from jobtechs.fetcher import SessionFactory, ThrottledFetcher
+from jobtechs.ledger import PARSED, Ledger
+from jobtechs.metrics import TIMINGS_HEADER, Metrics
+from jobtechs.parser import (
+    NETLOC_TO_PARSER_MAP, TERMS_EXTRACTORS, PageParser, canonicalize_url, get_external_job_url)
+from jobtechs.profiler import StackSampler, format_top, iter_parts, merge_profiles
+from jobtechs.replay import replay_pages
+from jobtechs.sharedterms import SharedTermsExtractor
+from jobtechs.sinks import COMPRESSORS, SINKS, open_sink
+from jobtechs.termsdb import is_terms_db
+from jobtechs.throttle import HostScheduler, TokenBucket
 
 G_LOG = logging.getLogger(__name__)
 
 class TechsExtractionRunner:
-    """Class containing the functionality of running the techs extraction process."""
-    # pylint: disable=no-self-use
+    """Class containing the functionality of running the techs extraction process.
 
-    def __init__(self, terms_path='techs.txt', errors_path='failed_urls.txt', save_pages_to=None):
+    The input urls are canonicalized (see canonicalize_url) and, if dedup is on,
+    the duplicates are skipped. The seen urls are kept in a Bloom filter, which
+    allows tens of millions of urls but may skip a new url with the probability
+    of dedup_error_rate.
+
+    External job descriptions found on the pages (e.g. an embedded Greenhouse job)
+    are requested in the same run, up to follow_depth links away from the input urls.
+    Each of them is requested once.
+
+    The queues between the runner, the fetchers and the writers hold at most
+    queue_size items each, so that the input is read as fast as the urls are
+    processed and the memory use does not depend on its size. The depths of
+    the queues are logged every stats_interval seconds (see queue_depths).
+
+    The terms extractor is shared by the fetcher processes (see SharedTermsExtractor)
+    and the terms file is checked for changes every terms_reload_interval seconds
+    (None checks it only on request_reload), a new version of the terms is
+    picked up by the fetchers without a restart.
+
+    The stages of processing the urls are timed by the fetchers and collected
+    into metrics (see jobtechs.metrics). Their summary is logged with the depths
+    of the queues, and they are written to metrics_path in the Prometheus text
+    format if it is given. The timings of every url are written to timings_path
+    as tab-separated lines if it is given.
+
+    The fetchers only request the pages, which are parsed by parse_workers
+    ParseWorker processes shared by all the fetchers, one per core by default,
+    so that parsing scales with the cores rather than with the number of
+    the fetchers. With parse_workers=0 (the default on a single core, where
+    passing the pages to another process gains nothing) the pages are parsed
+    by the fetcher threads requesting them.
+
+    If profile_path is given, all the processes of the run are sampled
+    (see StackSampler) and their samples are merged into the profile
+    at profile_path on close, the functions with the most samples are logged.
+    """
+    # pylint: disable=no-self-use,too-many-instance-attributes
+
+    # whether the urls are dispatched by the runner, which counts the pending ones
+    # and follows up the errors; otherwise the errors are final
+    dispatches_urls = True
+
+    def __init__(self, terms_path='techs.txt', errors_path='failed_urls.txt', save_pages_to=None,
+                 terms_engine='automaton', session_factory=None, max_rps=3, burst=1,
+                 host_rps=3, default_workers=20, cache=None, sink=None, ledger=None,
+                 follow_depth=1, dedup=True, dedup_error_rate=1e-6, queue_size=1000,
+                 stats_interval=60, terms_reload_interval=10, metrics_path=None,
+                 timings_path=None, profile_path=None, parse_workers=None):
+        # pylint: disable=too-many-arguments,too-many-locals
         self.save_pages_to = save_pages_to
+        self.queue_size = queue_size
+        self.ledger = ledger
+        self.follow_depth = follow_depth
+        # the depths of the followed urls by their canonical urls
+        self._followed = {}
+        self._seen = ScalableBloomFilter(error_rate=dedup_error_rate) if dedup else None
+        self._seen_lock = threading.Lock()
+        self.duplicates = 0
+        # the number of dispatched urls without a result or an error yet
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        # the followed urls waiting to be dispatched by the main thread
+        self._follow_ups = deque()
+        self.sink = sink if sink is not None else self.make_sink()
+        self.cache = cache
+        self.session_factory = session_factory or SessionFactory()
+        self.max_rps = max_rps
+        self.burst = burst
+        self.host_rps = host_rps
+        self.default_workers = default_workers
+        self._rate_limiters = {}
         self.terms_path = terms_path
+        self.terms_engine = terms_engine
         self.errors_path = errors_path
-        self._q_out = self._q_err = None
+        self.parse_workers = parse_workers
+        self._parse_workers = []
+        self._q_pages = None
+        self.terms_extractor = self.make_terms_extractor(terms_path)
+        self.terms_extractor.watch(terms_reload_interval)
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        self._timings_file = None
+        if timings_path:
+            self._timings_file = open(timings_path, 'w')
+            print(*TIMINGS_HEADER, sep='\t', file=self._timings_file)
+        self.profile_path = profile_path
+        if profile_path:
+            # left by an interrupted run
+            for part_path in iter_parts(profile_path):
+                os.remove(part_path)
+        self._q_out = self._q_err = self._q_metrics = None
         self._init_queues()
         self._fetchers = {}
         self._init_fetchers()
         self._writers = []
         self._init_writers()
+        # started after the fetcher processes, which sample themselves
+        self._sampler = None
+        if profile_path:
+            self._sampler = StackSampler('main')
+            self._sampler.start()
+        self.stats_interval = stats_interval
+        self._stats_stop = threading.Event()
+        self._stats_thread = None
+        if stats_interval > 0:
+            self._stats_thread = threading.Thread(target=self._log_stats, daemon=True)
+            self._stats_thread.start()
 
     def make_terms_extractor(self, terms_path):
-        """A factory method for instantiating a terms extractor."""
-        return TermsExtractor(terms_path)
+        """A factory method for instantiating a terms extractor shared by the fetchers."""
+        return SharedTermsExtractor(terms_path, TERMS_EXTRACTORS[self.terms_engine])
+
+    def request_terms_reload(self, *args):
+        """Reload the terms file in the fetchers, a handler of SIGHUP."""
+        # pylint: disable=unused-argument
+        # no logging here: the handler may interrupt a thread holding the logging lock
+        self.terms_extractor.request_reload()
+
+    def make_sink(self):
+        """A factory method for the default sink of the results: text lines to stdout."""
+        return open_sink()
 
     def make_queue(self):
         """A factory method for the queue."""
-        return mp.Queue()
+        return mp.Queue(self.queue_size)
 
     def _init_queues(self):
         self._q_out = self.make_queue()
         self._q_err = self.make_queue()
+        # the fetchers put a few items per second into it
+        self._q_metrics = mp.Queue()
 
-    def _init_fetchers(self):
-        terms_extractor = self.make_terms_extractor(self.terms_path)
-        # add specific parsers for job aggregators
-        self._fetchers = {
-            netloc:
-                ThrottledFetcher(
-                    parser=parser_cls(save_pages_to=self.save_pages_to),
-                    terms_extractor=terms_extractor,
-                    q_out=self._q_out, q_err=self._q_err,
-                    max_workers=5)
+    def get_rate_limiter(self, netloc):
+        """Return the rate limiter shared by all fetchers requesting the netloc.
+
+        Returns None if the requests are not limited."""
+        if self.max_rps <= 0:
+            return None
+        rate_limiter = self._rate_limiters.get(netloc)
+        if rate_limiter is None:
+            rate_limiter = self._rate_limiters[netloc] = TokenBucket(self.max_rps, self.burst)
+        return rate_limiter
+
+    def get_host_limiter(self):
+        """Return the limiter of the requests to every host shared by all fetchers.
+
+        Returns None, the hosts are limited by the fetchers (see HostScheduler)."""
+        return None
+
+    def make_parsers(self):
+        """Create parsers for job aggregators by netloc and a generic one by 'default' key."""
+        parsers = {
+            netloc: parser_cls(save_pages_to=self.save_pages_to)
             for netloc, parser_cls in NETLOC_TO_PARSER_MAP.items()
         }
         # add general parser for other pages
-        generic_parser = PageParser(
+        parsers['default'] = PageParser(
             save_pages_to=self.save_pages_to,
-            agg_parsers=[fetcher.parser for fetcher in self._fetchers.values()]
+            agg_parsers=list(parsers.values())
         )
-        self._fetchers['default'] = \
-            ThrottledFetcher(
-                parser=generic_parser,
-                terms_extractor=terms_extractor,
+        return parsers
+
+    def _init_parse_workers(self, parsers):
+        num_workers = self.parse_workers
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+            if num_workers == 1:
+                num_workers = 0
+        if num_workers <= 0:
+            return
+        # a few pages per worker, the pages may take megabytes
+        self._q_pages = mp.Queue(4 * num_workers)
+        self._parse_workers = [
+            ParseWorker(parsers, self.terms_extractor, self._q_pages, self._q_out, self._q_err,
+                        q_metrics=self._q_metrics, trace_urls=self._timings_file is not None,
+                        profile_path=self.profile_path)
+            for _ in range(num_workers)
+        ]
+        for worker in self._parse_workers:
+            worker.start()
+
+    def _init_fetchers(self):
+        # add specific parsers for job aggregators limited by a shared rate limiter,
+        # other sites are scheduled by their hosts each limited to host_rps
+        self._fetchers = {}
+        parsers = self.make_parsers()
+        self._init_parse_workers(parsers)
+        host_limiter = self.get_host_limiter()
+        for netloc, parser in parsers.items():
+            if netloc == 'default':
+                rate_limiter = None
+                scheduler = HostScheduler(host_rps=self.host_rps, initial_concurrency=2,
+                                          max_queued=self.queue_size)
+                max_workers = self.default_workers
+            else:
+                rate_limiter = self.get_rate_limiter(netloc)
+                scheduler = HostScheduler(initial_concurrency=2, max_queued=self.queue_size)
+                max_workers = 5
+            self._fetchers[netloc] = ThrottledFetcher(
+                parser=parser,
+                terms_extractor=self.terms_extractor,
                 q_out=self._q_out, q_err=self._q_err,
-                max_workers=5, max_rps=0)
+                max_workers=max_workers, max_rps=0, rate_limiter=rate_limiter,
+                scheduler=scheduler, session_factory=self.session_factory, cache=self.cache,
+                queue_size=self.queue_size, q_metrics=self._q_metrics,
+                trace_urls=self._timings_file is not None, profile_path=self.profile_path,
+                q_pages=self._q_pages, host_limiter=host_limiter)
 
         for fetcher in self._fetchers.values():
             fetcher.start()
@@ -80,7 +262,14 @@ class TechsExtractionRunner:
             result = q_out.get()
             if not result:
                 break
-            print(result)
+            started = time.perf_counter()
+            self.sink.write(result)
+            self.metrics.observe('write', time.perf_counter() - started)
+            if self.ledger:
+                self.ledger.mark_parsed(result.url)
+            if self.dispatches_urls:
+                self._task_done()
+        self.sink.close()
 
     def _write_errors(self, q_err, errors_path):
         with open(errors_path, 'w') as errors_file:
@@ -88,47 +277,222 @@ class TechsExtractionRunner:
                 result = q_err.get()
                 if not result:
                     break
-                print(*result, sep='\t', file=errors_file)
+                new_url = self.follow_up(*result) if self.dispatches_urls else None
+                if new_url:
+                    self._follow(new_url)
+                elif new_url is None:
+                    print(*result, sep='\t', file=errors_file)
+                    if self.ledger:
+                        self.ledger.mark_failed(*result)
+                if self.dispatches_urls:
+                    self._task_done()
+
+    def _add_trace(self, trace):
+        """Record the finished trace of a url processed in this process."""
+        self.metrics.record(trace)
+        if self._timings_file:
+            print(*trace.to_row(), sep='\t', file=self._timings_file)
+
+    def _collect_metrics(self, q_metrics):
+        while True:
+            state = q_metrics.get()
+            if not state:
+                break
+            self.metrics.merge(state)
+            if self._timings_file:
+                for row in state.get('traces', ()):
+                    print(*row, sep='\t', file=self._timings_file)
 
     def _init_writers(self):
         self._writers = [
             threading.Thread(target=self._write_results, args=(self._q_out,)),
             threading.Thread(target=self._write_errors, args=(self._q_err, self.errors_path)),
+            threading.Thread(target=self._collect_metrics, args=(self._q_metrics,)),
         ]
 
         for writer in self._writers:
             writer.start()
 
+    def follow_up(self, url, error):
+        """Decide whether to request the external job description reported by the error.
+
+        Returns the url of the job description to request, '' if it is already requested
+        (or parsed by an earlier run) and None if the error is not followed."""
+        new_url = get_external_job_url(error)
+        if new_url is None:
+            return None
+        target = canonicalize_url(new_url)
+        with self._seen_lock:
+            depth = self._followed.get(url, 0) + 1
+            if depth > self.follow_depth:
+                return None
+            if target in self._followed or (self._seen is not None and self._seen.add(target)):
+                new_url = ''
+            else:
+                self._followed[target] = depth
+                new_url = target
+        if self.ledger:
+            # a resumed run skips the page once the job description is parsed
+            self.ledger.mark_followed(url, target)
+            if new_url and self.ledger.get_state(new_url)[0] == PARSED:
+                new_url = ''
+        G_LOG.info('following %s found on %s', new_url or 'a requested url', url)
+        return new_url
+
+    def _route(self, url):
+        fetcher = self._fetchers.get(urlparse(url).netloc, self._fetchers['default'])
+        # blocks while the input queue of the fetcher is full
+        fetcher.q_in.put(url)
+
+    def _dispatch(self, url):
+        with self._pending_cond:
+            self._pending += 1
+        self._route(url)
+
+    def _follow(self, url):
+        # the errors writer must not block on a full input queue: the fetcher may be
+        # waiting for room in the errors queue, hence the main thread dispatches the url
+        with self._pending_cond:
+            self._pending += 1
+            self._follow_ups.append(url)
+            self._pending_cond.notify_all()
+
+    def _dispatch_follow_ups(self):
+        while self._follow_ups:
+            self._route(self._follow_ups.popleft())
+
+    def _task_done(self):
+        with self._pending_cond:
+            self._pending -= 1
+            if self._pending <= 0:
+                self._pending_cond.notify_all()
+
+    def _iter_unseen(self, urls):
+        for url in urls:
+            with self._seen_lock:
+                seen = self._seen.add(url)
+            if seen:
+                self.duplicates += 1
+                continue
+            yield url
+
+    def iter_urls(self, infile):
+        """Iterate over the canonical urls of the infile.
+
+        The duplicates are skipped unless dedup is off, the urls parsed by an earlier run
+        are skipped if there is a ledger."""
+        urls = (canonicalize_url(url) for url in iter_good_lines(infile))
+        if self._seen is not None:
+            urls = self._iter_unseen(urls)
+        if self.ledger:
+            urls = self.ledger.iter_unfinished(urls)
+        return urls
+
     def run(self, infile):
         """Process urls from the infile.
 
         The method can be run several times (for several files)."""
-        fetchers = self._fetchers
-        default_fetcher = fetchers['default']
-
-        for url in iter_good_lines(infile):
-            urlp = urlparse(url)
-            fetcher = fetchers.get(urlp.netloc, default_fetcher)
-            fetcher.q_in.put(url)
+        for url in self.iter_urls(infile):
+            self._dispatch_follow_ups()
+            self._dispatch(url)
 
-        for fetcher in fetchers.values():
-            fetcher.q_in.join()
+        # the followed urls are dispatched as the errors come, hence waiting for
+        # the results and the errors of all the urls rather than for the queues
+        while True:
+            self._dispatch_follow_ups()
+            with self._pending_cond:
+                self._pending_cond.wait_for(lambda: self._pending <= 0 or self._follow_ups)
+                if self._pending <= 0:
+                    break
 
         G_LOG.info('finished processing urls')
 
+    def queue_depths(self):
+        """Return a dict from queue names to the numbers of items in them.
+
+        'in <netloc>' are the input queues of the fetchers, 'pages' holds the fetched
+        pages waiting for the parsing processes, 'out' and 'err' are
+        the results and the errors waiting for the writers and 'pending' (if the runner
+        dispatches the urls) is the number of dispatched urls without a result or an error
+        yet, including the ones in the queues. A depth is None if the platform can not
+        tell it. A full queue is a sign that its consumer is the bottleneck."""
+        depths = {'pending': self._pending} if self.dispatches_urls else {}
+        for netloc, fetcher in self._fetchers.items():
+            depths['in ' + netloc] = get_qsize(fetcher.q_in)
+        if self._q_pages is not None:
+            depths['pages'] = get_qsize(self._q_pages)
+        depths['out'] = get_qsize(self._q_out)
+        depths['err'] = get_qsize(self._q_err)
+        return depths
+
+    def write_metrics(self):
+        """Write the metrics and the depths of the queues to metrics_path, if it is given."""
+        if self.metrics_path:
+            self.metrics.write_prometheus(self.metrics_path, self.queue_depths())
+
+    def _log_stats(self):
+        while not self._stats_stop.wait(self.stats_interval):
+            G_LOG.info('queue depths (max %d): %s', self.queue_size, ', '.join(
+                '{} {}'.format(name, depth) for name, depth in self.queue_depths().items()))
+            G_LOG.info('stages: %s', self.metrics.summary())
+            self.write_metrics()
+
     def close(self):
         """Release resources by sending messages to subprocesses and threads
         that there is no more urls to process.
         """
+        self._stats_stop.set()
+        if self._stats_thread:
+            self._stats_thread.join()
         # signal to fetchers
         for fetcher in self._fetchers.values():
             fetcher.q_in.put(None)
             fetcher.q_in.join()
+        for _ in self._parse_workers:
+            self._q_pages.put(None)
+        for worker in self._parse_workers:
+            worker.join()
 
         # signal to writers
         self._q_out.put(None)
         self._q_err.put(None)
+        self._q_metrics.put(None)
         G_LOG.info('poison pills sent to subprocesses and threads.')
+        for writer in self._writers:
+            writer.join()
+        G_LOG.info('%d results written', self.sink.rows)
+        G_LOG.info('stages: %s', self.metrics.summary())
+        self.write_metrics()
+        if self._timings_file:
+            self._timings_file.close()
+        if self._seen is not None:
+            G_LOG.info('%d duplicate urls skipped, %d urls seen in %d bytes',
+                       self.duplicates, len(self._seen), self._seen.size)
+        if self.ledger:
+            G_LOG.info('ledger %s: %d urls skipped as parsed earlier, states %s',
+                       self.ledger.path, self.ledger.skipped, self.ledger.counts())
+            self.ledger.close()
+
+        for netloc, fetcher in self._fetchers.items():
+            G_LOG.info('fetcher %s: %d requests sent, %d new connections, %d reused',
+                       netloc, fetcher.requests_sent.value, fetcher.connections_new.value,
+                       fetcher.connections_reused)
+        for netloc, rate_limiter in self._rate_limiters.items():
+            G_LOG.info('rate limit %s: configured %.2f rps, achieved %.2f rps',
+                       netloc, rate_limiter.rate, rate_limiter.achieved_rate)
+
+        if self.cache:
+            self.cache.prune()
+
+        G_LOG.info('terms version %d used', self.terms_extractor.version)
+        self.terms_extractor.close()
+
+        if self._sampler:
+            self._sampler.stop()
+            self._sampler.save(self.profile_path)
+            counts = merge_profiles(self.profile_path)
+            G_LOG.info('profile of %d samples written to %s, the busiest functions:\n%s',
+                       sum(counts.values()), self.profile_path, format_top(counts))
 
     @classmethod
     def main2(cls):
@@ -139,15 +503,99 @@ class TechsExtractionRunner:
             '--techs-file', type=pathlib.Path, default='techs.txt',
             help=('A file where the searched techs are listed: each tech on a separate line. '
                   'Defaults to techs.txt.'))
+        parser.add_argument(
+            '--terms-engine', choices=list(TERMS_EXTRACTORS.keys()), default='automaton',
+            help=('An implementation of the terms extractor: n-gram matching, a single pass '
+                  'with an Aho-Corasick automaton or the automaton read in place from a compiled '
+                  'dictionary (see jobtechs.scripts.compile_terms), which is used for a compiled '
+                  '--techs-file. Defaults to automaton.'))
+        parser.add_argument(
+            '--terms-reload-interval', type=float, default=10,
+            help=('Check the techs file for changes every number of seconds and pick up '
+                  'a changed one without a restart, 0 reloads it only on SIGHUP. '
+                  'Defaults to 10.'))
         parser.add_argument(
             'infile', nargs='*', type=argparse.FileType('r'), default=[sys.stdin],
             help=('A file or a list of files with a list of urls. Each url is supposed '
                   'to contain a job description. Defaults to stdin.'))
+        parser.add_argument(
+            '--output', default='-',
+            help='A file the results are written to. Defaults to stdout.')
+        parser.add_argument(
+            '--output-format', choices=list(SINKS.keys()), default='text',
+            help=('The format of the results: |-separated text lines, json lines, csv or '
+                  'a compact columnar binary format keeping term ids (see jobtechs.sinks). '
+                  'Defaults to text.'))
+        parser.add_argument(
+            '--output-compression', choices=list(COMPRESSORS.keys()),
+            help='Compress the results. By default the results are not compressed.')
+        parser.add_argument(
+            '--output-batch-size', type=int, default=1000,
+            help='The number of results buffered before writing. Defaults to 1000.')
         parser.add_argument(
             '--errors-file', type=pathlib.Path, default='failed_urls.txt',
             help=('A tab-separated file to which we are going to dump urls requesting or parsing '
                   'of which resulted in an error. The error message is dumped after the url. '
                   'Defaults to failed_urls.txt.'))
+        parser.add_argument(
+            '--ledger',
+            help=('An SQLite database recording the state of every url. A run with the same '
+                  'ledger skips the urls parsed earlier and retries the failed ones, so that '
+                  'an interrupted run can be resumed. By default there is no ledger.'))
+        parser.add_argument(
+            '--no-dedup', dest='dedup', action='store_false',
+            help=('Request duplicate urls. By default the urls are canonicalized and '
+                  'the duplicates are skipped.'))
+        parser.add_argument(
+            '--dedup-error-rate', type=float, default=1e-6,
+            help=('The probability of taking a new url for a duplicate, the lower it is, the more '
+                  'memory the seen urls take. Defaults to 1e-6.'))
+        parser.add_argument(
+            '--follow-depth', type=int, default=1,
+            help=('Request external job descriptions found on the pages (e.g. embedded '
+                  'Greenhouse jobs) up to the number of links away from the input urls, '
+                  '0 reports them to --errors-file instead. Defaults to 1.'))
+        parser.add_argument(
+            '--queue-size', type=int, default=1000,
+            help=('The number of urls, results or errors each queue between the input, '
+                  'the fetchers and the writers holds. The input is read as fast as the urls '
+                  'are processed. 0 means unbounded queues. Defaults to 1000.'))
+        parser.add_argument(
+            '--stats-interval', type=float, default=60,
+            help=('Log the depths of the queues and the mean times of the processing stages '
+                  'every number of seconds, 0 turns it off. Defaults to 60.'))
+        parser.add_argument(
+            '--metrics-file',
+            help=('Write the times of the processing stages (fetching, parsing, matching, '
+                  'writing), the numbers of urls and bytes fetched and the depths of the queues '
+                  'to the file in the Prometheus text format, every --stats-interval seconds '
+                  'and at the end. By default the metrics are only logged.'))
+        parser.add_argument(
+            '--timings-file',
+            help=('Write the times of the processing stages of every url to the file '
+                  'as tab-separated lines. By default they are not written.'))
+        parser.add_argument(
+            '--profile', metavar='FILE',
+            help=('Sample the stacks of the threads of all the processes (the fetchers, '
+                  'the parsing pool and the main one) every 10 ms and write them merged '
+                  'to the file in the collapsed stacks format of flamegraph.pl and speedscope. '
+                  'The functions with the most samples are logged. By default the run '
+                  'is not profiled.'))
+        parser.add_argument(
+            '--coordinator', metavar='HOST:PORT',
+            help=('Serve the urls of infile to --worker processes on other hosts at the address '
+                  'and write their results. The rate limits hold for the requests of all '
+                  'the workers together. The coordinator and the workers share the secret '
+                  'in the {} environment variable and the techs file. By default the urls '
+                  'are processed by this process.'.format(AUTHKEY_ENV)))
+        parser.add_argument(
+            '--worker', metavar='HOST:PORT',
+            help=('Process the urls of the --coordinator at the address instead of infile '
+                  'until it finishes, the results are sent to the coordinator.'))
+        parser.add_argument(
+            '--lease-timeout', type=float, default=60,
+            help=('The number of seconds after which the urls of a silent worker '
+                  'are given to other workers. Defaults to 60.'))
         parser.add_argument(
             '--log-file', type=argparse.FileType('a'), default='extract_techs.log',
             help='A file where we write logs to. Defaults to extract_techs.log.')
@@ -155,12 +603,71 @@ class TechsExtractionRunner:
             '--save-pages-to',
             help=('Save copies of the html into the specified directory. '
                   'By default html-files are not saved.'))
+        parser.add_argument(
+            '--from-pages', metavar='DIR',
+            help=('Parse the pages saved with --save-pages-to into the directory instead of '
+                  'fetching the urls from infile.'))
+        parser.add_argument(
+            '--parse-workers', type=int,
+            help=('The number of processes parsing the pages, the fetchers only request them. '
+                  'With --engine=processes 0 parses the pages in the threads requesting them, '
+                  'which is the default on a single core. Defaults to the number of cores.'))
+        parser.add_argument(
+            '--engine', choices=['processes', 'asyncio'], default='processes',
+            help=('processes: a fetcher process with a pool of threads for each job aggregator '
+                  'and one for other sites and a pool of processes parsing the pages; asyncio: '
+                  'a single event loop for fetching and a pool of processes for parsing '
+                  '(requires aiohttp). Defaults to processes.'))
+        parser.add_argument(
+            '--max-rps', type=float, default=3,
+            help=('The limit of requests per second to each job aggregator site, '
+                  '0 turns the limit off. Defaults to 3.'))
+        parser.add_argument(
+            '--burst', type=int, default=1,
+            help=('The number of requests to a job aggregator site that can be sent at once '
+                  'after a pause. Defaults to 1.'))
+        parser.add_argument(
+            '--host-rps', type=float, default=3,
+            help=('The initial limit of requests per second to each of other sites, '
+                  'it is lowered if a site asks to slow down. 0 turns the limit off. '
+                  'Defaults to 3.'))
+        parser.add_argument(
+            '--default-workers', type=int, default=20,
+            help='The number of threads requesting other sites. Defaults to 20.')
+        parser.add_argument(
+            '--cache-dir',
+            help=('Cache responses in the specified directory and reuse them on later runs. '
+                  'By default responses are not cached.'))
+        parser.add_argument(
+            '--cache-ttl', type=float, default=7*24*3600,
+            help=('The number of seconds a cached response is used without revalidation, '
+                  'older ones are revalidated by conditional requests. Defaults to a week.'))
+        parser.add_argument(
+            '--cache-max-size', type=int, default=0,
+            help=('The limit of the cache size in megabytes, the oldest responses are evicted '
+                  'at the end of the run. By default the size is not limited.'))
+        parser.add_argument(
+            '--pool-size', type=int, default=10,
+            help=('The number of hosts each fetcher thread keeps connections alive for. '
+                  'Defaults to 10.'))
+        parser.add_argument(
+            '--connect-timeout', type=float, default=10,
+            help='Timeout in seconds for establishing a connection. Defaults to 10.')
+        parser.add_argument(
+            '--read-timeout', type=float, default=30,
+            help='Timeout in seconds for reading the response. Defaults to 30.')
+        parser.add_argument(
+            '--retries', type=int, default=2,
+            help=('The number of retries on connection errors and 429/5xx responses. '
+                  'Defaults to 2.'))
 
         args = parser.parse_args()
         if not args.techs_file.exists():
             parser.error(
                 ('The file with techs {} does not exist. '
                  'Use --techs-file option').format(args.techs_file.as_posix()))
+        if is_terms_db(args.techs_file.as_posix()):
+            args.terms_engine = 'mapped'
 
         try:
             with args.errors_file.open('w'):
@@ -168,6 +675,28 @@ class TechsExtractionRunner:
         except IOError:
             parser.error('Can not open {} for writing.'.format(args.errors_path.as_posix()))
 
+        if args.output_format == 'columnar' and args.output == '-' and sys.stdout.isatty():
+            parser.error('The columnar format is binary, use --output.')
+
+        if args.from_pages:
+            if not os.path.isdir(args.from_pages):
+                parser.error('The directory {} does not exist.'.format(args.from_pages))
+            if args.save_pages_to:
+                parser.error('--save-pages-to can not be used with --from-pages.')
+
+        authkey = None
+        if args.coordinator or args.worker:
+            if args.coordinator and args.worker:
+                parser.error('--coordinator can not be used with --worker.')
+            if args.from_pages:
+                parser.error('--from-pages can not be used with --coordinator or --worker.')
+            if args.worker and args.engine != 'processes':
+                parser.error('--worker requires --engine=processes.')
+            try:
+                authkey = get_authkey()
+            except RuntimeError as err:
+                parser.error(str(err))
+
         if args.save_pages_to:
             save_pages_to = pathlib.Path(args.save_pages_to)
             save_pages_to.mkdir(parents=True, exist_ok=True)
@@ -176,19 +705,323 @@ class TechsExtractionRunner:
 
         start = time.time()
 
-        runner = TechsExtractionRunner(
-            terms_path=args.techs_file.as_posix(),
-            errors_path=args.errors_file.as_posix(),
-            save_pages_to=args.save_pages_to)
+        cache = None
+        if args.cache_dir:
+            cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl,
+                                  max_size=args.cache_max_size * 1024 * 1024)
 
-        for file_ in args.infile:
-            runner.run(file_)
+        sink = ledger = None
+        # the results of a worker are written by the coordinator
+        if not args.worker:
+            sink = open_sink(args.output_format, args.output, args.output_compression,
+                             args.output_batch_size)
+            ledger = Ledger(args.ledger) if args.ledger else None
 
-        runner.close()
+        if args.from_pages:
+            runner = PagesReplayRunner(
+                parse_workers=args.parse_workers,
+                terms_path=args.techs_file.as_posix(),
+                errors_path=args.errors_file.as_posix(),
+                terms_engine=args.terms_engine,
+                sink=sink, ledger=ledger, queue_size=args.queue_size,
+                stats_interval=args.stats_interval, terms_reload_interval=None,
+                metrics_path=args.metrics_file, profile_path=args.profile)
+            runner.run(args.from_pages)
+            runner.close()
+        else:
+            runner_cls = RUNNERS[args.engine]
+            kwargs = {}
+            if args.coordinator:
+                runner_cls = CoordinatorRunner
+                kwargs = dict(address=parse_address(args.coordinator), authkey=authkey,
+                              lease_timeout=args.lease_timeout)
+            elif args.worker:
+                runner_cls = WorkerRunner
+                kwargs = dict(address=parse_address(args.worker), authkey=authkey)
+            runner = runner_cls(
+                parse_workers=args.parse_workers,
+                terms_path=args.techs_file.as_posix(),
+                errors_path=args.errors_file.as_posix(),
+                save_pages_to=args.save_pages_to,
+                terms_engine=args.terms_engine,
+                max_rps=args.max_rps, burst=args.burst,
+                host_rps=args.host_rps, default_workers=args.default_workers,
+                cache=cache, sink=sink, ledger=ledger, follow_depth=args.follow_depth,
+                dedup=args.dedup, dedup_error_rate=args.dedup_error_rate,
+                queue_size=args.queue_size, stats_interval=args.stats_interval,
+                terms_reload_interval=args.terms_reload_interval or None,
+                metrics_path=args.metrics_file, timings_path=args.timings_file,
+                profile_path=args.profile,
+                session_factory=SessionFactory(
+                    pool_connections=args.pool_size,
+                    connect_timeout=args.connect_timeout, read_timeout=args.read_timeout,
+                    retries=args.retries),
+                **kwargs)
+            if args.worker:
+                runner.run()
+            else:
+                # the terms of a distributed run must stay the same
+                if hasattr(signal, 'SIGHUP') and not args.coordinator:
+                    signal.signal(signal.SIGHUP, runner.request_terms_reload)
+                for file_ in args.infile:
+                    runner.run(file_)
+
+            runner.close()
 
         end = time.time()
         G_LOG.info('The execution of the script took {:0.3f}.'.format(end-start))
 
 
+class AsyncTechsExtractionRunner(TechsExtractionRunner):
+    """The runner fetching the urls in a single asyncio event loop.
+
+    The pages are parsed in a pool of processes (see AsyncFetcher), which as well
+    follows up the errors."""
+    dispatches_urls = False
+
+    def _init_fetchers(self):
+        self._fetcher = AsyncFetcher(
+            self.make_parsers(), self.terms_extractor,
+            q_out=self._q_out, q_err=self._q_err, host_rps=self.host_rps,
+            parse_workers=self.parse_workers, session_factory=self.session_factory,
+            rate_limiter_factory=self.get_rate_limiter, cache=self.cache,
+            follow_up=self.follow_up, on_trace=self._add_trace, profile_path=self.profile_path)
+
+    def run(self, infile):
+        """Process urls from the infile.
+
+        The method can be run several times (for several files)."""
+        self._fetcher.run(self.iter_urls(infile))
+        G_LOG.info('finished processing urls')
+
+    def queue_depths(self):
+        """Return a dict from queue names to the numbers of items in them.
+
+        'in flight' is the number of urls processed in the event loop."""
+        depths = super().queue_depths()
+        depths['in flight'] = self._fetcher.in_flight
+        return depths
+
+    def close(self):
+        """Release resources by stopping the parsing processes and the writers."""
+        self._fetcher.close()
+        super().close()
+
+
+class PagesReplayRunner(TechsExtractionRunner):
+    """The runner re-parsing pages saved with --save-pages-to instead of fetching urls.
+
+    The pages are parsed in chunks by a pool of processes, one per core by default."""
+    dispatches_urls = False
+
+    def __init__(self, parse_workers=None, chunk_size=100, **kwargs):
+        self.chunk_size = chunk_size
+        kwargs['save_pages_to'] = None
+        # there is nothing to request
+        kwargs['follow_depth'] = 0
+        super().__init__(parse_workers=parse_workers or os.cpu_count(), **kwargs)
+
+    def _init_fetchers(self):
+        self._executor = parsepool.make_pool(
+            self.make_parsers(), self.terms_extractor, self.parse_workers, self.profile_path)
+
+    def run(self, directory):
+        """Parse the pages saved in the directory.
+
+        The method can be run several times (for several directories)."""
+        for url, result, error in replay_pages(
+                self._executor, directory, NETLOC_TO_PARSER_MAP.keys(),
+                chunk_size=self.chunk_size, max_pending=2 * self.parse_workers):
+            if error:
+                self._q_err.put((url, error))
+            else:
+                self._q_out.put(result)
+        G_LOG.info('finished parsing pages from %s', directory)
+
+    def close(self):
+        """Release resources by stopping the parsing processes and the writers."""
+        self._executor.shutdown()
+        super().close()
+
+
+class CoordinatorRunner(TechsExtractionRunner):
+    """The runner of a distributed run serving the urls to WorkerRunner processes.
+
+    The urls of infile are read, deduplicated and followed up as by the other
+    runners, but they are put into a WorkQueue served at address (see
+    jobtechs.distributed) instead of the fetchers. The workers on any number
+    of hosts take the urls, put the results and the errors back and the
+    coordinator writes them to the sink, the errors file and the ledger.
+
+    The rate limits (max_rps, burst and host_rps) hold for the requests
+    of all the workers together: every request waits for a time slot reserved
+    by the coordinator. A worker silent for lease_timeout seconds is considered
+    lost and its urls are given to other workers.
+
+    The workers have to use the same terms file, which is not reloaded in this mode.
+    """
+
+    def __init__(self, address, authkey, lease_timeout=60, **kwargs):
+        self.address = address
+        self.authkey = authkey
+        self.lease_timeout = lease_timeout
+        self._work = self._limits = self._server = None
+        self._expire_stop = threading.Event()
+        self._expire_thread = None
+        # the workers check that they use the same terms by the digest
+        kwargs['terms_reload_interval'] = None
+        super().__init__(**kwargs)
+
+    def _init_fetchers(self):
+        self._work = WorkQueue(self._q_out, self._q_err, self.queue_size, self.lease_timeout,
+                               info={'terms_digest': self.terms_extractor.vocabulary.digest})
+        self._limits = GlobalRateLimits(self.max_rps, self.burst, self.host_rps)
+        self._server = serve(self._work, self._limits, self.address, self.authkey)
+        G_LOG.info('serving the urls to the workers at %s:%d', *self._server.address)
+        self._expire_thread = threading.Thread(target=self._expire, daemon=True)
+        self._expire_thread.start()
+
+    def _expire(self):
+        while not self._expire_stop.wait(self.lease_timeout / 4):
+            self._work.expire()
+
+    def _route(self, url):
+        # blocks while queue_size urls wait for the workers
+        self._work.put(url)
+
+    def queue_depths(self):
+        """Return a dict from queue names to the numbers of items in them.
+
+        'urls' are the urls waiting for the workers, 'workers' is the number of them."""
+        depths = super().queue_depths()
+        depths['urls'] = self._work.qsize()
+        depths['workers'] = self._work.workers()
+        return depths
+
+    def close(self):
+        """Let the workers finish, stop serving and release resources."""
+        self._work.finish()
+        # the workers leave when they take no more urls
+        deadline = time.monotonic() + self.lease_timeout
+        while self._work.workers() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._expire_stop.set()
+        self._expire_thread.join()
+        stop_serving(self._server)
+        super().close()
+        for netloc, count in sorted(self._limits.counts().items()):
+            G_LOG.info('host %s: %d requests by the workers', netloc, count)
+
+
+class WorkerRunner(TechsExtractionRunner):
+    """The runner of a distributed run processing the urls of a CoordinatorRunner.
+
+    The urls are taken from the coordinator at address, up to queue_size
+    at a time, and processed by the fetchers and the parsing processes
+    as by TechsExtractionRunner. The results and the errors are put back
+    to the coordinator, which writes them and follows up the external job
+    descriptions. The requests wait for the time slots of their hosts reserved
+    by the coordinator, the hosts are still slowed down on 429/503 responses
+    by the fetchers (see HostScheduler). The worker is known to the coordinator
+    by worker_id, the host name and the process id by default.
+    """
+
+    def __init__(self, address, authkey, worker_id=None, **kwargs):
+        self.worker_id = worker_id or '{}-{}'.format(socket.gethostname(), os.getpid())
+        # the proxies are passed to the fetcher processes
+        self._work, limits = connect(address, authkey)
+        self._host_limiter = GlobalHostLimiter(limits)
+        info = self._work.info()
+        self.lease_timeout = info['lease_timeout']
+        self._terms_digest = info['terms_digest']
+        self.errors_sent = 0
+        kwargs.update(
+            sink=RemoteSink(self._work, self.worker_id),
+            # the coordinator limits the requests, deduplicates and follows up the urls
+            max_rps=0, host_rps=0, ledger=None, dedup=False, terms_reload_interval=None)
+        super().__init__(**kwargs)
+        self._heartbeat_stop = threading.Event()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._heartbeat_thread.start()
+
+    def _init_fetchers(self):
+        digest = self.terms_extractor.vocabulary.digest
+        if digest != self._terms_digest:
+            self.terms_extractor.close()
+            raise RuntimeError('The terms of the worker {} differ from the terms of '
+                               'the coordinator {}.'.format(digest, self._terms_digest))
+        super()._init_fetchers()
+
+    def get_host_limiter(self):
+        """Return the limiter waiting for the time slots reserved by the coordinator."""
+        return self._host_limiter
+
+    def _heartbeat(self):
+        while not self._heartbeat_stop.wait(self.lease_timeout / 4):
+            try:
+                self._work.heartbeat(self.worker_id)
+            except (EOFError, ConnectionError):
+                G_LOG.error('the coordinator is gone')
+                return
+
+    def _write_errors(self, q_err, errors_path):
+        while True:
+            result = q_err.get()
+            if not result:
+                break
+            try:
+                if self._work.put_error(self.worker_id, *result):
+                    self.errors_sent += 1
+            except (EOFError, ConnectionError):
+                G_LOG.error('the coordinator is gone, error of %s dropped', result[0])
+            self._task_done()
+
+    def _task_done(self):
+        with self._pending_cond:
+            self._pending -= 1
+            # run waits for room as well
+            self._pending_cond.notify_all()
+
+    def run(self, infile=None):
+        """Process the urls of the coordinator until it finishes the run.
+
+        infile is ignored, the coordinator reads the urls."""
+        # pylint: disable=unused-argument,arguments-differ
+        try:
+            while True:
+                if self.queue_size > 0:
+                    with self._pending_cond:
+                        self._pending_cond.wait_for(lambda: self._pending < self.queue_size)
+                url = self._work.take(self.worker_id, 1.)
+                if url is not None:
+                    self._dispatch(url)
+                elif self._work.is_finished():
+                    break
+        except (EOFError, ConnectionError):
+            G_LOG.error('the coordinator is gone')
+        with self._pending_cond:
+            self._pending_cond.wait_for(lambda: self._pending <= 0)
+        G_LOG.info('finished processing urls')
+
+    def close(self):
+        """Release resources and leave the coordinator."""
+        super().close()
+        self._heartbeat_stop.set()
+        self._heartbeat_thread.join()
+        G_LOG.info('%d errors sent, %d results dropped (expired leases)',
+                   self.errors_sent, self.sink.dropped)
+        try:
+            self._work.leave(self.worker_id)
+        except (EOFError, ConnectionError):
+            pass
+
+
+# runner classes by the --engine option
+RUNNERS = {
+    'processes': TechsExtractionRunner,
+    'asyncio': AsyncTechsExtractionRunner,
+}
+
+
 if __name__ == '__main__':
     TechsExtractionRunner.main2()
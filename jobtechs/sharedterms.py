@@ -0,0 +1,221 @@
+"""The module implements a terms extractor shared by the fetcher processes and
+reloaded in all of them when the terms file changes.
+
+The main process builds the extractor once and saves it pickled into a snapshot
+file, the other processes load the snapshot instead of building the extractor
+from the terms file. The number of the current snapshot is kept in shared memory:
+every process checks it once per page and the first thread noticing a newer
+snapshot loads it, while the other threads keep parsing with the extractor
+they have. A page is parsed with a single version of the terms
+(see TermsExtractor.current).
+
+A MappedTermsExtractor is published as a copy of its compiled dictionary, which
+all the processes map, so that the pages of the dictionary are kept in memory once.
+
+The vocabulary of a new version is registered in the main process before
+the version is published, so that the results referencing it by its digest
+can be unpickled there (see Result). Only the current and the previous
+versions are kept: the snapshots and the registered vocabularies of older
+ones are dropped, so that a long run reloading the terms does not grow.
+"""
+
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+
+from jobtechs.parser import AutomatonTermsExtractor, Vocabulary
+from jobtechs.termsdb import MappedTermsExtractor
+
+G_LOG = logging.getLogger(__name__)
+
+
+class SharedTermsExtractor:
+    """A terms extractor of the terms file reloaded in all processes when the file changes.
+
+    extractor_cls builds an extractor of the terms file (see TERMS_EXTRACTORS).
+    The snapshots are saved into directory, a temporary directory by default.
+    Only the process creating the instance reads the terms file: check_terms
+    publishes a new version if the file changed, watch runs it periodically
+    in a thread. The extraction methods delegate to the current extractor.
+    """
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, terms_filename, extractor_cls=AutomatonTermsExtractor, directory=None):
+        self.terms_filename = terms_filename
+        self.extractor_cls = extractor_cls
+        self._own_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix='jobtechs-terms-')
+        # the number of the current snapshot
+        self._version = mp.RawValue('Q', 0)
+        self._extractor = None
+        # the extractor of the previous version, kept for the pages parsed meanwhile
+        self._previous = None
+        self._loaded = 0
+        self._load_lock = threading.Lock()
+        # the (mtime, size, inode) of the terms file at the last check
+        self._stat = None
+        self._reload = threading.Event()
+        self._stop = threading.Event()
+        self._watcher = None
+        self.check_terms()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # a spawned process loads the current snapshot on the first use
+        state.update(_extractor=None, _previous=None, _loaded=0, _load_lock=None, _reload=None,
+                     _stop=None, _watcher=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._load_lock = threading.Lock()
+
+    @property
+    def version(self):
+        """The number of the current version of the terms."""
+        return self._version.value
+
+    def _snapshot_path(self, version):
+        return os.path.join(self.directory, '{}.pickle'.format(version))
+
+    def check_terms(self, force=False):
+        """Publish a new version of the terms if the terms file changed since the last check.
+
+        Returns True if a new version is published. If the file can not be read,
+        the error is logged and the current version is kept."""
+        try:
+            stat = os.stat(self.terms_filename)
+            signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if signature == self._stat and not force:
+                return False
+            extractor = self.extractor_cls(self.terms_filename)
+        except OSError as err:
+            if self._extractor is None:
+                raise
+            G_LOG.error('failed to reload terms from %s: %s', self.terms_filename, err)
+            return False
+        self._stat = signature
+        current = self._extractor
+        if current is not None and extractor.vocabulary.digest == current.vocabulary.digest:
+            return False
+        self._publish(extractor)
+        return True
+
+    def _publish(self, extractor):
+        version = self._version.value + 1
+        path = self._snapshot_path(version)
+        if isinstance(extractor, MappedTermsExtractor):
+            # the snapshot references the copy by its path
+            extractor = extractor.save(path + '.termsdb')
+        with open(path + '.tmp', 'wb') as file_:
+            pickle.dump(extractor, file_, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        self._replace(extractor, version)
+        # the vocabulary is registered in this process by now
+        self._version.value = version
+        self._remove_snapshot(version - 2)
+        G_LOG.info('terms version %d published: %d terms from %s',
+                   version, len(extractor.vocabulary), self.terms_filename)
+
+    def _replace(self, extractor, version):
+        """Make the extractor current, unregistering the vocabulary of the one before."""
+        dropped, self._previous = self._previous, self._extractor
+        self._extractor = extractor
+        self._loaded = version
+        if dropped is not None:
+            # the terms may be changed back to the ones of a kept version
+            kept = {other.vocabulary.digest for other in (self._previous, extractor)}
+            if dropped.vocabulary.digest not in kept:
+                Vocabulary.unregister(dropped.vocabulary.digest)
+
+    def _remove_snapshot(self, version):
+        path = self._snapshot_path(version)
+        for filename in (path, path + '.termsdb'):
+            try:
+                # the processes mapping the dictionary keep its pages
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                G_LOG.warning('failed to remove terms snapshot %s: %s', filename, err)
+
+    def request_reload(self):
+        """Reload the terms file in the watching thread, safe in a signal handler."""
+        self._reload.set()
+
+    def _watch(self, interval):
+        while True:
+            forced = self._reload.wait(interval)
+            self._reload.clear()
+            if self._stop.is_set():
+                break
+            self.check_terms(force=forced)
+
+    def watch(self, interval=10):
+        """Check the terms file every interval seconds in a thread.
+
+        A None interval checks the file only on request_reload."""
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), daemon=True)
+        self._watcher.start()
+
+    def current(self):
+        """Return the extractor of the current version of the terms.
+
+        A newer version is loaded by the first thread noticing it, the other threads
+        get the previous extractor meanwhile."""
+        if self._version.value != self._loaded:
+            # nothing to return before the first load
+            if self._load_lock.acquire(self._extractor is None):
+                try:
+                    self._load()
+                finally:
+                    self._load_lock.release()
+        return self._extractor
+
+    def _load(self):
+        version = self._version.value
+        if version == self._loaded:
+            return
+        with open(self._snapshot_path(version), 'rb') as file_:
+            extractor = pickle.load(file_)
+        self._replace(extractor, version)
+        G_LOG.info('terms version %d loaded', version)
+
+    @property
+    def vocabulary(self):
+        """The vocabulary of the current version."""
+        return self.current().vocabulary
+
+    def extract_terms(self, text):
+        """Extract ids of terms from the text description."""
+        return self.current().extract_terms(text)
+
+    def extract_terms_many(self, texts):
+        """Extract terms from an iterable of text descriptions."""
+        return self.current().extract_terms_many(texts)
+
+    def extract_terms_from_chunks(self, chunks):
+        """Extract ids of terms from a text description given by an iterable of its chunks."""
+        return self.current().extract_terms_from_chunks(chunks)
+
+    def terms_to_list(self, terms):
+        """Convert set of term ids into a sorted list of strings."""
+        return self.current().terms_to_list(terms)
+
+    def terms_to_ids(self, terms):
+        """Convert set of term ids into a compact sorted array."""
+        return self.current().terms_to_ids(terms)
+
+    def close(self):
+        """Stop watching the terms file and remove the temporary snapshots."""
+        if self._watcher is not None:
+            self._stop.set()
+            self._reload.set()
+            self._watcher.join()
+            self._watcher = None
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
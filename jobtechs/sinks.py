@@ -0,0 +1,265 @@
+"""The module defines output sinks the extraction results are written to.
+
+A sink buffers results and writes them by batches of batch_size results.
+The available formats (SINKS):
+
+- text: the legacy ' | '-separated lines of Result.__str__;
+- jsonl: a json object per line with url, company, site and a list of techs;
+- csv: url, company, site and ';'-separated techs with a header row;
+- columnar: a compact binary format keeping term ids instead of names,
+  see ColumnarSink and iter_columnar_batches.
+
+The output may be compressed by any of COMPRESSORS.
+"""
+
+from array import array
+from collections import namedtuple
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import os
+import struct
+import sys
+
+from jobtechs.parser import Result, Vocabulary
+
+COMPRESSORS = {
+    'gzip': gzip.open,
+    'bz2': bz2.open,
+    'xz': lzma.open,
+}
+
+
+class ResultSink:
+    """A base class of the sinks writing results to a binary stream by batches.
+
+    Subclasses implement _write_batch, text sinks write to self.file, a utf-8
+    text wrapper of the stream. raw is the file a compressed stream writes to,
+    it is closed after the stream."""
+    binary = False
+
+    def __init__(self, stream, batch_size=1000, raw=None):
+        self.stream = stream
+        self.raw = raw
+        if self.binary:
+            self.file = stream
+        else:
+            self.file = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        self.batch_size = max(batch_size, 1)
+        self.rows = 0
+        self._batch = []
+
+    def write(self, result):
+        """Add a result to the batch, the batch is written when it is full."""
+        self._batch.append(result)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered results."""
+        if self._batch:
+            self._write_batch(self._batch)
+            self.rows += len(self._batch)
+            self._batch = []
+        self.file.flush()
+
+    def _write_batch(self, results):
+        raise NotImplementedError
+
+    def close(self):
+        """Write the buffered results and close the stream."""
+        self.flush()
+        self.file.close()
+        if self.raw is not None:
+            self.raw.close()
+
+
+class TextSink(ResultSink):
+    """Writes results in the legacy format of Result.__str__."""
+
+    def _write_batch(self, results):
+        self.file.write(''.join(str(result) + '\n' for result in results))
+
+
+class JsonLinesSink(ResultSink):
+    """Writes a json object per result."""
+
+    def _write_batch(self, results):
+        self.file.write(''.join(
+            json.dumps({'url': result.url, 'company': result.company, 'site': result.site,
+                        'techs': result.techs}, ensure_ascii=False) + '\n'
+            for result in results))
+
+
+class CsvSink(ResultSink):
+    """Writes results as csv rows, the techs are joined by ';'."""
+    HEADER = ('url', 'company', 'site', 'techs')
+
+    def __init__(self, stream, batch_size=1000, raw=None):
+        super().__init__(stream, batch_size, raw)
+        self._writer = csv.writer(self.file)
+        self._writer.writerow(self.HEADER)
+
+    def _write_batch(self, results):
+        self._writer.writerows(
+            (result.url, result.company, result.site, ';'.join(result.techs))
+            for result in results)
+
+
+# the columnar format: MAGIC followed by frames, each frame is a kind byte,
+# the length of the payload (FRAME_HEADER) and the payload
+COLUMNAR_MAGIC = b'JTCOL\x01\n'
+FRAME_HEADER = struct.Struct('<cI')
+# a vocabulary frame: a json {"digest": ..., "names": [...]}, it applies to the following batches
+VOCABULARY_FRAME = b'V'
+# a batch frame: the number of rows, then the url, company and site columns,
+# each as an array of lengths and the concatenated utf-8 strings, then an array
+# of n + 1 offsets of the term ids of the rows and the term ids
+BATCH_FRAME = b'B'
+ROWS_HEADER = struct.Struct('<I')
+
+# columns of a batch read by iter_columnar_batches, the term ids of the i-th
+# row are term_ids[offsets[i]:offsets[i + 1]]
+ColumnarBatch = namedtuple('ColumnarBatch', 'vocabulary urls companies sites offsets term_ids')
+
+
+def _array_bytes(items):
+    # the arrays are stored little-endian
+    if sys.byteorder == 'big':
+        items = array(items.typecode, items)
+        items.byteswap()
+    return items.tobytes()
+
+
+def _read_array(typecode, data, pos, count):
+    items = array(typecode)
+    end = pos + count * items.itemsize
+    items.frombytes(data[pos:end])
+    if sys.byteorder == 'big':
+        items.byteswap()
+    return items, end
+
+
+def _pack_strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    return _array_bytes(array('I', map(len, encoded))) + b''.join(encoded)
+
+
+def _unpack_strings(data, pos, count):
+    lengths, pos = _read_array('I', data, pos, count)
+    strings = []
+    for length in lengths:
+        strings.append(data[pos:pos + length].decode('utf-8'))
+        pos += length
+    return strings, pos
+
+
+class ColumnarSink(ResultSink):
+    """Writes results in the columnar binary format.
+
+    The techs are kept as ids of the vocabulary terms, the vocabulary is written
+    once, before the first batch of its results."""
+    binary = True
+
+    def __init__(self, stream, batch_size=1000, raw=None):
+        super().__init__(stream, batch_size, raw)
+        self._vocabulary = None
+        self.file.write(COLUMNAR_MAGIC)
+
+    def _write_frame(self, kind, payload):
+        self.file.write(FRAME_HEADER.pack(kind, len(payload)))
+        self.file.write(payload)
+
+    def _write_batch(self, results):
+        start = 0
+        for end in range(1, len(results) + 1):
+            if end == len(results) or results[end].vocabulary is not results[start].vocabulary:
+                self._write_rows(results[start:end])
+                start = end
+
+    def _write_rows(self, results):
+        vocabulary = results[0].vocabulary
+        if vocabulary is not self._vocabulary:
+            self._vocabulary = vocabulary
+            self._write_frame(VOCABULARY_FRAME, json.dumps(
+                {'digest': vocabulary.digest, 'names': list(vocabulary.names)}).encode('utf-8'))
+        offsets = array('I', [0])
+        term_ids = array(vocabulary.typecode)
+        for result in results:
+            term_ids.extend(result.term_ids)
+            offsets.append(len(term_ids))
+        self._write_frame(BATCH_FRAME, b''.join((
+            ROWS_HEADER.pack(len(results)),
+            _pack_strings(result.url for result in results),
+            _pack_strings(result.company for result in results),
+            _pack_strings(result.site for result in results),
+            _array_bytes(offsets),
+            _array_bytes(term_ids),
+        )))
+
+
+def iter_columnar_batches(stream):
+    """Iterate over ColumnarBatch of a binary stream written by ColumnarSink."""
+    if stream.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+        raise ValueError('The stream is not in the columnar format.')
+    vocabulary = None
+    while True:
+        header = stream.read(FRAME_HEADER.size)
+        if not header:
+            return
+        kind, size = FRAME_HEADER.unpack(header)
+        payload = stream.read(size)
+        if len(payload) != size:
+            raise ValueError('The stream is truncated.')
+        if kind == VOCABULARY_FRAME:
+            data = json.loads(payload.decode('utf-8'))
+            try:
+                vocabulary = Vocabulary.get(data['digest'])
+            except KeyError:
+                vocabulary = Vocabulary(name.split(' ') for name in data['names'])
+        elif kind == BATCH_FRAME:
+            rows, = ROWS_HEADER.unpack_from(payload)
+            pos = ROWS_HEADER.size
+            urls, pos = _unpack_strings(payload, pos, rows)
+            companies, pos = _unpack_strings(payload, pos, rows)
+            sites, pos = _unpack_strings(payload, pos, rows)
+            offsets, pos = _read_array('I', payload, pos, rows + 1)
+            term_ids, pos = _read_array(vocabulary.typecode, payload, pos, offsets[-1])
+            yield ColumnarBatch(vocabulary, urls, companies, sites, offsets, term_ids)
+        else:
+            raise ValueError('Unknown frame {!r}.'.format(kind))
+
+
+def iter_columnar_results(stream):
+    """Iterate over Results of a binary stream written by ColumnarSink."""
+    for batch in iter_columnar_batches(stream):
+        for i, url in enumerate(batch.urls):
+            yield Result(url, batch.companies[i],
+                         batch.term_ids[batch.offsets[i]:batch.offsets[i + 1]],
+                         batch.sites[i], batch.vocabulary)
+
+
+SINKS = {
+    'text': TextSink,
+    'jsonl': JsonLinesSink,
+    'csv': CsvSink,
+    'columnar': ColumnarSink,
+}
+
+
+def open_sink(output_format='text', path='-', compression=None, batch_size=1000):
+    """Open a sink of the format (see SINKS) writing to the path, '-' is stdout.
+
+    compression is None or a key of COMPRESSORS."""
+    if path == '-':
+        sys.stdout.flush()
+        # closing the sink does not close stdout
+        stream = os.fdopen(sys.stdout.fileno(), 'wb', closefd=False)
+    else:
+        stream = open(path, 'wb')
+    if not compression:
+        return SINKS[output_format](stream, batch_size)
+    return SINKS[output_format](COMPRESSORS[compression](stream, 'wb'), batch_size, stream)
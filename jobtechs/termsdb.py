@@ -0,0 +1,382 @@
+"""The module implements a compiled terms dictionary read in place from a memory-mapped file.
+
+A terms file with hundreds of thousands of terms takes seconds to load and hundreds
+of megabytes in every process as a Vocabulary and a TermsAutomaton of dicts.
+compile_terms writes them once into a binary file of flat arrays, which every
+process maps into memory: the pages of the file are shared by the processes
+and loading takes no time regardless of its size.
+
+The file is little-endian, all the arrays are of unsigned 32-bit integers:
+
+- HEADER: the magic, the digest of the vocabulary and the sizes of the sections;
+- names: offsets of the term names (in the order of term ids, see Vocabulary)
+  followed by the concatenated utf-8 names;
+- words: offsets of the words of the terms (word ids are their sorted order)
+  followed by the concatenated utf-8 words;
+- table: an open-addressing hash table of word ids + 1 by crc32 of the word;
+- root: the state the automaton goes to from the root by each word id;
+- edges: for each state, the start of its transitions in the arrays of
+  word ids (sorted within a state) and next states; the root is not there;
+- fail: the failure link of each state;
+- outputs: for each state, the start of its term ids in the array of term ids.
+
+MappedTermsExtractor finds the same terms as AutomatonTermsExtractor. A plain
+terms file is compiled in memory, so that it can be used as a fallback.
+"""
+
+from array import array
+from bisect import bisect_left
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from jobtechs.common import iter_good_lines
+from jobtechs.parser import (
+    TERMS_EXTRACTORS, AutomatonTermsExtractor, TermsAutomaton, Vocabulary, iter_words)
+
+TERMS_DB_MAGIC = b'JTTERMS\x01'
+# magic, digest, number of terms, size of names, number of words, size of words,
+# size of the hash table, number of states, number of transitions, number of outputs
+HEADER = struct.Struct('<8s40s8I')
+# the number of words the word ids are cached for in each process
+WORD_CACHE_SIZE = 1 << 16
+
+
+def _padded(size):
+    return (size + 3) & ~3
+
+
+def _layout(counts):
+    """Return a list of (section, offset, size in bytes, is it an array)."""
+    num_terms, names_size, num_words, words_size, table_size, num_states, num_edges, \
+        num_outputs = counts
+    sections = (
+        ('name_offsets', (num_terms + 1) * 4, True),
+        ('names', _padded(names_size), False),
+        ('word_offsets', (num_words + 1) * 4, True),
+        ('words', _padded(words_size), False),
+        ('table', table_size * 4, True),
+        ('root', num_words * 4, True),
+        ('edge_start', (num_states + 1) * 4, True),
+        ('edge_words', num_edges * 4, True),
+        ('edge_next', num_edges * 4, True),
+        ('fail', num_states * 4, True),
+        ('output_start', (num_states + 1) * 4, True),
+        ('output_ids', num_outputs * 4, True),
+    )
+    layout = []
+    offset = HEADER.size
+    for name, size, is_array in sections:
+        layout.append((name, offset, size, is_array))
+        offset += size
+    return layout
+
+
+def _pack_strings(strings):
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = array('I', [0])
+    for item in encoded:
+        offsets.append(offsets[-1] + len(item))
+    return offsets, b''.join(encoded)
+
+
+def _table_size(num_words):
+    size = 8
+    while size < 2 * num_words:
+        size <<= 1
+    return size
+
+
+def compile_terms(terms):
+    """Compile an iterable of term-tuples into the bytes of a terms dictionary."""
+    # pylint: disable=too-many-locals,protected-access
+    vocabulary = Vocabulary(terms)
+    automaton = TermsAutomaton(vocabulary.ids)
+    words = sorted({word for term in vocabulary.terms for word in term})
+    word_ids = {word: word_id for word_id, word in enumerate(words)}
+    name_offsets, names = _pack_strings(vocabulary.names)
+    word_offsets, words_blob = _pack_strings(words)
+
+    table = array('I', [0]) * _table_size(len(words))
+    mask = len(table) - 1
+    for word_id, word in enumerate(words):
+        slot = zlib.crc32(word.encode('utf-8')) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = word_id + 1
+
+    root = array('I', [0]) * len(words)
+    for word, state in automaton._goto[0].items():
+        root[word_ids[word]] = state
+    edge_start, edge_words, edge_next = array('I'), array('I'), array('I')
+    output_start, output_ids = array('I'), array('I')
+    for state, goto in enumerate(automaton._goto):
+        edge_start.append(len(edge_words))
+        if state:
+            for word_id, next_state in sorted((word_ids[word], next_state)
+                                              for word, next_state in goto.items()):
+                edge_words.append(word_id)
+                edge_next.append(next_state)
+        output_start.append(len(output_ids))
+        output_ids.extend(automaton._output[state])
+    edge_start.append(len(edge_words))
+    output_start.append(len(output_ids))
+    fail = array('I', automaton._fail)
+
+    counts = (len(vocabulary), len(names), len(words), len(words_blob), len(table),
+              len(fail), len(edge_words), len(output_ids))
+    sections = {
+        'name_offsets': name_offsets, 'names': names,
+        'word_offsets': word_offsets, 'words': words_blob,
+        'table': table, 'root': root,
+        'edge_start': edge_start, 'edge_words': edge_words, 'edge_next': edge_next,
+        'fail': fail, 'output_start': output_start, 'output_ids': output_ids,
+    }
+    parts = [HEADER.pack(TERMS_DB_MAGIC, vocabulary.digest.encode('ascii'), *counts)]
+    for name, _, size, is_array in _layout(counts):
+        data = sections[name]
+        if is_array:
+            if sys.byteorder == 'big':
+                data = array('I', data)
+                data.byteswap()
+            data = data.tobytes()
+        parts.append(data + b'\0' * (size - len(data)))
+    return b''.join(parts)
+
+
+def read_terms(terms_filename):
+    """Read term-tuples from a plain terms file (see TermsExtractor.reload_terms)."""
+    with open(terms_filename) as file_:
+        return [tuple(line.lower().split()) for line in iter_good_lines(file_)]
+
+
+def write_terms_db(data, path):
+    """Write the bytes of a terms dictionary to the path atomically.
+
+    The processes having the old file mapped keep reading it."""
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as file_:
+        file_.write(data)
+    os.replace(tmp_path, path)
+
+
+def is_terms_db(path):
+    """Check whether the file at the path is a compiled terms dictionary."""
+    with open(path, 'rb') as file_:
+        return file_.read(len(TERMS_DB_MAGIC)) == TERMS_DB_MAGIC
+
+
+class TermsDb:
+    """Arrays of a compiled terms dictionary read in place from a buffer.
+
+    The buffer is usually an mmap of the file, see open."""
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, buffer, path=None):
+        self.path = path
+        self.buffer = buffer
+        view = memoryview(buffer)
+        magic, digest, *counts = HEADER.unpack_from(view)
+        if magic != TERMS_DB_MAGIC:
+            raise ValueError('Not a compiled terms dictionary.')
+        self.digest = digest.decode('ascii')
+        self.num_terms, _, self.num_words = counts[:3]
+        for name, offset, size, is_array in _layout(counts):
+            section = view[offset:offset + size]
+            if is_array:
+                if sys.byteorder == 'big':
+                    # a private copy in the native order
+                    section = array('I', section.tobytes())
+                    section.byteswap()
+                else:
+                    section = section.cast('I')
+            setattr(self, name, section)
+        self._mask = len(self.table) - 1
+
+    @classmethod
+    def open(cls, path):
+        """Map the compiled terms dictionary at the path into memory."""
+        with open(path, 'rb') as file_:
+            buffer = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, path)
+
+    @staticmethod
+    def _get_string(offsets, blob, index):
+        return bytes(blob[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+    def get_name(self, term_id):
+        """Return the name of the term by its id."""
+        return self._get_string(self.name_offsets, self.names, term_id)
+
+    def get_word(self, word_id):
+        """Return the word by its id."""
+        return self._get_string(self.word_offsets, self.words, word_id)
+
+    def lookup(self, word):
+        """Return the id of the word, -1 if no term has the word."""
+        encoded = word.encode('utf-8')
+        table, offsets, words, mask = self.table, self.word_offsets, self.words, self._mask
+        slot = zlib.crc32(encoded) & mask
+        while table[slot]:
+            word_id = table[slot] - 1
+            if words[offsets[word_id]:offsets[word_id + 1]] == encoded:
+                return word_id
+            slot = (slot + 1) & mask
+        return -1
+
+
+class MappedNames:
+    """A read-only sequence of the term names of a TermsDb decoded on access."""
+
+    def __init__(self, terms_db):
+        self._db = terms_db
+
+    def __len__(self):
+        return self._db.num_terms
+
+    def __getitem__(self, term_id):
+        if not 0 <= term_id < self._db.num_terms:
+            raise IndexError(term_id)
+        return self._db.get_name(term_id)
+
+    def __iter__(self):
+        return (self._db.get_name(term_id) for term_id in range(self._db.num_terms))
+
+
+class MappedVocabulary(Vocabulary):
+    """A Vocabulary of a TermsDb, the names are not loaded into memory.
+
+    The terms and their ids are built on demand, the extraction does not need them."""
+    # pylint: disable=super-init-not-called
+
+    def __init__(self, terms_db):
+        self.names = MappedNames(terms_db)
+        self.typecode = 'H' if len(self.names) <= 0xffff else 'I'
+        self.digest = terms_db.digest
+        self._terms = None
+        self._registry[self.digest] = self
+
+    @property
+    def terms(self):
+        """A tuple of the term-tuples in the order of their ids."""
+        if self._terms is None:
+            self._terms = tuple(tuple(name.split(' ')) for name in self.names)
+        return self._terms
+
+    @property
+    def ids(self):
+        """A dict from the term-tuples to their ids."""
+        return {term: term_id for term_id, term in enumerate(self.terms)}
+
+
+class MappedAutomaton(TermsAutomaton):
+    """A TermsAutomaton reading its transitions from a TermsDb.
+
+    Words are looked up in the hash table of the dictionary, the ids of the recent
+    words (most of them are not in any term) are cached in memory."""
+    # pylint: disable=super-init-not-called
+
+    def __init__(self, terms_db):
+        self.db = terms_db
+        self._word_ids = {}
+
+    def _lookup_word(self, word):
+        word_id = self.db.lookup(word)
+        if len(self._word_ids) >= WORD_CACHE_SIZE:
+            self._word_ids.clear()
+        self._word_ids[word] = word_id
+        return word_id
+
+    def _next_state(self, state, word):
+        word_id = self._word_ids.get(word)
+        if word_id is None:
+            word_id = self._lookup_word(word)
+        if word_id < 0:
+            # the word is in no term, hence no transition from any state
+            return 0
+        db = self.db
+        edge_start, edge_words, fail = db.edge_start, db.edge_words, db.fail
+        while state:
+            start, end = edge_start[state], edge_start[state + 1]
+            i = bisect_left(edge_words, word_id, start, end)
+            if i < end and edge_words[i] == word_id:
+                return db.edge_next[i]
+            state = fail[state]
+        return db.root[word_id]
+
+    def _outputs(self, state):
+        output_start = self.db.output_start
+        return self.db.output_ids[output_start[state]:output_start[state + 1]]
+
+    def iter_matches(self, text):
+        """Iterate over ids of terms found in the text (in order of their ends)."""
+        state = 0
+        for word, breaks in iter_words(text):
+            state = self._next_state(0 if breaks else state, word)
+            if state:
+                yield from self._outputs(state)
+
+    def _scan_piece(self, piece, state, breaks_before, found, final):
+        """Feed words of a piece of a text to the automaton starting in the state.
+
+        See TermsAutomaton._scan_piece."""
+        words = iter_words(piece)
+        last = next(words, None)
+        for item in words:
+            word, breaks = last
+            last = item
+            if breaks or breaks_before:
+                state = 0
+                breaks_before = False
+            state = self._next_state(state, word)
+            if state:
+                found.update(self._outputs(state))
+        if last is None:
+            return state, breaks_before
+        if not final:
+            return state, breaks_before or last[1]
+        word, breaks = last
+        state = self._next_state(0 if breaks or breaks_before else state, word)
+        if state:
+            found.update(self._outputs(state))
+        return state, False
+
+    def extract_many(self, texts):
+        """Return a list of sets of term ids found in each of the texts."""
+        return [set(self.iter_matches(text.lower())) for text in texts]
+
+
+class MappedTermsExtractor(AutomatonTermsExtractor):
+    """Terms extractor reading a compiled terms dictionary in place (see compile_terms).
+
+    A plain terms file is compiled in memory instead. The extractor is pickled
+    by its file name, so that each process maps the file itself."""
+
+    def reload_terms(self):
+        """Map the compiled terms file into memory or compile a plain one."""
+        if is_terms_db(self.terms_filename):
+            terms_db = TermsDb.open(self.terms_filename)
+        else:
+            terms_db = TermsDb(compile_terms(read_terms(self.terms_filename)))
+        self.vocabulary = MappedVocabulary(terms_db)
+        self._terms = {}
+        self._automaton = MappedAutomaton(terms_db)
+
+    @property
+    def terms_db(self):
+        """The TermsDb the extractor reads."""
+        return self._automaton.db
+
+    def save(self, path):
+        """Write the dictionary to the path and return an extractor mapping it."""
+        write_terms_db(self.terms_db.buffer, path)
+        return type(self)(path)
+
+    def __reduce__(self):
+        return type(self), (self.terms_filename,)
+
+
+# a plain terms file is compiled on load, a compiled one is mapped
+TERMS_EXTRACTORS['mapped'] = MappedTermsExtractor
@@ -0,0 +1,330 @@
+"""The module defines rate limiters and schedulers used by the fetchers.
+
+TokenBucket keeps its state in shared memory, so that a single instance created
+in the main process limits all the fetcher processes it is passed to.
+HostScheduler distributes urls of a fetcher among its threads by hosts adapting
+the load on each host to its responses.
+"""
+
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import heapq
+import multiprocessing as mp
+import threading
+import time
+from urllib.parse import urlparse
+
+
+class TokenBucket:
+    """A token bucket rate limiter shared between threads and processes.
+
+    The bucket is refilled with rate tokens per second and holds at most capacity
+    tokens, that is capacity requests may be sent at once after a pause.
+
+    The implementation is the virtual scheduling form of the algorithm (GCRA):
+    the bucket keeps the theoretical arrival time of the next request and every
+    caller reserves its time slot under the lock and then sleeps until the slot.
+    Slots are reserved in the order of calls, so that the waiting is FIFO-fair
+    and nobody spins on the lock.
+    """
+    # indexes in the shared state
+    _TAT, _FIRST, _LAST, _COUNT = range(4)
+
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise ValueError('rate should be positive')
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._interval = 1. / rate
+        self._tolerance = (self.capacity - 1) * self._interval
+        self._lock = mp.Lock()
+        self._state = mp.RawArray('d', 4)
+
+    def reserve(self):
+        """Reserve a token and return the number of seconds to wait for it."""
+        state = self._state
+        with self._lock:
+            now = time.monotonic()
+            tat = max(state[self._TAT], now)
+            start = max(tat - self._tolerance, now)
+            state[self._TAT] = tat + self._interval
+            if not state[self._COUNT]:
+                state[self._FIRST] = start
+            state[self._LAST] = start
+            state[self._COUNT] += 1
+        return start - now
+
+    def acquire(self):
+        """Wait until a token is available."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    @property
+    def achieved_rate(self):
+        """The average rate of requests between the first and the last acquired tokens."""
+        with self._lock:
+            count = self._state[self._COUNT]
+            period = self._state[self._LAST] - self._state[self._FIRST]
+        if count < 2 or period <= 0:
+            return 0.
+        return (count - 1) / period
+
+
+def parse_retry_after(value):
+    """Convert a Retry-After header value (seconds or an HTTP date) into seconds.
+
+    Returns None if the value is missing or malformed."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class _HostState:
+    """Scheduling state of a single host (see HostScheduler)."""
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('urls', 'concurrency', 'in_flight', 'interval', 'next_time',
+                 'latency', 'min_latency', 'successes', 'scheduled')
+
+    def __init__(self, concurrency, interval):
+        self.urls = deque()
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.interval = interval
+        self.next_time = 0
+        # exponentially weighted average and minimum of the response time
+        self.latency = None
+        self.min_latency = None
+        self.successes = 0
+        # whether the host is in the heap of ready hosts
+        self.scheduled = False
+
+
+class HostScheduler:
+    """Schedules urls of a fetcher by their hosts (netloc).
+
+    Each host has its own queue of urls, its own limit of requests per second
+    (host_rps, 0 means no limit) and its own limit of concurrent requests.
+    Worker threads take urls with get() and report the outcome of every request
+    with done(). The limit of concurrent requests of a host starts with
+    initial_concurrency and is adapted (additive increase, multiplicative decrease):
+    it grows while the response time stays close to the best observed one
+    and is halved on 429/503 responses, which as well double the interval between
+    requests to the host and postpone them by Retry-After.
+
+    Urls put with paced=False (e.g. served from a cache) are given out first
+    regardless of their hosts.
+
+    If max_queued is positive, put() blocks while max_queued urls wait to be taken,
+    so that the producer is slowed down to the pace of the requests.
+
+    The state of a host is dropped once it has no urls, no requests in flight
+    and its next request is due, unless the host has been slowed down, so that
+    the memory does not grow with the number of hosts seen.
+    """
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    # statuses telling us to slow down
+    THROTTLING_STATUSES = frozenset((429, 503))
+    # response time growing more than latency_factor times the best one
+    # (plus latency_slack seconds) is a sign of congestion
+    latency_factor = 2.
+    latency_slack = 0.1
+    # the weight of a new response time in the average
+    latency_alpha = 0.2
+
+    def __init__(self, host_rps=0, max_concurrency=5, initial_concurrency=1, max_interval=60,
+                 max_queued=0):
+        self.base_interval = 1. / host_rps if host_rps > 0 else 0
+        self.max_concurrency = max_concurrency
+        self.initial_concurrency = min(initial_concurrency, max_concurrency)
+        self.max_interval = max_interval
+        self.max_queued = max_queued
+        self._hosts = {}
+        # (next_time, seq, netloc) of hosts having urls and a free concurrency slot
+        self._ready = []
+        # (next_time, netloc) of hosts which became idle, see _evict
+        self._idle = []
+        # urls not limited by their hosts and the number of them given out
+        self._unpaced = deque()
+        self._unpaced_taken = {}
+        self._seq = 0
+        self._queued = 0
+        self._closed = False
+        lock = threading.Lock()
+        # workers wait on _cond for urls, producers wait on _not_full for free room
+        self._cond = threading.Condition(lock)
+        self._not_full = threading.Condition(lock)
+
+    def _get_host(self, netloc):
+        host = self._hosts.get(netloc)
+        if host is None:
+            host = self._hosts[netloc] = _HostState(self.initial_concurrency, self.base_interval)
+        return host
+
+    def _is_backed_off(self, host):
+        return host.interval > self.base_interval or host.concurrency < self.initial_concurrency
+
+    def _evict(self):
+        """Drop the states of idle hosts whose next requests are due."""
+        now = time.monotonic()
+        while self._idle and self._idle[0][0] <= now:
+            _, netloc = heapq.heappop(self._idle)
+            host = self._hosts.get(netloc)
+            if (host is not None and not host.urls and not host.in_flight
+                    and not host.scheduled and host.next_time <= now
+                    and not self._is_backed_off(host)):
+                del self._hosts[netloc]
+
+    def _schedule(self, netloc, host):
+        if host.scheduled or not host.urls or host.in_flight >= host.concurrency:
+            return
+        host.scheduled = True
+        self._seq += 1
+        heapq.heappush(self._ready, (host.next_time, self._seq, netloc))
+        self._cond.notify()
+
+    @property
+    def queued(self):
+        """The number of urls waiting to be taken."""
+        with self._cond:
+            return self._queued
+
+    def _wait_not_full(self):
+        if self.max_queued > 0:
+            self._not_full.wait_for(lambda: self._queued < self.max_queued)
+
+    def _taken(self):
+        self._queued -= 1
+        if self.max_queued > 0:
+            self._not_full.notify()
+
+    def put(self, url, paced=True):
+        """Add a url to the queue of its host.
+
+        Waits for free room if max_queued urls are queued."""
+        if not paced:
+            with self._cond:
+                self._wait_not_full()
+                self._unpaced.append(url)
+                self._queued += 1
+                self._cond.notify()
+            return
+        netloc = urlparse(url).netloc
+        with self._cond:
+            self._wait_not_full()
+            self._evict()
+            host = self._get_host(netloc)
+            host.urls.append(url)
+            self._queued += 1
+            self._schedule(netloc, host)
+
+    def close(self):
+        """Mark that no more urls are going to be added."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def get(self):
+        """Wait for a host ready for the next request and return its next url.
+
+        Returns None when the scheduler is closed and all the urls are taken."""
+        with self._cond:
+            while True:
+                if self._unpaced:
+                    url = self._unpaced.popleft()
+                    self._taken()
+                    self._unpaced_taken[url] = self._unpaced_taken.get(url, 0) + 1
+                    return url
+                if self._ready:
+                    next_time, _, netloc = self._ready[0]
+                    now = time.monotonic()
+                    if next_time > now:
+                        self._cond.wait(next_time - now)
+                        continue
+                    heapq.heappop(self._ready)
+                    host = self._hosts[netloc]
+                    host.scheduled = False
+                    if host.next_time > now:
+                        # postponed by Retry-After after it was scheduled
+                        self._schedule(netloc, host)
+                        continue
+                    url = host.urls.popleft()
+                    self._taken()
+                    host.in_flight += 1
+                    host.next_time = now + host.interval
+                    self._schedule(netloc, host)
+                    return url
+                if self._closed and not self._queued:
+                    # wake up other waiting workers as well
+                    self._cond.notify_all()
+                    return None
+                self._cond.wait()
+
+    def done(self, url, latency=None, status=None, retry_after=None):
+        """Report the outcome of a request to the url taken by get().
+
+        latency is the response time in seconds, None if there was no response.
+        """
+        with self._cond:
+            taken = self._unpaced_taken.get(url)
+            if taken:
+                if taken > 1:
+                    self._unpaced_taken[url] = taken - 1
+                else:
+                    del self._unpaced_taken[url]
+                return
+            netloc = urlparse(url).netloc
+            host = self._hosts[netloc]
+            host.in_flight -= 1
+            if status in self.THROTTLING_STATUSES:
+                self._slow_down(host, retry_after)
+            elif latency is not None:
+                self._speed_up(host, latency)
+            self._schedule(netloc, host)
+            if not host.in_flight and not host.urls:
+                heapq.heappush(self._idle, (host.next_time, netloc))
+            self._evict()
+
+    def _slow_down(self, host, retry_after):
+        host.concurrency = max(host.concurrency // 2, 1)
+        host.successes = 0
+        host.interval = min(max(host.interval * 2, 1.), self.max_interval)
+        if retry_after:
+            host.next_time = max(host.next_time, time.monotonic() + retry_after)
+
+    def _speed_up(self, host, latency):
+        if host.latency is None:
+            host.latency = host.min_latency = latency
+        else:
+            host.latency += self.latency_alpha * (latency - host.latency)
+            host.min_latency = min(host.min_latency, latency)
+        if host.latency > self.latency_factor * host.min_latency + self.latency_slack:
+            # the host responds slower, probably under load
+            host.concurrency = max(host.concurrency - 1, 1)
+            host.successes = 0
+            return
+        host.interval = max(host.interval * 0.9, self.base_interval)
+        if host.interval < self.base_interval * 1.05:
+            host.interval = self.base_interval
+        host.successes += 1
+        if host.successes >= host.concurrency:
+            host.concurrency = min(host.concurrency + 1, self.max_concurrency)
+            host.successes = 0
+
+    def host_stats(self):
+        """Return a dict netloc -> (concurrency, requests interval) for the hosts
+        with a state (see HostScheduler)."""
+        with self._cond:
+            return {netloc: (host.concurrency, host.interval)
+                    for netloc, host in self._hosts.items()}
@@ -19,9 +19,14 @@ setup(
     packages=find_packages(),
     long_description=open(join(dirname(__file__), 'README.md')).read(),
     install_requires=['requests', 'lxml'],
+    extras_require={
+        # the asyncio fetching engine (extract_techs --engine=asyncio)
+        'async': ['aiohttp'],
+    },
     entry_points = {
         'console_scripts': [
             'extract_techs = jobtechs.scripts.extract_techs:main2',
+            'compile_terms = jobtechs.scripts.compile_terms:main',
         ]
     },
     test_suite = 'tests',
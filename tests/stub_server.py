@@ -0,0 +1,63 @@
+"""A local stand-in HTTP server serving pages from a dict for the tests."""
+
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Serve server.pages[path] keeping connections alive, 404 otherwise.
+
+    Pages have an ETag, a matching If-None-Match gets 304."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # pylint: disable=invalid-name,missing-docstring
+        page = self.server.pages.get(self.path)
+        self.server.requests.append(self.path)
+        if page is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = page.encode('utf-8') if isinstance(page, str) else page
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        # pylint: disable=arguments-differ
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """A threaded server on a random local port, use as a context manager."""
+    daemon_threads = True
+
+    def __init__(self, pages=None, handler_cls=StubHandler):
+        super().__init__(('127.0.0.1', 0), handler_cls)
+        self.pages = {} if pages is None else pages
+        self.requests = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def url(self, path):
+        """Return an absolute url of the path on the server."""
+        return 'http://127.0.0.1:{}{}'.format(self.server_address[1], path)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
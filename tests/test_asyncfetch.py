@@ -0,0 +1,136 @@
+import os
+import queue
+import tempfile
+import threading
+import time
+from unittest import TestCase, skipIf
+
+from jobtechs.asyncfetch import AsyncFetcher, HostLimiter, aiohttp
+from jobtechs.fetcher import SessionFactory, ThrottledFetcher
+from jobtechs.parser import EXTERNAL_JOB_FOUND, AutomatonTermsExtractor, PageParser
+from stub_server import StubServer
+
+PAGE = '<html><head><title>Job</title></head><body><p>Python, C# developer</p></body></html>'
+
+
+class EmbeddingPageParser(PageParser):
+    """Reports pages with /embed in the url as embedding the job at the ?job= url."""
+
+    def find_external_job_url(self, context):
+        if '/embed' in context.url:
+            return context.url.split('?job=')[1]
+        return None
+
+
+def drain(q):
+    items = []
+    while not q.empty():
+        items.append(q.get())
+    return items
+
+
+@skipIf(aiohttp is None, 'aiohttp is not installed')
+class TestAsyncFetcher(TestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file_:
+            print('Python', 'C#', sep='\n', file=file_)
+        self.addCleanup(os.remove, file_.name)
+        self.extractor = AutomatonTermsExtractor(file_.name)
+        self.server = StubServer({'/job1': PAGE, '/job2': PAGE, '/empty': '<html></html>'})
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.urls = [self.server.url(path) for path in ('/job1', '/job2', '/empty', '/missing')]
+
+    def run_threaded(self):
+        q_out, q_err = queue.Queue(), queue.Queue()
+        fetcher = ThrottledFetcher(
+            PageParser(), self.extractor, q_out=q_out, q_err=q_err, max_rps=0,
+            session_factory=SessionFactory(retries=0))
+        fetcher._local = threading.local()
+        for url in self.urls:
+            fetcher.q_in.put(url)
+            fetcher._process_url(url)
+        return drain(q_out), drain(q_err)
+
+    def run_async(self):
+        q_out, q_err = queue.Queue(), queue.Queue()
+        fetcher = AsyncFetcher(
+            {'default': PageParser()}, self.extractor, q_out, q_err, parse_workers=2,
+            session_factory=SessionFactory(retries=0))
+        try:
+            fetcher.run(iter(self.urls))
+        finally:
+            fetcher.close()
+        return drain(q_out), drain(q_err)
+
+    def test_same_outputs_as_threaded_fetcher(self):
+        results, errors = self.run_async()
+        expected_results, expected_errors = self.run_threaded()
+        self.assertEqual(sorted(map(str, expected_results)), sorted(map(str, results)))
+        self.assertEqual(sorted(expected_errors), sorted(errors))
+        self.assertEqual(3, len(results))
+        self.assertEqual(1, len(errors))
+        techs = {result.url: result.techs for result in results}
+        self.assertEqual(['c#', 'python'], techs[self.urls[0]])
+
+    def test_follow_up(self):
+        q_out, q_err = queue.Queue(), queue.Queue()
+        followed = set()
+
+        def follow_up(url, error):
+            new_url = error[len(EXTERNAL_JOB_FOUND):]
+            if new_url in followed:
+                return ''
+            followed.add(new_url)
+            return new_url
+
+        job_url = self.server.url('/job1')
+        paths = ['/embed{}?job={}'.format(i, job_url) for i in range(2)]
+        for path in paths:
+            self.server.pages[path] = PAGE
+        fetcher = AsyncFetcher(
+            {'default': EmbeddingPageParser()}, self.extractor, q_out, q_err, parse_workers=1,
+            session_factory=SessionFactory(retries=0), follow_up=follow_up)
+        try:
+            fetcher.run(self.server.url(path) for path in paths)
+        finally:
+            fetcher.close()
+        self.assertEqual([job_url], [result.url for result in drain(q_out)])
+        self.assertEqual([], drain(q_err))
+        self.assertEqual(1, sum(path == '/job1' for path in self.server.requests))
+
+    def test_hosts_paced(self):
+        q_out, q_err = queue.Queue(), queue.Queue()
+        fetcher = AsyncFetcher(
+            {'default': PageParser()}, self.extractor, q_out, q_err, host_rps=20,
+            parse_workers=1, session_factory=SessionFactory(retries=0))
+        self.server.pages.update({'/job{}'.format(i): PAGE for i in range(3, 7)})
+        started = time.monotonic()
+        try:
+            fetcher.run(self.server.url('/job{}'.format(i)) for i in range(1, 7))
+        finally:
+            fetcher.close()
+        # 6 requests to the host at 20 rps with the first one free
+        self.assertGreaterEqual(time.monotonic() - started, 5 / 20)
+        self.assertEqual(6, len(drain(q_out)))
+
+    def test_host_slowed_down(self):
+        limiter = HostLimiter(host_rps=10)
+        limiter.done(429, retry_after=5)
+        self.assertEqual(1., limiter.interval)
+        self.assertGreater(limiter.next_time, time.monotonic() + 4)
+        for _ in range(100):
+            limiter.done(200)
+        self.assertEqual(0.1, limiter.interval)
+
+    def test_idle_limiters_dropped(self):
+        fetcher = AsyncFetcher({'default': PageParser()}, self.extractor, queue.Queue(),
+                               queue.Queue(), parse_workers=1)
+        self.addCleanup(fetcher.close)
+        for netloc in ['host{}'.format(i) for i in range(100)] + ['slow']:
+            limiter = fetcher._get_limiter(netloc)
+            if netloc == 'slow':
+                limiter.done(429)
+            fetcher._release_limiter(netloc, limiter)
+        fetcher._get_limiter('last')
+        self.assertEqual({'slow', 'last'}, set(fetcher._limiters))
@@ -0,0 +1,92 @@
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from jobtechs.cache import ResponseCache
+from jobtechs.fetcher import SessionFactory, ThrottledFetcher
+from stub_server import StubServer
+
+
+class TestResponseCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_put_get(self):
+        cache = ResponseCache(self.directory, ttl=60)
+        cache.put('http://A.com:80/job#top', 200,
+                  {'ETag': '"1"', 'Content-Encoding': 'gzip', 'Content-Type': 'text/html'},
+                  b'<html></html>')
+        entry = cache.get('http://a.com/job')
+        self.assertEqual(b'<html></html>', entry.body)
+        self.assertNotIn('Content-Encoding', entry.headers)
+        self.assertEqual({'If-None-Match': '"1"'}, entry.validators())
+        self.assertTrue(cache.is_fresh('http://a.com/job'))
+        self.assertIsNotNone(cache.get_fresh('http://a.com/job'))
+        self.assertEqual('<html></html>', entry.to_response().text)
+
+    def test_errors_not_cached(self):
+        cache = ResponseCache(self.directory, ttl=60)
+        cache.put('http://a.com/job', 404, {}, b'')
+        self.assertIsNone(cache.get('http://a.com/job'))
+
+    def test_stale(self):
+        cache = ResponseCache(self.directory, ttl=None)
+        cache.put('http://a.com/job', 200, {}, b'x')
+        self.assertIsNone(cache.get_fresh('http://a.com/job'))
+        self.assertFalse(cache.is_fresh('http://a.com/job'))
+
+    def test_prune(self):
+        cache = ResponseCache(self.directory, max_size=1500)
+        for i in range(3):
+            cache.put('http://a.com/{}'.format(i), 200, {}, b'x' * 500)
+            time.sleep(0.01)
+        cache.prune()
+        self.assertIsNone(cache.get('http://a.com/0'))
+        self.assertIsNotNone(cache.get('http://a.com/2'))
+
+
+class TestFetcherCache(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = StubServer({'/job': 'job'})
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def make_fetcher(self, ttl):
+        fetcher = ThrottledFetcher(
+            parser=None, terms_extractor=None, max_rps=0,
+            session_factory=SessionFactory(retries=0),
+            cache=ResponseCache(self.directory, ttl=ttl))
+        fetcher._local = threading.local()
+        return fetcher
+
+    def test_revalidation(self):
+        fetcher = self.make_fetcher(ttl=None)
+        url = self.server.url('/job')
+        self.assertEqual(200, fetcher._fetch(url).status_code)
+        res = fetcher._fetch(url)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual('job', res.text)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_fresh_not_requested(self):
+        url = self.server.url('/job')
+        self.make_fetcher(ttl=60)._fetch(url)
+        fetcher = self.make_fetcher(ttl=60)
+        q_out = queue.Queue()
+        fetcher.q_out = q_out
+
+        class Parser:
+            def parse_page(self, url, text, extractor, encoding=None):
+                return text, None
+
+        fetcher.parser = Parser()
+        fetcher.q_in.put(url)
+        fetcher._process_url(url)
+        self.assertEqual(b'job', q_out.get_nowait())
+        self.assertEqual(1, len(self.server.requests))
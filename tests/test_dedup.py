@@ -0,0 +1,22 @@
+from unittest import TestCase
+
+from jobtechs.dedup import BloomFilter, ScalableBloomFilter
+
+
+class TestBloomFilter(TestCase):
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+        urls = ['http://a.com/{}'.format(i) for i in range(1000)]
+        self.assertFalse(any(bloom.add(url) for url in urls))
+        self.assertTrue(all(bloom.add(url) for url in urls))
+        self.assertEqual(1000, len(bloom))
+        false_positives = sum('http://b.com/{}'.format(i) in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_scalable_grows(self):
+        seen = ScalableBloomFilter(initial_capacity=100, error_rate=0.001)
+        urls = ['http://a.com/{}'.format(i) for i in range(2000)]
+        added = sum(not seen.add(url) for url in urls)
+        self.assertGreaterEqual(added, 1995)
+        self.assertTrue(all(url in seen for url in urls))
+        self.assertEqual([100, 400, 1600], [filter_.capacity for filter_ in seen.filters])
@@ -0,0 +1,120 @@
+import queue
+import threading
+import time
+from unittest import TestCase
+
+from jobtechs.distributed import (
+    GlobalHostLimiter, GlobalRateLimits, RemoteSink, WorkQueue, connect, serve, stop_serving)
+from jobtechs.parser import Result, Vocabulary
+
+AUTHKEY = b'secret'
+
+
+def make_result(url, vocabulary):
+    return Result(url, 'company', [0], 'site', vocabulary)
+
+
+class TestWorkQueue(TestCase):
+    def setUp(self):
+        self.q_out = queue.Queue()
+        self.q_err = queue.Queue()
+        self.work = WorkQueue(self.q_out, self.q_err, lease_timeout=0.05)
+        self.vocabulary = Vocabulary(['python'])
+
+    def test_results_release_leases(self):
+        for url in ('http://a/1', 'http://a/2'):
+            self.work.put(url)
+        self.assertEqual('http://a/1', self.work.take('w1'))
+        self.assertEqual('http://a/2', self.work.take('w2'))
+        self.assertTrue(self.work.put_result('w1', make_result('http://a/1', self.vocabulary)))
+        self.assertTrue(self.work.put_error('w2', 'http://a/2', 'HTTP 404'))
+        self.assertEqual('http://a/1', self.q_out.get_nowait().url)
+        self.assertEqual(('http://a/2', 'HTTP 404'), self.q_err.get_nowait())
+        # nothing is leased any more
+        self.assertFalse(self.work.put_error('w2', 'http://a/2', 'HTTP 404'))
+
+    def test_lost_worker_urls_requeued(self):
+        self.work.put('http://a/1')
+        self.assertEqual('http://a/1', self.work.take('w1'))
+        time.sleep(0.1)
+        self.assertEqual(1, self.work.expire())
+        self.assertEqual(0, self.work.workers())
+        self.assertEqual('http://a/1', self.work.take('w2'))
+        # the late result of the lost worker is dropped
+        sink = RemoteSink(self.work, 'w1')
+        sink.write(make_result('http://a/1', self.vocabulary))
+        self.assertEqual((0, 1), (sink.rows, sink.dropped))
+        self.assertTrue(self.q_out.empty())
+
+    def test_take_stops_on_finish(self):
+        started = time.monotonic()
+        self.assertIsNone(self.work.take('w1', timeout=0.05))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.work.finish()
+        self.assertIsNone(self.work.take('w1', timeout=10))
+        self.assertTrue(self.work.is_finished())
+
+
+class TestGlobalRateLimits(TestCase):
+    def test_hosts_limited_separately(self):
+        limits = GlobalRateLimits(max_rps=0, host_rps=10)
+        delays = [limits.reserve('a.com') for _ in range(3)] + [limits.reserve('b.com')]
+        self.assertAlmostEqual(0, delays[0], places=2)
+        self.assertAlmostEqual(0.1, delays[1], places=2)
+        self.assertAlmostEqual(0.2, delays[2], places=2)
+        self.assertAlmostEqual(0, delays[3], places=2)
+        self.assertEqual({'a.com': 3, 'b.com': 1}, limits.counts())
+
+    def test_past_hosts_dropped(self):
+        limits = GlobalRateLimits(host_rps=100)
+        for i in range(100):
+            limits.reserve('host{}.com'.format(i))
+        time.sleep(0.02)
+        limits.reserve('last.com')
+        self.assertEqual(['last.com'], list(limits._tats))
+
+
+class TestServe(TestCase):
+    def test_workers_share_queue_and_limits(self):
+        q_out = queue.Queue()
+        work = WorkQueue(q_out, queue.Queue(), info={'terms_digest': 'x'})
+        limits = GlobalRateLimits(host_rps=20)
+        server = serve(work, limits, ('127.0.0.1', 0), AUTHKEY)
+        self.addCleanup(stop_serving, server)
+        vocabulary = Vocabulary(['python'])
+        for i in range(10):
+            work.put('http://a.com/{}'.format(i))
+        work.finish()
+
+        def run_worker(name):
+            worker_work, worker_limits = connect(server.address, AUTHKEY)
+            limiter = GlobalHostLimiter(worker_limits)
+            sink = RemoteSink(worker_work, name)
+            while True:
+                url = worker_work.take(name, 1.)
+                if url is None:
+                    break
+                limiter.acquire('a.com')
+                sink.write(make_result(url, vocabulary))
+            worker_work.leave(name)
+
+        started = time.monotonic()
+        workers = [threading.Thread(target=run_worker, args=(name,)) for name in ('w1', 'w2')]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        # 10 requests at 20 rps with the first one free, whichever worker sends them
+        self.assertGreaterEqual(time.monotonic() - started, 9 / 20)
+        self.assertEqual(['http://a.com/{}'.format(i) for i in range(10)],
+                         sorted((q_out.get_nowait().url for _ in range(10)),
+                                key=lambda url: int(url.rsplit('/', 1)[1])))
+        self.assertEqual(0, work.workers())
+        self.assertEqual('x', connect(server.address, AUTHKEY)[0].info()['terms_digest'])
+
+    def test_stop_serving(self):
+        server = serve(WorkQueue(queue.Queue(), queue.Queue()), GlobalRateLimits(),
+                       ('127.0.0.1', 0), AUTHKEY)
+        stop_serving(server)
+        server.accept_thread.join(5)
+        self.assertFalse(server.accept_thread.is_alive())
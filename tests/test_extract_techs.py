@@ -0,0 +1,335 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import TestCase
+from urllib.parse import quote, unquote
+
+from jobtechs.asyncfetch import aiohttp
+from jobtechs.distributed import AUTHKEY_ENV
+from jobtechs.fetcher import SessionFactory
+from jobtechs.ledger import Ledger
+from jobtechs.parser import PageParser
+from jobtechs.scripts.extract_techs import (
+    AsyncTechsExtractionRunner, CoordinatorRunner, PagesReplayRunner, TechsExtractionRunner,
+    WorkerRunner)
+from jobtechs.sinks import ResultSink
+from stub_server import StubServer
+
+PAGE = '<html><head><title>Job</title></head><body><p>Python, C# developer</p></body></html>'
+
+
+class EmbeddingPageParser(PageParser):
+    """Reports pages with /embed in the url as embedding the job at the ?job= url."""
+
+    def find_external_job_url(self, context):
+        if '/embed' in context.url:
+            return unquote(context.url.split('?job=', 1)[1])
+        return None
+
+
+class EmbeddingParsersMixin:
+    """Parses all the pages with EmbeddingPageParser."""
+
+    def make_parsers(self):
+        # pylint: disable=missing-docstring
+        return {'default': EmbeddingPageParser(save_pages_to=self.save_pages_to)}
+
+
+class EmbeddingRunner(EmbeddingParsersMixin, TechsExtractionRunner):
+    pass
+
+
+class AsyncEmbeddingRunner(EmbeddingParsersMixin, AsyncTechsExtractionRunner):
+    pass
+
+
+class ReplayEmbeddingRunner(EmbeddingParsersMixin, PagesReplayRunner):
+    pass
+
+
+class ListSink(ResultSink):
+    """Keeps the written results in a list."""
+
+    def __init__(self, batch_size=1000):
+        super().__init__(io.BytesIO(), batch_size)
+        self.results = []
+
+    def _write_batch(self, results):
+        self.results.extend(results)
+
+
+class SlowSink(ListSink):
+    """Writes a result every delay seconds recording how far the lines are taken ahead."""
+
+    def __init__(self, lines, delay):
+        super().__init__(batch_size=1)
+        self.lines = lines
+        self.delay = delay
+        self.lags = []
+
+    def _write_batch(self, results):
+        time.sleep(self.delay)
+        super()._write_batch(results)
+        self.lags.append(self.lines.taken - len(self.results))
+
+
+class CountingLines:
+    """Iterates over the lines counting the ones taken."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.taken = 0
+
+    def __iter__(self):
+        for line in self.lines:
+            self.taken += 1
+            yield line
+
+
+class PagesByPath(dict):
+    """Serves the pages by the paths of the requests without the query."""
+
+    def get(self, path, default=None):
+        return super().get(path.split('?', 1)[0], default)
+
+
+class RunnerTestCase(TestCase):
+    """Runs the runners against a stub server of PAGE at /job<n> and /embed<n>."""
+    # a run taking longer is considered deadlocked
+    RUN_TIMEOUT = 30
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.terms_path = os.path.join(self.directory, 'techs.txt')
+        with open(self.terms_path, 'w') as file_:
+            print('Python', 'C#', sep='\n', file=file_)
+        self.errors_path = os.path.join(self.directory, 'failed_urls.txt')
+        self.server = StubServer(PagesByPath(
+            {'/{}{}'.format(kind, i): PAGE for kind in ('job', 'embed') for i in range(100)}))
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def embed_url(self, number, job_url):
+        """Return the url of the page embedding the job at job_url."""
+        return self.server.url('/embed{}?job={}'.format(number, quote(job_url, safe='')))
+
+    def make_runner(self, runner_cls=EmbeddingRunner, **kwargs):
+        """Create a runner writing to a ListSink."""
+        kwargs = dict(
+            dict(terms_path=self.terms_path, errors_path=self.errors_path, sink=ListSink(),
+                 max_rps=0, host_rps=0, parse_workers=0, stats_interval=0,
+                 terms_reload_interval=None, session_factory=SessionFactory(retries=0)),
+            **kwargs)
+        return runner_cls(**kwargs)
+
+    def run_runner(self, runner, infile):
+        """Run the runner in a thread failing the test if it does not return in time."""
+        thread = threading.Thread(target=runner.run, args=(infile,), daemon=True)
+        thread.start()
+        thread.join(self.RUN_TIMEOUT)
+        self.assertFalse(thread.is_alive(), 'the run did not finish')
+
+    def run_urls(self, urls, runner_cls=EmbeddingRunner, **kwargs):
+        """Run the urls through a new runner and close it.
+
+        Returns the runner, the urls of the results and the lines of the errors file."""
+        runner = self.make_runner(runner_cls, **kwargs)
+        try:
+            self.run_runner(runner, io.StringIO(''.join(url + '\n' for url in urls)))
+        finally:
+            runner.close()
+        with open(self.errors_path) as errors_file:
+            errors = errors_file.read().splitlines()
+        return runner, [result.url for result in runner.sink.results], errors
+
+    def requested(self, path):
+        """Return the number of the requests of the path, with any query."""
+        return sum(request.split('?', 1)[0] == path for request in self.server.requests)
+
+
+class TestFollowUp(RunnerTestCase):
+    def runner_classes(self):
+        yield EmbeddingRunner
+        if aiohttp is not None:
+            yield AsyncEmbeddingRunner
+
+    def test_followed_url_written_once(self):
+        for runner_cls in self.runner_classes():
+            with self.subTest(runner=runner_cls.__name__):
+                self.server.requests.clear()
+                job_url = self.server.url('/job1')
+                _, results, errors = self.run_urls(
+                    [self.embed_url(1, job_url), self.embed_url(2, job_url)], runner_cls,
+                    parse_workers=1)
+                self.assertEqual([job_url], results)
+                self.assertEqual([], errors)
+                self.assertEqual(1, self.requested('/job1'))
+
+    def test_follow_depth(self):
+        inner_url = self.embed_url(2, self.server.url('/job2'))
+        for follow_depth in (0, 1):
+            with self.subTest(follow_depth=follow_depth):
+                self.server.requests.clear()
+                _, results, errors = self.run_urls(
+                    [self.embed_url(1, inner_url)], follow_depth=follow_depth)
+                self.assertEqual([], results)
+                # the last page within the depth is reported as an error
+                self.assertEqual([self.embed_url(1, inner_url), inner_url][follow_depth],
+                                 errors[0].split('\t')[0])
+                self.assertEqual(1, len(errors))
+                self.assertEqual(follow_depth, self.requested('/embed2'))
+                self.assertEqual(0, self.requested('/job2'))
+
+    def test_seen_url_not_followed(self):
+        job_url = self.server.url('/job1')
+        _, results, errors = self.run_urls([job_url, self.embed_url(1, job_url)])
+        self.assertEqual([job_url], results)
+        self.assertEqual([], errors)
+        self.assertEqual(1, self.requested('/job1'))
+
+    def test_runs_return(self):
+        urls = [self.server.url('/job{}'.format(i)) for i in range(5)] + [
+            self.embed_url(i, self.server.url('/job{}'.format(i + 5))) for i in range(5)] + [
+            self.server.url('/missing{}'.format(i)) for i in range(5)]
+        for runner_cls in self.runner_classes():
+            with self.subTest(runner=runner_cls.__name__):
+                pages_dir = os.path.join(self.directory, runner_cls.__name__)
+                os.mkdir(pages_dir)
+                runner, results, errors = self.run_urls(
+                    urls, runner_cls, parse_workers=1, save_pages_to=pages_dir)
+                self.assertEqual(10, len(results))
+                self.assertEqual(5, len(errors))
+                self.assertEqual(0, runner._pending)
+
+        with self.subTest(runner=ReplayEmbeddingRunner.__name__):
+            runner = self.make_runner(ReplayEmbeddingRunner, parse_workers=1, chunk_size=2)
+            try:
+                self.run_runner(runner, pages_dir)
+            finally:
+                runner.close()
+            # the embedding pages are not followed in a replay
+            self.assertEqual(10, runner.sink.rows)
+            with open(self.errors_path) as errors_file:
+                self.assertEqual(5, len(errors_file.read().splitlines()))
+
+
+class TestResume(RunnerTestCase):
+    def test_second_run_fetches_failed_urls(self):
+        ledger_path = os.path.join(self.directory, 'ledger.db')
+        urls = [self.server.url('/job1'), self.embed_url(1, self.server.url('/job2')),
+                self.server.url('/missing')]
+        _, results, errors = self.run_urls(urls, ledger=Ledger(ledger_path))
+        self.assertEqual(2, len(results))
+        self.assertEqual(1, len(errors))
+
+        self.server.requests.clear()
+        runner, results, errors = self.run_urls(urls, ledger=Ledger(ledger_path))
+        # the embedding page is skipped as its job description is parsed
+        self.assertEqual(['/missing'], self.server.requests)
+        self.assertEqual([], results)
+        self.assertEqual([urls[2]], [error.split('\t')[0] for error in errors])
+        self.assertEqual(2, runner.ledger.skipped)
+
+
+class TestBackpressure(RunnerTestCase):
+    QUEUE_SIZE = 5
+
+    def test_input_read_as_results_written(self):
+        lines = CountingLines([self.server.url('/job{}'.format(i)) + '\n' for i in range(100)])
+        sink = SlowSink(lines, 0.01)
+        runner = self.make_runner(sink=sink, queue_size=self.QUEUE_SIZE, default_workers=2)
+        try:
+            self.run_runner(runner, lines)
+        finally:
+            runner.close()
+        self.assertEqual(100, len(sink.results))
+        # the urls in the input queue of the fetcher, its scheduler and its workers,
+        # the results queue and the one being written
+        capacity = 3 * self.QUEUE_SIZE + 2 + 1
+        self.assertLessEqual(max(sink.lags), capacity)
+
+    def test_follow_ups_with_full_errors_queue(self):
+        # every page is reported to the errors queue and followed while the queue is full
+        urls = [self.embed_url(i, self.server.url('/job{}'.format(i))) for i in range(40)]
+        _, results, errors = self.run_urls(urls, queue_size=2, default_workers=2)
+        self.assertEqual(40, len(results))
+        self.assertEqual([], errors)
+
+
+class TestDedup(RunnerTestCase):
+    def test_variants_requested_once(self):
+        job_url = self.server.url('/job1')
+        variants = [job_url, job_url, job_url + '?utm_source=feed',
+                    job_url.replace('http://', 'HTTP://') + '?gclid=1&utm_medium=cpc',
+                    job_url + '#apply']
+        runner, results, errors = self.run_urls(variants + [self.server.url('/job2')])
+        self.assertEqual([1, 1], [self.requested('/job1'), self.requested('/job2')])
+        self.assertEqual([job_url, self.server.url('/job2')], sorted(results))
+        self.assertEqual([], errors)
+        self.assertEqual(4, runner.duplicates)
+
+        # without dedup every variant is requested
+        self.server.requests.clear()
+        runner, results, _ = self.run_urls(variants, dedup=False)
+        self.assertEqual(5, self.requested('/job1'))
+        self.assertEqual([job_url] * 5, results)
+        self.assertEqual(0, runner.duplicates)
+
+
+class TestDistributed(RunnerTestCase):
+    AUTHKEY = b'secret'
+
+    def setUp(self):
+        super().setUp()
+        self.coordinator = self.make_runner(
+            CoordinatorRunner, address=('127.0.0.1', 0), authkey=self.AUTHKEY, lease_timeout=10)
+        self.address = '{}:{}'.format(*self.coordinator._server.address)
+
+    def start_worker(self):
+        """Start a worker process of the command line script."""
+        worker = subprocess.Popen(
+            [sys.executable, '-m', 'jobtechs.scripts.extract_techs', '--worker', self.address,
+             '--techs-file', self.terms_path,
+             '--errors-file', os.path.join(self.directory, 'worker_failed_urls.txt'),
+             '--log-file', os.path.join(self.directory, 'worker.log'),
+             '--parse-workers', '1', '--retries', '0'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env=dict(os.environ, **{AUTHKEY_ENV: self.AUTHKEY.decode()}))
+        self.addCleanup(worker.kill)
+        return worker
+
+    def test_worker_process(self):
+        urls = [self.server.url('/job{}'.format(i)) for i in range(30)] + [
+            self.server.url('/missing')]
+        try:
+            worker = self.start_worker()
+            self.run_runner(self.coordinator, io.StringIO(''.join(url + '\n' for url in urls)))
+        finally:
+            # lets the worker finish
+            self.coordinator.close()
+        self.assertEqual(0, worker.wait(self.RUN_TIMEOUT))
+        self.assertEqual(sorted(urls[:30]),
+                         sorted(result.url for result in self.coordinator.sink.results))
+        with open(self.errors_path) as errors_file:
+            self.assertEqual([urls[30]], [line.split('\t')[0] for line in errors_file])
+        self.assertEqual(31, len(self.server.requests))
+
+    def test_terms_differ(self):
+        terms_path = os.path.join(self.directory, 'worker_techs.txt')
+        with open(terms_path, 'w') as file_:
+            print('Python', file=file_)
+        try:
+            with self.assertRaisesRegex(RuntimeError, 'differ'):
+                WorkerRunner(
+                    self.coordinator._server.address, self.AUTHKEY, terms_path=terms_path,
+                    errors_path=os.path.join(self.directory, 'worker_failed_urls.txt'),
+                    parse_workers=0, stats_interval=0)
+            self.assertEqual(0, self.coordinator._work.workers())
+        finally:
+            self.coordinator.close()
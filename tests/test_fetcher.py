@@ -0,0 +1,94 @@
+import os
+import queue
+import tempfile
+import threading
+from unittest import TestCase
+
+from jobtechs.fetcher import SessionFactory, ThrottledFetcher
+from jobtechs.metrics import end_trace, start_trace
+from jobtechs.parser import AutomatonTermsExtractor, PageParser
+from jobtechs.parsepool import ParseWorker
+from stub_server import StubServer
+
+
+class TestThrottledFetcherSessions(TestCase):
+    def setUp(self):
+        self.server = StubServer({'/a': 'a', '/b': 'b'})
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+        self.fetcher = ThrottledFetcher(
+            parser=None, terms_extractor=None, max_rps=0,
+            session_factory=SessionFactory(retries=0))
+        self.fetcher._local = threading.local()
+
+    def test_connections_reused(self):
+        for path in ('/a', '/b', '/a'):
+            res = self.fetcher._fetch(self.server.url(path))
+            self.assertEqual(path[1:], res.text)
+        self.assertEqual(3, self.fetcher.requests_sent.value)
+        self.assertEqual(1, self.fetcher.connections_new.value)
+        self.assertEqual(2, self.fetcher.connections_reused)
+
+    def test_session_per_thread(self):
+        self.fetcher._fetch(self.server.url('/a'))
+        thread = threading.Thread(target=self.fetcher._fetch, args=(self.server.url('/b'),))
+        thread.start()
+        thread.join()
+        self.assertEqual(2, len(self.fetcher._sessions))
+        self.assertEqual(2, self.fetcher.connections_new.value)
+
+    def test_failed_run_leaves_stop_undone(self):
+        def fail():
+            raise RuntimeError('failed')
+        self.fetcher._run = fail
+        # the None was not taken, only the url put is to be marked done
+        self.fetcher.q_in.put(self.server.url('/a'))
+        with self.assertRaises(RuntimeError):
+            self.fetcher.run()
+        self.fetcher.q_in.get()
+        self.fetcher.q_in.task_done()
+        self.fetcher.q_in.join()
+
+    def test_fetch_timed(self):
+        trace = start_trace(self.server.url('/a'))
+        try:
+            self.fetcher._fetch(self.server.url('/a'))
+            self.fetcher._fetch(self.server.url('/a'))
+        finally:
+            end_trace()
+        self.assertEqual({'connect', 'ttfb', 'download'}, set(trace.stages))
+        self.assertEqual(2, trace.bytes)
+        # the second request reuses the connection
+        self.assertEqual(1, self.fetcher.connections_new.value)
+
+
+class TestParseWorker(TestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file_:
+            print('Python', file=file_)
+        self.addCleanup(os.remove, file_.name)
+        self.extractor = AutomatonTermsExtractor(file_.name)
+        self.server = StubServer({'/job': '<html><body><p>Python developer</p></body></html>'})
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__)
+
+    def test_pages_parsed_by_worker(self):
+        q_pages, q_out, q_err, q_metrics = (queue.Queue() for _ in range(4))
+        fetcher = ThrottledFetcher(
+            PageParser(), None, q_out=q_out, q_err=q_err, max_rps=0,
+            session_factory=SessionFactory(retries=0), q_pages=q_pages)
+        fetcher._local = threading.local()
+        urls = [self.server.url('/job'), self.server.url('/missing')]
+        for url in urls:
+            fetcher.q_in.put(url)
+            fetcher._process_url(url)
+        # only the fetched page is passed on, the error is reported by the fetcher
+        self.assertEqual(1, q_pages.qsize())
+        self.assertEqual(urls[1], q_err.get_nowait()[0])
+
+        q_pages.put(None)
+        worker = ParseWorker({'default': PageParser()}, self.extractor, q_pages, q_out, q_err,
+                             q_metrics=q_metrics)
+        worker.run()
+        self.assertEqual(['python'], q_out.get_nowait().techs)
+        self.assertTrue(q_err.empty())
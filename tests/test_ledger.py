@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jobtechs.ledger import FAILED, FOLLOWED, PARSED, QUEUED, Ledger
+
+
+class TestLedger(TestCase):
+    URLS = ['http://a.com/1', 'http://a.com/2', 'http://a.com/3']
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'ledger.db')
+
+    def test_resume(self):
+        ledger = Ledger(self.path)
+        self.assertEqual(self.URLS[:2], list(ledger.iter_unfinished(self.URLS[:2])))
+        ledger.mark_parsed('HTTP://A.com:80/1')
+        ledger.mark_failed(self.URLS[1], 'Not found')
+        ledger.close()
+
+        ledger = Ledger(self.path)
+        self.addCleanup(ledger.close)
+        self.assertEqual((PARSED, None), ledger.get_state(self.URLS[0]))
+        self.assertEqual((FAILED, 'Not found'), ledger.get_state(self.URLS[1]))
+        self.assertEqual(self.URLS[1:], list(ledger.iter_unfinished(self.URLS, chunk_size=2)))
+        self.assertEqual(1, ledger.skipped)
+        self.assertEqual({PARSED: 1, QUEUED: 2}, ledger.counts())
+
+    def test_followed_skipped_once_target_parsed(self):
+        ledger = Ledger(self.path)
+        list(ledger.iter_unfinished(self.URLS))
+        ledger.mark_followed(self.URLS[0], 'http://b.com/1')
+        ledger.mark_followed(self.URLS[1], 'http://b.com/2')
+        ledger.mark_parsed('http://b.com/1')
+        ledger.mark_failed('http://b.com/2', 'Not found')
+        # the buffered updates are looked up without writing them
+        self.assertEqual((PARSED, None), ledger.get_state('http://b.com/1'))
+        self.assertEqual({}, Ledger(self.path).counts())
+        ledger.close()
+
+        ledger = Ledger(self.path)
+        self.addCleanup(ledger.close)
+        self.assertEqual((FOLLOWED, None), ledger.get_state(self.URLS[0]))
+        self.assertEqual(self.URLS[1:], list(ledger.iter_unfinished(self.URLS)))
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from jobtechs.metrics import (
+    BUCKETS, Metrics, Trace, current_trace, end_trace, iter_timed, start_trace, timed)
+
+
+class TestTrace(TestCase):
+    def tearDown(self):
+        end_trace()
+
+    def test_no_trace(self):
+        with timed('parse'):
+            pass
+        self.assertEqual(list(iter_timed([1, 2], 'parse')), [1, 2])
+        self.assertIsNone(current_trace())
+
+    def test_stages(self):
+        trace = start_trace('http://a.com/job', 'default', 'PageParser')
+
+        def chunks():
+            yield 'a'
+            time.sleep(0.02)
+            yield 'b'
+
+        with timed('match'):
+            self.assertEqual(list(iter_timed(chunks(), 'parse', 'match')), ['a', 'b'])
+        with timed('match'):
+            pass
+        self.assertIs(end_trace(), trace)
+        self.assertIsNone(current_trace())
+        self.assertGreaterEqual(trace.stages['parse'], 0.02)
+        # producing the chunks is not counted as matching them
+        self.assertLess(trace.stages['match'], 0.02)
+
+    def test_none_items_timed(self):
+        start_trace('http://a.com/job')
+        try:
+            self.assertEqual([None, 'a'], list(iter_timed([None, 'a'], 'parse')))
+        finally:
+            end_trace()
+
+
+class TestMetrics(TestCase):
+    def make_trace(self, url, parse, outcome='ok'):
+        trace = Trace(url, 'default', 'PageParser')
+        trace.add('parse', parse)
+        trace.bytes = 100
+        trace.outcome = outcome
+        return trace
+
+    def test_merge(self):
+        first, second, total = Metrics(), Metrics(), Metrics()
+        first.record(self.make_trace('http://a.com/1', 0.002))
+        second.record(self.make_trace('http://a.com/2', 100., 'error'))
+        second.observe('write', 0.0001)
+        total.merge(first.take())
+        total.merge(second.take())
+        self.assertEqual(first.take(), {'histograms': {}, 'urls': {}, 'bytes': {}})
+
+        self.assertEqual(total.stage_totals(), {'parse': (2, 100.002), 'write': (1, 0.0001)})
+        self.assertEqual(total.bytes, {'default': 200})
+        histogram = total.histograms['parse', 'default', 'PageParser']
+        # 0.002 is in the second bucket, 100 only in +Inf
+        self.assertEqual(histogram[:len(BUCKETS) + 2], [0, 1] + [0] * (len(BUCKETS) - 2) + [1, 2])
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.record(self.make_trace('http://a.com/1', 0.002))
+        text = metrics.to_prometheus({'out': 3, 'err': None})
+        lines = text.splitlines()
+        labels = 'stage="parse",fetcher="default",parser="PageParser"'
+        self.assertIn('jobtechs_stage_seconds_bucket{%s,le="0.001"} 0' % labels, lines)
+        self.assertIn('jobtechs_stage_seconds_bucket{%s,le="0.005"} 1' % labels, lines)
+        self.assertIn('jobtechs_stage_seconds_bucket{%s,le="+Inf"} 1' % labels, lines)
+        self.assertIn('jobtechs_stage_seconds_count{%s} 1' % labels, lines)
+        self.assertIn(
+            'jobtechs_urls_total{fetcher="default",parser="PageParser",outcome="ok"} 1', lines)
+        self.assertIn('jobtechs_fetched_bytes_total{fetcher="default"} 100', lines)
+        self.assertIn('jobtechs_queue_depth{queue="out"} 3', lines)
+        self.assertFalse([line for line in lines if 'queue="err"' in line])
+
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'jobtechs.prom')
+            metrics.write_prometheus(path)
+            self.assertEqual(os.listdir(directory), ['jobtechs.prom'])
+        finally:
+            shutil.rmtree(directory)
@@ -1,5 +1,15 @@
+import os
+import pickle
+import tempfile
 from unittest import TestCase
-from jobtechs.parser import iter_n_grams
+
+import lxml.etree
+import lxml.html as etree
+
+from jobtechs.parser import (
+    iter_n_grams, iter_body_text, guess_encoding, parse_html, canonicalize_url, TermsExtractor,
+    AutomatonTermsExtractor, Vocabulary, Result, PageContext, PageParser, DiceParser,
+    GreenHouseParser, IndeedParser, NewtonSoftwareParser)
 
 class TestIterNGrams(TestCase):
     def test_unigrams(self):
@@ -55,3 +65,172 @@ class TestIterNGrams(TestCase):
             [('c#',), ('developer',), ('c#', 'developer')],
             list(iter_n_grams(text, 2))
         )
+
+
+class TestAutomatonTermsExtractor(TestCase):
+    TERMS = ['a', 'a b', 'b c', 'a b c', 'node.js', '.net', 'microsoft .net',
+             'node.js.io', 'c# developer', 'New Relic', 'Apache Hadoop']
+
+    TEXTS = ['a b c', 'a node.js developer.', 'a .net developer', 'microsoft .net',
+             'a node.js.io file', 'c# developer', 'a, b c', 'New Relic, Apache. Hadoop', '']
+
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file_:
+            print(*self.TERMS, sep='\n', file=file_)
+        self.addCleanup(os.remove, file_.name)
+        self.ngrams_extractor = TermsExtractor(file_.name)
+        self.automaton_extractor = AutomatonTermsExtractor(file_.name)
+
+    def test_same_as_ngrams(self):
+        for text in self.TEXTS:
+            with self.subTest(text=text):
+                self.assertEqual(self.ngrams_extractor.extract_terms(text),
+                                 self.automaton_extractor.extract_terms(text))
+
+    def test_extract_terms_many(self):
+        for extractor in (self.ngrams_extractor, self.automaton_extractor):
+            with self.subTest(extractor=type(extractor).__name__):
+                self.assertEqual([extractor.extract_terms(text) for text in self.TEXTS],
+                                 extractor.extract_terms_many(iter(self.TEXTS)))
+
+    def test_extract_terms_from_chunks(self):
+        extractor = self.automaton_extractor
+        for text in self.TEXTS:
+            for size in range(1, 4):
+                chunks = [text[i:i + size] for i in range(0, len(text), size)]
+                with self.subTest(chunks=chunks):
+                    self.assertEqual(extractor.extract_terms(text),
+                                     extractor.extract_terms_from_chunks(chunks))
+
+    def test_overlapping_terms(self):
+        extractor = self.automaton_extractor
+        self.assertEqual(['a', 'a b', 'a b c', 'b c'],
+                         extractor.terms_to_list(extractor.extract_terms('A b c')))
+
+    def test_punctuation_breaks_terms(self):
+        extractor = self.automaton_extractor
+        self.assertEqual(['a'], extractor.terms_to_list(extractor.extract_terms('a, b. c')))
+
+
+class TestIterBodyText(TestCase):
+    PAGE = ('<html><head><title>Title</title><style>p {}</style></head><body>'
+            '<p>C# &amp; <b>.NET</b></p><script>var a = "<p>x</p>";</script> tail'
+            '<!-- comment --><style>b {}</style> end</body></html>')
+
+    def test_same_as_tree(self):
+        tree = etree.fromstring(self.PAGE)
+        for elem in tree.xpath('.//script | .//style'):
+            elem.drop_tree()
+        for size in (1, 7, 1000):
+            with self.subTest(size=size):
+                self.assertEqual(tree.xpath('string(./body)'),
+                                 ''.join(iter_body_text(self.PAGE, size)))
+
+    def test_parse_page_streams_description(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file_:
+            print('c#', '.net', 'title', sep='\n', file=file_)
+        self.addCleanup(os.remove, file_.name)
+        result, error = PageParser().parse_page(
+            'http://a.com/job', self.PAGE, AutomatonTermsExtractor(file_.name))
+        self.assertIsNone(error)
+        self.assertEqual(['.net', 'c#'], result.techs)
+
+
+class TestEncoding(TestCase):
+    BODY = '<body>Разработчик C#, Java</body></html>'
+
+    def test_guess_encoding(self):
+        meta = b'<html><head><meta charset="windows-1251"></head>'
+        self.assertEqual('cp1251', guess_encoding(meta))
+        self.assertEqual('koi8-r', guess_encoding(meta, 'KOI8-R'))
+        self.assertEqual('cp1251', guess_encoding(meta, 'unknown'))
+        self.assertEqual('cp1252', guess_encoding(b'<html>', 'ISO-8859-1'))
+        self.assertEqual('utf-8', guess_encoding(b'<html>'))
+        self.assertEqual('utf-16-le', guess_encoding('<html>'.encode('utf-16'), 'cp1251'))
+
+    def test_bytes_decoded_by_lxml(self):
+        meta = ('<html><head><meta http-equiv="Content-Type" content="text/html; '
+                'charset=windows-1251"></head>')
+        for html, charset, encoding in (('<html>' + self.BODY, 'utf-8', None),
+                                        ('<html>' + self.BODY, 'cp1251', 'cp1251'),
+                                        (meta + self.BODY, 'cp1251', None)):
+            content = html.encode(charset)
+            with self.subTest(html=html, encoding=encoding):
+                tree = parse_html(content, encoding)
+                self.assertEqual('Разработчик C#, Java', tree.xpath('string(./body)'))
+                self.assertEqual('Разработчик C#, Java',
+                                 ''.join(iter_body_text(content, 5, encoding)))
+
+
+class TestResult(TestCase):
+    def test_pickled_by_vocabulary_digest(self):
+        vocabulary = Vocabulary([('node.js',), ('c#',), ('new', 'relic')])
+        result = Result('http://a.com/job', 'A', vocabulary.to_array({2, 0}), 'http://a.com',
+                        vocabulary)
+        self.assertEqual(['c#', 'node.js'], result.techs)
+
+        data = pickle.dumps(result)
+        self.assertNotIn(b'node.js', data)
+        restored = pickle.loads(data)
+        self.assertIs(vocabulary, restored.vocabulary)
+        self.assertEqual(str(result), str(restored))
+
+
+class TestExternalJobDetection(TestCase):
+    PAGE = ('<html><head><script src="https://boards.greenhouse.io/embed/job_board/js?for=acme">'
+            '</script></head><body>Job</body></html>')
+
+    def setUp(self):
+        self.parser = PageParser(agg_parsers=[NewtonSoftwareParser(), GreenHouseParser(),
+                                              IndeedParser()])
+
+    def test_greenhouse_embed(self):
+        url = 'https://acme.com/careers?gh_jid=42'
+        context = PageContext(url, self.PAGE)
+        self.assertEqual('https://boards.greenhouse.io/embed/job_app?for=acme&token=42',
+                         self.parser.find_external_job_url(context))
+        self.assertEqual(['https://boards.greenhouse.io/embed/job_board/js?for=acme'],
+                         context.script_srcs)
+
+    def test_page_without_markers_is_not_parsed(self):
+        context = PageContext('https://acme.com/careers?id=1', self.PAGE)
+        self.assertIsNone(self.parser.find_external_job_url(context))
+        self.assertIsNone(context._tree)
+
+
+class TestSelectors(TestCase):
+    def test_compiled_at_class_creation(self):
+        self.assertIsInstance(IndeedParser._xpaths['description'], lxml.etree.XPath)
+        # inherited selectors are shared, overridden ones are replaced
+        self.assertIs(PageParser._xpaths['scripts_and_styles'],
+                      IndeedParser._xpaths['scripts_and_styles'])
+        self.assertIsNot(PageParser._xpaths['description'], IndeedParser._xpaths['description'])
+
+    def test_extract_job_id(self):
+        tree = etree.fromstring('<html><head><meta name="groupId" content="acme">'
+                                '<meta name="jobId" content=" SM1-42 "></head></html>')
+        self.assertEqual(('acme', 'SM1-42'),
+                         DiceParser().extract_job_id('https://www.dice.com/job', '', tree))
+
+
+class TestCanonicalizeUrl(TestCase):
+    def test_aggregators(self):
+        for url, canonical in (
+                ('https://boards.greenhouse.io/embed/job_app?for=acme&token=42&b=https://acme.com',
+                 'https://boards.greenhouse.io/embed/job_app?for=acme&token=42'),
+                ('https://newton.newtonsoftware.com/career/JobIntroduction.action'
+                 '?clientId=8a78&source=Indeed&id=8a79',
+                 'https://newton.newtonsoftware.com/career/JobIntroduction.action'
+                 '?clientId=8a78&id=8a79'),
+                ('http://WWW.indeed.com/m/viewjob?jk=ce09&from=serp',
+                 'https://www.indeed.com/viewjob?jk=ce09'),
+                ('https://boards.greenhouse.io/acme/jobs/42?gh_src=x#apply',
+                 'https://boards.greenhouse.io/acme/jobs/42')):
+            with self.subTest(url=url):
+                self.assertEqual(canonical, canonicalize_url(url))
+
+    def test_tracking_params(self):
+        self.assertEqual('http://acme.com/careers?gnk=job&gni=8a78',
+                         canonicalize_url('HTTP://Acme.com:80/careers?gnk=job&gni=8a78&gns=Indeed'))
+        url = 'http://acme.com/job?id=1&x=a%20b'
+        self.assertEqual(url, canonicalize_url(url))
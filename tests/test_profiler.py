@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+from jobtechs.profiler import StackSampler, merge_profiles, read_collapsed, top_functions
+
+
+def busy(started, stop):
+    started.set()
+    while not stop.is_set():
+        sum(range(100))
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'profile.txt')
+
+    def test_sample(self):
+        started, stop = threading.Event(), threading.Event()
+        thread = threading.Thread(target=busy, args=(started, stop))
+        thread.start()
+        started.wait()
+        sampler = StackSampler('test', interval=0.001)
+        try:
+            for _ in range(5):
+                sampler.sample()
+        finally:
+            stop.set()
+            thread.join()
+        stacks = [stack for stack in sampler.counts if __name__ + '.busy' in stack]
+        self.assertEqual(5, sum(sampler.counts[stack] for stack in stacks))
+        self.assertEqual('test', stacks[0][0])
+        self.assertEqual('threading.Thread._bootstrap', stacks[0][1])
+
+    def test_merge(self):
+        for label, count in (('a', 1), ('b', 2)):
+            sampler = StackSampler(label)
+            sampler.counts[(label, 'm.main', 'm.work')] = count
+            sampler.counts[(label, 'm.main', 'threading.Condition.wait')] = 10
+            sampler.save(self.path)
+            os.rename('{}.{}.part'.format(self.path, os.getpid()),
+                      '{}.{}.part'.format(self.path, label))
+        counts = merge_profiles(self.path)
+        self.assertEqual(os.listdir(self.directory), ['profile.txt'])
+        self.assertEqual(counts, read_collapsed(self.path))
+        self.assertEqual(counts[('b', 'm.main', 'm.work')], 2)
+        self.assertEqual(top_functions(counts), [('m.work', 3, 3)])
+        self.assertEqual(top_functions(counts, waiting=True)[0],
+                         ('threading.Condition.wait', 20, 20))
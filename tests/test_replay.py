@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jobtechs import parsepool
+from jobtechs.parser import AutomatonTermsExtractor, GreenHouseParser, PageParser
+from jobtechs.replay import get_parser_key, iter_saved_pages, replay_pages
+
+GENERIC_PAGE = '<html><body><p>Python and C# developer</p></body></html>'
+GREENHOUSE_PAGE = '''<html><head>
+<meta property="og:url" content="https://boards.greenhouse.io/acme/jobs/42">
+</head><body><div id="header"><span class="company-name">at Acme</span></div>
+<div id="content">Django, Python</div></body></html>'''
+
+
+class TestReplay(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        terms_path = os.path.join(self.directory, 'techs.txt')
+        with open(terms_path, 'w') as file_:
+            print('Python', 'C#', 'Django', sep='\n', file=file_)
+        self.extractor = AutomatonTermsExtractor(terms_path)
+        self.pages_dir = os.path.join(self.directory, 'pages')
+        os.mkdir(self.pages_dir)
+        greenhouse = GreenHouseParser(save_pages_to=self.pages_dir)
+        generic = PageParser(save_pages_to=self.pages_dir, agg_parsers=[greenhouse])
+        self.pages = [
+            (generic, 'http://acme.com/jobs/1', GENERIC_PAGE),
+            (generic, 'http://acme.com/jobs/2', GENERIC_PAGE),
+            (greenhouse, 'https://boards.greenhouse.io/embed/job_app?for=acme&token=42',
+             GREENHOUSE_PAGE),
+        ]
+        self.expected = {}
+        for parser, url, text in self.pages:
+            result, _ = parser.parse_page(url, text, self.extractor)
+            self.expected[url] = str(result)
+        self.parsers = {'boards.greenhouse.io': GreenHouseParser(),
+                        'default': PageParser(agg_parsers=[GreenHouseParser()])}
+
+    def test_parser_key(self):
+        netlocs = ['greenhouse.io', 'boards.greenhouse.io']
+        self.assertEqual('boards.greenhouse.io',
+                         get_parser_key('boards.greenhouse.io.acme.42.html', netlocs))
+        self.assertEqual('default', get_parser_key('acme.com.1234.html', netlocs))
+
+    def test_saved_pages_index(self):
+        urls = {url for _, url, _, _ in iter_saved_pages(self.pages_dir, self.parsers)}
+        self.assertEqual(set(self.expected), urls)
+
+    def test_replay_in_pool(self):
+        executor = parsepool.make_pool(self.parsers, self.extractor, max_workers=2)
+        self.addCleanup(executor.shutdown)
+        replayed = {
+            url: str(result)
+            for url, result, error in replay_pages(executor, self.pages_dir, self.parsers,
+                                                   chunk_size=1, max_pending=1)
+        }
+        self.assertEqual(self.expected, replayed)
+
+    def test_parse_pages_batch(self):
+        parser = self.parsers['default']
+        results = parser.parse_pages([(url, text, None) for _, url, text in self.pages[:2]],
+                                     self.extractor)
+        self.assertEqual([self.expected['http://acme.com/jobs/1'],
+                          self.expected['http://acme.com/jobs/2']],
+                         [str(result) for result, _ in results])
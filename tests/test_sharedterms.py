@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jobtechs import parsepool
+from jobtechs.parser import PageParser, TermsExtractor, Vocabulary
+from jobtechs.sharedterms import SharedTermsExtractor
+from jobtechs.termsdb import MappedTermsExtractor
+
+PAGE = '<html><body><p>Python, Kotlin and C# developer</p></body></html>'
+
+
+class TestSharedTermsExtractor(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.terms_path = os.path.join(self.directory, 'techs.txt')
+        self.write_terms('Python', 'C#')
+        self.extractor = SharedTermsExtractor(self.terms_path)
+        self.addCleanup(self.extractor.close)
+
+    def write_terms(self, *terms):
+        with open(self.terms_path, 'w') as file_:
+            print(*terms, sep='\n', file=file_)
+
+    def test_reload_in_processes(self):
+        pool = parsepool.make_pool({'default': PageParser()}, self.extractor, 2)
+        self.addCleanup(pool.shutdown)
+        result, _ = pool.submit(parsepool.parse_page, 'default', 'http://a.com/1', PAGE).result()
+        self.assertEqual(['c#', 'python'], result.techs)
+
+        self.assertFalse(self.extractor.check_terms())
+        self.write_terms('Python', 'Kotlin')
+        # a new file is noticed even if its mtime is the same
+        os.utime(self.terms_path, ns=(0, 0))
+        self.assertTrue(self.extractor.check_terms())
+        self.assertEqual(2, self.extractor.version)
+
+        # the results of the new version are unpickled by the digest of its vocabulary
+        results = [future.result()[0] for future in [
+            pool.submit(parsepool.parse_page, 'default', 'http://a.com/2', PAGE)
+            for _ in range(4)]]
+        self.assertEqual([['kotlin', 'python']] * 4, [result.techs for result in results])
+        self.assertIs(self.extractor.vocabulary, results[0].vocabulary)
+
+    def test_same_terms_are_not_published(self):
+        self.write_terms('C#', 'python')
+        self.assertFalse(self.extractor.check_terms(force=True))
+        self.assertEqual(1, self.extractor.version)
+
+    def test_old_versions_dropped(self):
+        for extractor_cls in (TermsExtractor, MappedTermsExtractor):
+            with self.subTest(extractor_cls=extractor_cls.__name__):
+                self.write_terms('Python', 'C#')
+                extractor = SharedTermsExtractor(self.terms_path, extractor_cls)
+                self.addCleanup(extractor.close)
+                first = extractor.vocabulary
+                self.write_terms('Python', 'Kotlin')
+                self.assertTrue(extractor.check_terms(force=True))
+                # the terms changed back to the first version are registered again
+                self.write_terms('C#', 'Python')
+                self.assertTrue(extractor.check_terms(force=True))
+                self.write_terms('Kotlin')
+                self.assertTrue(extractor.check_terms(force=True))
+                self.assertEqual(['3.pickle', '4.pickle'], sorted(
+                    name for name in os.listdir(extractor.directory)
+                    if name.endswith('.pickle')))
+                self.assertEqual(extractor_cls is MappedTermsExtractor, os.path.exists(
+                    os.path.join(extractor.directory, '4.pickle.termsdb')))
+                self.assertFalse(os.path.exists(
+                    os.path.join(extractor.directory, '2.pickle.termsdb')))
+                self.assertIs(extractor.vocabulary, Vocabulary.get(extractor.vocabulary.digest))
+                self.assertIsNotNone(Vocabulary.get(first.digest))
+                self.write_terms('Go')
+                self.assertTrue(extractor.check_terms(force=True))
+                with self.assertRaises(KeyError):
+                    Vocabulary.get(first.digest)
+
+    def test_delegates(self):
+        extractor = TermsExtractor(self.terms_path)
+        text = 'python and c# developer'
+        self.assertEqual(extractor.terms_to_list(extractor.extract_terms(text)),
+                         self.extractor.terms_to_list(self.extractor.extract_terms(text)))
+        self.assertIs(self.extractor.current(), self.extractor.current().current())
@@ -0,0 +1,68 @@
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jobtechs.parser import Result, Vocabulary
+from jobtechs.sinks import (
+    ColumnarSink, CsvSink, JsonLinesSink, iter_columnar_batches, iter_columnar_results,
+    open_sink)
+
+
+class NonClosingBytesIO(io.BytesIO):
+    def close(self):
+        pass
+
+
+class TestSinks(TestCase):
+    def setUp(self):
+        self.vocabulary = Vocabulary([('c#',), ('node.js',), ('new', 'relic')])
+        self.results = [
+            Result('http://a.com/job/{}'.format(i), 'A, "Inc"' if i % 2 else '',
+                   self.vocabulary.to_array(set(range(i % 4))), 'http://a.com', self.vocabulary)
+            for i in range(10)
+        ]
+
+    def write(self, sink_class, batch_size=3):
+        stream = NonClosingBytesIO()
+        sink = sink_class(stream, batch_size)
+        for result in self.results:
+            sink.write(result)
+        sink.close()
+        self.assertEqual(len(self.results), sink.rows)
+        return stream.getvalue()
+
+    def test_jsonl(self):
+        rows = [json.loads(line) for line in self.write(JsonLinesSink).decode().splitlines()]
+        self.assertEqual({'url': 'http://a.com/job/3', 'company': 'A, "Inc"',
+                          'site': 'http://a.com', 'techs': ['c#', 'new relic', 'node.js']},
+                         rows[3])
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.write(CsvSink).decode())))
+        self.assertEqual(['url', 'company', 'site', 'techs'], rows[0])
+        self.assertEqual(['http://a.com/job/3', 'A, "Inc"', 'http://a.com',
+                          'c#;new relic;node.js'], rows[4])
+
+    def test_columnar(self):
+        data = self.write(ColumnarSink)
+        batches = list(iter_columnar_batches(io.BytesIO(data)))
+        self.assertEqual([3, 3, 3, 1], [len(batch.urls) for batch in batches])
+        self.assertIs(self.vocabulary, batches[0].vocabulary)
+        self.assertEqual([str(result) for result in self.results],
+                         [str(result) for result in iter_columnar_results(io.BytesIO(data))])
+
+    def test_open_sink_compressed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'results.bin.gz')
+        sink = open_sink('columnar', path, 'gzip', batch_size=4)
+        for result in self.results:
+            sink.write(result)
+        sink.close()
+        with gzip.open(path) as file_:
+            self.assertEqual(self.results[-1].techs, list(iter_columnar_results(file_))[-1].techs)
@@ -0,0 +1,59 @@
+import os
+import pickle
+import shutil
+import tempfile
+from unittest import TestCase
+
+from jobtechs.parser import AutomatonTermsExtractor, Vocabulary
+from jobtechs.sharedterms import SharedTermsExtractor
+from jobtechs.termsdb import (
+    MappedTermsExtractor, compile_terms, is_terms_db, read_terms, write_terms_db)
+
+TERMS = ['a', 'a b', 'b c', 'a b c', 'node.js', '.net', 'microsoft .net', 'node.js.io',
+         'c# developer', 'New Relic', 'Apache Hadoop', 'Élan', 'a b c d e']
+
+TEXTS = ['a b c', 'a node.js developer.', 'a .net developer', 'microsoft .net',
+         'a node.js.io file', 'c# developer', 'a, b c', 'New Relic, Apache. Hadoop',
+         'élan a b c d e', 'a b c d', '']
+
+
+class TestMappedTermsExtractor(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.terms_path = os.path.join(self.directory, 'techs.txt')
+        with open(self.terms_path, 'w') as file_:
+            print(*TERMS, sep='\n', file=file_)
+        self.db_path = os.path.join(self.directory, 'techs.termsdb')
+        write_terms_db(compile_terms(read_terms(self.terms_path)), self.db_path)
+        self.expected = AutomatonTermsExtractor(self.terms_path)
+
+    def test_same_as_automaton(self):
+        self.assertTrue(is_terms_db(self.db_path))
+        self.assertFalse(is_terms_db(self.terms_path))
+        for path in (self.db_path, self.terms_path):
+            extractor = MappedTermsExtractor(path)
+            self.assertEqual(self.expected.vocabulary.digest, extractor.vocabulary.digest)
+            self.assertEqual(list(self.expected.vocabulary.names), list(extractor.vocabulary.names))
+            for text in TEXTS:
+                with self.subTest(path=path, text=text):
+                    expected = self.expected.extract_terms(text)
+                    self.assertEqual(expected, extractor.extract_terms(text))
+                    self.assertEqual(expected, extractor.extract_terms_from_chunks(
+                        [text[i:i + 2] for i in range(0, len(text), 2)]))
+            self.assertEqual(self.expected.extract_terms_many(TEXTS),
+                             extractor.extract_terms_many(TEXTS))
+
+    def test_pickled_by_path(self):
+        extractor = MappedTermsExtractor(self.db_path)
+        self.assertLess(len(pickle.dumps(extractor)), 200)
+        copy = pickle.loads(pickle.dumps(extractor))
+        self.assertEqual(['c# developer'], copy.terms_to_list(copy.extract_terms('C# developer')))
+        self.assertIs(copy.vocabulary, Vocabulary.get(extractor.vocabulary.digest))
+
+    def test_shared(self):
+        shared = SharedTermsExtractor(self.db_path, MappedTermsExtractor)
+        self.addCleanup(shared.close)
+        self.assertTrue(shared.current().terms_filename.startswith(shared.directory))
+        self.assertEqual(self.expected.extract_terms('a node.js developer'),
+                         shared.extract_terms('a node.js developer'))
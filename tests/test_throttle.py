@@ -0,0 +1,115 @@
+import multiprocessing as mp
+import threading
+import time
+from unittest import TestCase
+
+from jobtechs.throttle import HostScheduler, TokenBucket, parse_retry_after
+
+
+def acquire_tokens(bucket, count):
+    for _ in range(count):
+        bucket.acquire()
+
+
+class TestTokenBucket(TestCase):
+    def test_reservations_are_spaced(self):
+        bucket = TokenBucket(rate=10)
+        delays = [bucket.reserve() for _ in range(4)]
+        self.assertAlmostEqual(0, delays[0], places=2)
+        for prev, cur in zip(delays, delays[1:]):
+            self.assertAlmostEqual(0.1, cur - prev, places=2)
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=10, capacity=3)
+        delays = [bucket.reserve() for _ in range(4)]
+        self.assertEqual([0, 0, 0], [round(delay, 2) for delay in delays[:3]])
+        self.assertAlmostEqual(0.1, delays[3], places=2)
+
+    def test_shared_between_processes(self):
+        bucket = TokenBucket(rate=50)
+        start = time.monotonic()
+        procs = [mp.Process(target=acquire_tokens, args=(bucket, 5)) for _ in range(2)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        # 10 tokens with the first one free
+        self.assertGreaterEqual(time.monotonic() - start, 9 / 50)
+        self.assertAlmostEqual(50, bucket.achieved_rate, delta=5)
+
+
+class TestHostScheduler(TestCase):
+    def test_hosts_are_interleaved(self):
+        scheduler = HostScheduler(max_concurrency=1)
+        for url in ('http://a/1', 'http://a/2', 'http://b/1'):
+            scheduler.put(url)
+        scheduler.close()
+        self.assertEqual('http://a/1', scheduler.get())
+        # a is busy with a/1
+        self.assertEqual('http://b/1', scheduler.get())
+        scheduler.done('http://a/1', latency=0.01, status=200)
+        self.assertEqual('http://a/2', scheduler.get())
+        self.assertIsNone(scheduler.get())
+
+    def test_max_queued(self):
+        scheduler = HostScheduler(max_concurrency=5, initial_concurrency=5, max_queued=2)
+        producer = threading.Thread(
+            target=lambda: [scheduler.put('http://a/{}'.format(i)) for i in range(5)])
+        producer.start()
+        time.sleep(0.05)
+        self.assertEqual(2, scheduler.queued)
+        self.assertTrue(producer.is_alive())
+        urls = [scheduler.get() for _ in range(5)]
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(['http://a/{}'.format(i) for i in range(5)], urls)
+
+    def test_host_rps(self):
+        scheduler = HostScheduler(host_rps=20, max_concurrency=5, initial_concurrency=5)
+        for i in range(3):
+            scheduler.put('http://a/{}'.format(i))
+        scheduler.close()
+        start = time.monotonic()
+        while scheduler.get():
+            pass
+        self.assertGreaterEqual(time.monotonic() - start, 2 / 20)
+
+    def test_concurrency_adapts(self):
+        scheduler = HostScheduler(max_concurrency=4, initial_concurrency=1)
+        # a url stays queued, the state of an idle host not slowed down is dropped
+        scheduler.put('http://a/')
+        for _ in range(10):
+            scheduler.put('http://a/')
+            scheduler.get()
+            scheduler.done('http://a/', latency=0.01, status=200)
+        scheduler.get()
+        self.assertEqual(4, scheduler.host_stats()['a'][0])
+
+        scheduler.done('http://a/', latency=0.01, status=429, retry_after=0.2)
+        concurrency, interval = scheduler.host_stats()['a']
+        self.assertEqual(2, concurrency)
+        self.assertGreaterEqual(interval, 1)
+
+        scheduler.put('http://a/')
+        scheduler.close()
+        start = time.monotonic()
+        self.assertEqual('http://a/', scheduler.get())
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+    def test_idle_hosts_dropped(self):
+        scheduler = HostScheduler(max_concurrency=1)
+        for i in range(100):
+            scheduler.put('http://host{}/'.format(i))
+        scheduler.put('http://slow/')
+        for _ in range(101):
+            url = scheduler.get()
+            status = 429 if url == 'http://slow/' else 200
+            scheduler.done(url, latency=0.01, status=status)
+        scheduler.put('http://last/')
+        self.assertEqual({'slow', 'last'}, set(scheduler.host_stats()))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120, parse_retry_after('120'))
+        self.assertEqual(0, parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))